@@ -0,0 +1,500 @@
+"""Heap allocation and throughput of a microcontroller message handler.
+
+Runs :class:`ReferenceHandler`, a reference implementation of the command
+handling left to complete in ``microcontroller_client.py``, built on that
+script's helpers, under CPython (with the asyncio ``mqtt_as``, the dummy
+``netman`` and placeholder secrets). It is measured in its low-allocation
+mode and without it (``low_alloc=False``):
+
+- allocation: heap bytes allocated (peak above the baseline, via
+  :mod:`tracemalloc`) to parse a command, and to run it and build the reply
+- throughput: the highest message rate the receiver -> worker -> publisher
+  pipeline sustains, fed as fast as possible through a fake MQTT client,
+  with the number of commands dropped by the bounded work queue
+- with ``--broker``, also end to end: the pipeline on a real
+  ``mqtt_as.MQTTClient`` against an in-process :class:`mqtt_broker.MQTTBroker`,
+  with an orchestrator keeping ``--window`` commands awaiting their reply,
+  and the commands lost to the client's ``queue_len`` and the work queue
+
+CPython objects are larger than MicroPython's, so absolute numbers differ
+from the board, but the ratio between the modes carries over. On the board,
+``gc.mem_alloc()`` before and after a message (with ``gc.disable()``) gives
+the exact figure.
+
+Usage::
+
+    python benchmarks/bench_device_handler.py
+    python benchmarks/bench_device_handler.py --n 20000 --publish-delay 0.0005
+    python benchmarks/bench_device_handler.py --broker --window 16
+"""
+import gc
+import os
+import sys
+import json
+import types
+import asyncio
+import argparse
+import tracemalloc
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_handler():
+    # the board reads its credentials from my_secrets.py; placeholders suffice
+    # here, since nothing connects
+    secrets = types.ModuleType("my_secrets")
+    secrets.__dict__.update(
+        HIVEMQ_HOST="localhost",
+        HIVEMQ_USERNAME="bench",
+        HIVEMQ_PASSWORD="bench",
+        COURSE_ID="bench-course",
+        SSID="bench",
+        PASSWORD="bench",
+    )
+    sys.modules.setdefault("my_secrets", secrets)
+    sys.path.insert(0, ROOT)
+    import microcontroller_client
+
+    return microcontroller_client
+
+
+class ReferenceHandler:
+    """Answer commands through a pipeline of three tasks.
+
+    A slow experiment or publish never holds up receiving the next command::
+
+        receiver --(work queue)--> worker --(outbox)--> publisher
+
+    The work queue holds at most ``work_queue_len`` messages, highest
+    ``"priority"`` first. When it is full, the lowest-priority newest message
+    is dropped and counted. The outbox holds at most ``outbox_len`` replies;
+    when publishing falls behind, the worker waits for space (backpressure)
+    and the work queue absorbs the burst. Replies are published one at a
+    time: each awaits its QoS 1 acknowledgement before the next is sent.
+
+    A command whose experiment or reply fails is forgotten by the
+    deduplication, as is a dropped one, so a redelivery is run again.
+
+    With ``low_alloc``, single binary replies are packed into reusable
+    buffers (one per outbox slot, plus the ones being filled and sent), and
+    the sensor data of single JSON replies go into one reused dict, to spare
+    the Pico W's small heap. The heap is collected while idle rather than
+    mid-burst, once less than ``gc_min_free`` bytes are free (MicroPython
+    only).
+
+    Parameters
+    ----------
+    handler : module
+        ``microcontroller_client``, for its topics, codec, deduplication and
+        :class:`BoundedQueue`.
+    """
+
+    def __init__(
+        self,
+        handler,
+        low_alloc=True,
+        work_queue_len=32,
+        outbox_len=8,
+        gc_min_free=16 * 1024,
+    ):
+        self.handler = handler
+        self.low_alloc = low_alloc
+        self.gc_min_free = gc_min_free
+        self.work_queue = handler.BoundedQueue(work_queue_len)
+        self.outbox = handler.BoundedQueue(outbox_len)
+        self.command_topic = handler.command_topic.encode()
+        self.free_buffers = [
+            bytearray(handler.RESULT_SIZE + handler.MAX_ID_LEN)
+            for _ in range(outbox_len + 2)
+        ]
+        self.sensor_values = [0.0] * handler.N_CHANNELS
+        self.sensor_data_scratch = {}
+        # time a message waits in the work queue, time to run its
+        # experiments, time to publish the reply and time collecting garbage
+        self.histograms = {
+            name: handler.Histogram() for name in ("wait", "experiment", "publish", "gc")  # noqa: E501
+        }
+        self.counters = dict.fromkeys(
+            ("messages", "commands", "dropped", "errors", "gc"), 0
+        )
+
+    def tasks(self, client):
+        """Coroutines of the receiver, worker and publisher, to run as tasks."""
+        return [self.messages(client), self.worker(), self.publisher(client)]
+
+    def run_commands(self, payload_dicts):
+        # run each experiment and return the payload, batched like the commands
+        h = self.handler
+        binary = payload_dicts[0].get("encoding") == "binary"
+        parts = []
+        for payload_dict in payload_dicts:
+            cmd = payload_dict["command"]
+            sensor_data = h.run_color_experiment(cmd["R"], cmd["G"], cmd["B"])
+            if binary:
+                parts.append(h.encode_result(payload_dict, sensor_data))
+            else:
+                payload_dict["sensor_data"] = sensor_data
+                parts.append(payload_dict)
+        return parts, binary
+
+    def build_reply(self, payload_dicts, batch):
+        """Run the experiments and return (payload, buffer to reuse or None)."""
+        h = self.handler
+        binary = payload_dicts[0].get("encoding") == "binary"
+        if self.low_alloc and not batch:
+            payload_dict = payload_dicts[0]
+            cmd = payload_dict["command"]
+            if (
+                binary
+                and self.free_buffers
+                and len(payload_dict["experiment_id"]) <= h.MAX_ID_LEN
+            ):
+                buf = self.free_buffers.pop()
+                h.fill_sensor_values(cmd["R"], cmd["G"], cmd["B"], self.sensor_values)
+                n = h.encode_result_into(buf, payload_dict, self.sensor_values)
+                return memoryview(buf)[:n], buf
+            if not binary:
+                h.fill_sensor_values(cmd["R"], cmd["G"], cmd["B"], self.sensor_values)
+                for i in range(h.N_CHANNELS):
+                    self.sensor_data_scratch[h.CHANNELS[i]] = self.sensor_values[i]
+                payload_dict["sensor_data"] = self.sensor_data_scratch
+                return json.dumps(payload_dict), None
+        parts, binary = self.run_commands(payload_dicts)
+        if binary and batch:
+            header = h.struct.pack(
+                h.BATCH_FORMAT, h.WIRE_VERSION, h.BATCH_MESSAGE, len(parts)
+            )
+            return header + b"".join(parts), None
+        elif binary:
+            return parts[0], None
+        elif batch:
+            return json.dumps({"batch": parts}), None
+        return json.dumps(parts[0]), None
+
+    def collect_garbage(self):
+        # Collect while idle, before the heap runs low, instead of leaving it
+        # to the allocator in the middle of a burst
+        mem_free = getattr(gc, "mem_free", None)
+        if mem_free is not None and mem_free() < self.gc_min_free:
+            t0 = self.handler.ticks_ms()
+            gc.collect()
+            self.histograms["gc"].record(
+                self.handler.ticks_diff(self.handler.ticks_ms(), t0)
+            )
+            self.counters["gc"] += 1
+
+    def print_exception(self, e):
+        self.counters["errors"] += 1
+        print(f"{type(e).__name__}: {e}")
+
+    async def messages(self, client):
+        """Receive commands and queue them for the worker."""
+        h = self.handler
+        async for topic, msg, retained in client.queue:
+            try:
+                # compare the raw bytes rather than decoding the topic
+                if topic != self.command_topic:
+                    continue
+                # a single payload dictionary or {"batch": [...]} of them
+                message_dict = json.loads(msg)
+                batch = "batch" in message_dict
+                payload_dicts = message_dict["batch"] if batch else [message_dict]
+                payload_dicts = [
+                    p for p in payload_dicts if h.first_time(p["experiment_id"])
+                ]
+                if not payload_dicts:
+                    continue
+                self.counters["messages"] += 1
+                self.counters["commands"] += len(payload_dicts)
+                priority = max(p.get("priority", 0) for p in payload_dicts)
+                dropped = self.work_queue.put_nowait(
+                    (payload_dicts, batch, h.ticks_ms()), priority
+                )
+                if dropped is not None:
+                    for p in dropped[0]:
+                        h.forget(p["experiment_id"])
+                    self.counters["dropped"] += len(dropped[0])
+            except Exception as e:
+                self.print_exception(e)
+
+    async def worker(self):
+        """Run the queued experiments and hand the replies to the publisher."""
+        h = self.handler
+        while True:
+            payload_dicts, batch, queued_at = await self.work_queue.get()
+            try:
+                t0 = h.ticks_ms()
+                self.histograms["wait"].record(h.ticks_diff(t0, queued_at))
+                payload, buf = self.build_reply(payload_dicts, batch)
+                self.histograms["experiment"].record(h.ticks_diff(h.ticks_ms(), t0))
+                ids = [p["experiment_id"] for p in payload_dicts]
+                # waits while the publisher is behind
+                await self.outbox.put((payload, buf, ids))
+            except Exception as e:
+                for p in payload_dicts:
+                    h.forget(p["experiment_id"])
+                self.print_exception(e)
+            if not len(self.work_queue):
+                self.collect_garbage()
+            await asyncio.sleep(0)  # let the receiver in between experiments
+
+    async def publisher(self, client):
+        """Send the replies, in order."""
+        h = self.handler
+        while True:
+            payload, buf, ids = await self.outbox.get()
+            try:
+                t0 = h.ticks_ms()
+                await client.publish(h.sensor_data_topic, payload, qos=h.QOS)
+                self.histograms["publish"].record(h.ticks_diff(h.ticks_ms(), t0))
+            except Exception as e:
+                for experiment_id in ids:
+                    h.forget(experiment_id)
+                self.print_exception(e)
+            if buf is not None:
+                self.free_buffers.append(buf)  # sent, so the buffer can be reused
+
+
+def messages(handler, n, encoding, prefix):
+    topic = handler.command_topic.encode()
+    for i in range(n):
+        payload_dict = {
+            "command": {"R": i % 256, "G": (7 * i) % 256, "B": (13 * i) % 256},
+            "experiment_id": f"{prefix}{i:08x}",
+        }
+        if encoding != "json":
+            payload_dict["encoding"] = encoding
+        yield topic, json.dumps(payload_dict).encode(), False
+
+
+def reply(reference, payload_dict):
+    # what the worker and publisher do for one command, inline
+    payload, buf = reference.build_reply([payload_dict], False)
+    if buf is not None:
+        reference.free_buffers.append(buf)
+    return payload
+
+
+def traced(func, args):
+    # heap bytes allocated by func(*args) at its peak, above the baseline
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    func(*args)
+    return tracemalloc.get_traced_memory()[1] - before
+
+
+def bench_allocation(handler, n, encoding, low_alloc):
+    reference = ReferenceHandler(handler, low_alloc=low_alloc)
+    prefix = f"a{int(low_alloc)}{encoding[0]}"
+    msgs = [msg for _, msg, _ in messages(handler, n, encoding, prefix)]
+    for msg in msgs[:10]:  # warm up (interned strings, caches)
+        reply(reference, json.loads(msg))
+    payload_dicts = [json.loads(msg) for msg in msgs[10:]]
+    parse, build = [], []
+    tracemalloc.start()
+    for msg, payload_dict in zip(msgs[10:], payload_dicts):
+        # parsing the command allocates the same in both modes
+        parse.append(traced(json.loads, (msg,)))
+        build.append(traced(reply, (reference, payload_dict)))
+    tracemalloc.stop()
+    parse.sort()
+    build.sort()
+    return {
+        "encoding": encoding,
+        "low_alloc": low_alloc,
+        "parse_bytes_p50": parse[len(parse) // 2],
+        "reply_bytes_p50": build[len(build) // 2],
+        "reply_bytes_max": build[-1],
+    }
+
+
+class FakeClient:
+    """Stands in for mqtt_as.MQTTClient: an async-iterable queue and publish."""
+
+    def __init__(self, incoming, publish_delay):
+        self.incoming = incoming
+        self.publish_delay = publish_delay
+        self.published = 0
+
+    @property
+    def queue(self):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def publish(self, topic, payload, qos=0):
+        if self.publish_delay:
+            await asyncio.sleep(self.publish_delay)
+        self.published += 1
+
+
+def bench_throughput(handler, n, encoding, low_alloc, publish_delay):
+    reference = None
+
+    async def run():
+        nonlocal reference
+        # the queues use asyncio.Event, which must be created on this loop
+        reference = ReferenceHandler(handler, low_alloc=low_alloc)
+        incoming = asyncio.Queue()
+        client = FakeClient(incoming, publish_delay)
+        tasks = [asyncio.create_task(task) for task in reference.tasks(client)]
+        prefix = f"t{int(low_alloc)}{encoding[0]}{publish_delay}"
+        start = perf_counter()
+        for message in messages(handler, n, encoding, prefix):
+            incoming.put_nowait(message)
+            await asyncio.sleep(0)  # one message per scheduler pass
+        incoming.put_nowait(None)
+        while client.published < n - reference.counters["dropped"]:
+            await asyncio.sleep(0)
+        dropped = reference.counters["dropped"]
+        elapsed = perf_counter() - start
+        for task in tasks:
+            task.cancel()
+        return client.published, dropped, elapsed
+
+    published, dropped, elapsed = asyncio.run(run())
+    return {
+        "encoding": encoding,
+        "low_alloc": low_alloc,
+        "publish_delay_ms": publish_delay * 1000,
+        "messages_per_second": published / elapsed,
+        "dropped": dropped,
+        "work_queue_max_depth": reference.work_queue.max_depth,
+    }
+
+
+def bench_broker(handler, n, encoding, low_alloc, window, queue_len):
+    from mqtt_as import MQTTClient, config
+    from mqtt_broker import MQTTBroker
+
+    async def run(broker):
+        reference = ReferenceHandler(handler, low_alloc=low_alloc)
+        settings = {**config, "server": broker.host, "port": broker.port}
+        device = MQTTClient({**settings, "client_id": "bench-device", "queue_len": queue_len})  # noqa: E501
+        orchestrator = MQTTClient(
+            {**settings, "client_id": "bench-orchestrator", "queue_len": n}
+        )
+        await device.connect()
+        await device.subscribe(handler.command_topic, handler.QOS)
+        await orchestrator.connect()
+        await orchestrator.subscribe(handler.sensor_data_topic, handler.QOS)
+        tasks = [asyncio.create_task(task) for task in reference.tasks(device)]
+        prefix = f"b{int(low_alloc)}{encoding[0]}{window}"
+        received = 0
+        # at most window commands awaiting their reply
+        slots = asyncio.Semaphore(window)
+
+        async def replies():
+            nonlocal received
+            async for _ in orchestrator.queue:
+                received += 1
+                slots.release()
+
+        tasks.append(asyncio.create_task(replies()))
+        start = perf_counter()
+        sent = 0
+        for topic, msg, _ in messages(handler, n, encoding, prefix):
+            try:
+                await asyncio.wait_for(slots.acquire(), 5)
+            except asyncio.TimeoutError:
+                break  # commands were lost
+            tasks.append(
+                asyncio.create_task(
+                    orchestrator.publish(topic.decode(), msg, qos=handler.QOS)
+                )
+            )
+            sent += 1
+        deadline = perf_counter() + 5
+        while received < sent and perf_counter() < deadline:
+            await asyncio.sleep(0.001)
+        lost = n - received
+        elapsed = perf_counter() - start
+        for task in tasks:
+            task.cancel()
+        await orchestrator.disconnect()
+        await device.disconnect()
+        return received, device.queue.discards, lost, elapsed
+
+    with MQTTBroker() as broker:
+        received, discards, lost, elapsed = asyncio.run(run(broker))
+    return {
+        "encoding": encoding,
+        "low_alloc": low_alloc,
+        "window": window,
+        "messages_per_second": received / elapsed,
+        "queue_discards": discards,
+        "dropped": lost - discards,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n", type=int, default=5000, help="messages per case")
+    parser.add_argument(
+        "--publish-delay",
+        type=float,
+        default=0.0,
+        help="seconds each publish takes (e.g. 0.0005 to provoke backpressure)",
+    )
+    parser.add_argument(
+        "--broker",
+        action="store_true",
+        help="also measure end to end through mqtt_as and a local broker",
+    )
+    parser.add_argument(
+        "--window", type=int, default=8, help="commands awaiting a reply (--broker)"
+    )
+    parser.add_argument(
+        "--queue-len", type=int, default=16, help="the device's mqtt_as queue_len"
+    )
+    args = parser.parse_args(argv)
+    handler = import_handler()
+
+    print("Heap allocated per message (tracemalloc, CPython objects):")
+    for encoding in ("json", "binary"):
+        for low_alloc in (False, True):
+            case = bench_allocation(handler, min(args.n, 2000), encoding, low_alloc)
+            print(
+                f"  {encoding:<7} low_alloc={str(low_alloc):<6}"
+                f"parse {case['parse_bytes_p50']:5d} B  "
+                f"reply {case['reply_bytes_p50']:5d} B (max {case['reply_bytes_max']:5d})"  # noqa: E501
+            )
+
+    print("\nSustained rate through receiver -> worker -> publisher:")
+    for encoding in ("json", "binary"):
+        for low_alloc in (False, True):
+            case = bench_throughput(
+                handler, args.n, encoding, low_alloc, args.publish_delay
+            )
+            print(
+                f"  {encoding:<7} low_alloc={str(low_alloc):<6}"
+                f"{case['messages_per_second']:9.0f} msg/s  "
+                f"dropped {case['dropped']:5d}  "
+                f"work queue max {case['work_queue_max_depth']}"
+            )
+
+    if args.broker:
+        print(f"\nEnd to end through mqtt_as and a local broker (window {args.window}):")  # noqa: E501
+        for encoding in ("json", "binary"):
+            for low_alloc in (False, True):
+                case = bench_broker(
+                    handler, args.n, encoding, low_alloc, args.window, args.queue_len
+                )
+                print(
+                    f"  {encoding:<7} low_alloc={str(low_alloc):<6}"
+                    f"{case['messages_per_second']:9.0f} msg/s  "
+                    f"queue discards {case['queue_discards']:5d}  "
+                    f"dropped {case['dropped']:5d}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""Round-trip benchmarks against an in-process broker and simulated device.
+
+Everything runs offline: an :class:`mqtt_broker.MQTTBroker` on localhost and
+a :class:`color_experiment.SimulatedMicrocontroller` answering the commands,
+so numbers measure the client code and the MQTT round trip, not WiFi.
+
+Scenarios (each swept over its own parameters):
+
+- ``hivemq_communication``: payload size x QoS x concurrent callers
+- ``run_experiment``: ``orchestrator_client.get_client_and_queue`` and
+  ``run_experiment``, one command at a time, per QoS
+- ``iter_batch``: window (commands in flight) x commands per message
+
+For every case, p50/p99 latency and messages per second are printed and
+saved to ``benchmarks/results/<commit>.json``; ``--compare`` prints the
+ratios to an earlier results file.
+
+Usage::
+
+    python benchmarks/bench_round_trip.py             # full sweep
+    python benchmarks/bench_round_trip.py --quick     # smoke run
+    python benchmarks/bench_round_trip.py --compare benchmarks/results/abc1234.json
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+from contextlib import redirect_stdout
+from queue import Queue
+from time import perf_counter, strftime
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt_client
+
+from mqtt_broker import MQTTBroker
+from communication import (
+    MQTTSession,
+    hivemq_communication,
+    iter_batch,
+    decode_results,
+)
+from color_experiment import SimulatedMicrocontroller
+from metrics import Histogram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+USERNAME = "bench-user"
+PASSWORD = "bench-password"
+COURSE_ID = "bench-course"
+COMMAND_TOPIC = f"{COURSE_ID}/neopixel"
+SENSOR_DATA_TOPIC = f"{COURSE_ID}/as7341"
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def payload_dicts(n, prefix, payload_size=0):
+    padding = "x" * payload_size
+    for i in range(n):
+        payload_dict = {
+            "command": {"R": i % 256, "G": (7 * i) % 256, "B": (13 * i) % 256},
+            "experiment_id": f"{prefix}-{i}",
+        }
+        if payload_size:
+            payload_dict["padding"] = padding
+        yield payload_dict
+
+
+def summarize(name, params, latencies, elapsed, n_messages):
+    histogram = Histogram(name)
+    for latency in latencies:
+        histogram.record(latency)
+    return {
+        "scenario": name,
+        "params": params,
+        "n": n_messages,
+        "p50_ms": histogram.percentile(50) * 1000,
+        "p99_ms": histogram.percentile(99) * 1000,
+        "mean_ms": histogram.mean * 1000,
+        "messages_per_second": n_messages / elapsed,
+    }
+
+
+def connect_session(broker):
+    return MQTTSession(
+        broker.host, USERNAME, PASSWORD, port=broker.port, tls=False
+    ).connect()
+
+
+def bench_hivemq_communication(broker, n, payload_size, qos, concurrency):
+    session = connect_session(broker)
+    prefix = f"hc-{payload_size}-{qos}-{concurrency}"
+    requests = [json.dumps(p) for p in payload_dicts(n, prefix, payload_size)]
+
+    def request(message):
+        start = perf_counter()
+        hivemq_communication(
+            message, SENSOR_DATA_TOPIC, COMMAND_TOPIC, session=session, qos=qos
+        )
+        return perf_counter() - start
+
+    request(requests[0])  # warm up (subscription, multiplexer)
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(request, requests[1:]))
+    elapsed = perf_counter() - start
+    session.close()
+    params = {"payload_size": payload_size, "qos": qos, "concurrency": concurrency}
+    return summarize("hivemq_communication", params, latencies, elapsed, len(latencies))
+
+
+def bench_run_experiment(broker, n, qos):
+    import orchestrator_client
+
+    client, queue = orchestrator_client.get_client_and_queue(
+        SENSOR_DATA_TOPIC,
+        broker.host,
+        USERNAME,
+        password=PASSWORD,
+        port=broker.port,
+        tls=False,
+        qos=qos,
+    )
+    latencies = []
+    start = perf_counter()
+    # on_message prints every message; keep that out of the report
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for payload_dict in payload_dicts(n, f"re-{qos}"):
+            t0 = perf_counter()
+            orchestrator_client.run_experiment(
+                client, queue, COMMAND_TOPIC, payload_dict, queue_timeout=10, qos=qos
+            )
+            latencies.append(perf_counter() - t0)
+    elapsed = perf_counter() - start
+    client.disconnect()
+    return summarize("run_experiment", {"qos": qos}, latencies, elapsed, n)
+
+
+def bench_iter_batch(broker, n, window, batch_size, qos=2):
+    queue = Queue()
+    client = mqtt_client.Client()
+    client.username_pw_set(USERNAME, PASSWORD)
+
+    def on_message(client, userdata, msg):
+        for results_dict in decode_results(msg.payload):
+            queue.put(results_dict)
+
+    client.on_message = on_message
+    client.connect(broker.host, broker.port)
+    client.subscribe(SENSOR_DATA_TOPIC, qos=qos)
+    client.loop_start()
+
+    requests = list(payload_dicts(n, f"ib-{window}-{batch_size}"))
+    sent_at = {}
+    latencies = []
+
+    def timed(payload_dicts):
+        # iter_batch consumes payload_dicts lazily, just before publishing
+        for payload_dict in payload_dicts:
+            sent_at[payload_dict["experiment_id"]] = perf_counter()
+            yield payload_dict
+
+    start = perf_counter()
+    for index, result in iter_batch(
+        client,
+        queue,
+        COMMAND_TOPIC,
+        timed(requests),
+        window=window,
+        queue_timeout=30,
+        qos=qos,
+        batch_size=batch_size,
+    ):
+        if result is not None:
+            latencies.append(perf_counter() - sent_at[result["experiment_id"]])
+    elapsed = perf_counter() - start
+    client.loop_stop()
+    client.disconnect()
+    params = {"window": window, "batch_size": batch_size, "qos": qos}
+    return summarize("iter_batch", params, latencies, elapsed, len(latencies))
+
+
+def run(args):
+    cases = []
+    with MQTTBroker(username=USERNAME, password=PASSWORD) as broker:
+        # orchestrator_client reads its settings from the environment on import
+        os.environ.update(
+            {
+                "HIVEMQ_HOST": broker.host,
+                "HIVEMQ_PORT": str(broker.port),
+                "HIVEMQ_TLS": "0",
+                "HIVEMQ_USERNAME": USERNAME,
+                "HIVEMQ_PASSWORD": PASSWORD,
+                "COURSE_ID": COURSE_ID,
+            }
+        )
+        device_session = connect_session(broker)
+        with SimulatedMicrocontroller(device_session, COMMAND_TOPIC, SENSOR_DATA_TOPIC):
+            for payload_size in args.payload_sizes:
+                for qos in args.qos:
+                    for concurrency in args.concurrency:
+                        cases.append(
+                            bench_hivemq_communication(
+                                broker, args.n, payload_size, qos, concurrency
+                            )
+                        )
+                        report(cases[-1])
+            for qos in args.qos:
+                cases.append(bench_run_experiment(broker, max(args.n // 10, 5), qos))
+                report(cases[-1])
+            for window in args.concurrency:
+                for batch_size in args.batch_sizes:
+                    if batch_size > window:
+                        continue
+                    cases.append(bench_iter_batch(broker, args.n * 4, window, batch_size))
+                    report(cases[-1])
+        device_session.close()
+    return cases
+
+
+def report(case):
+    params = " ".join(f"{key}={value}" for key, value in case["params"].items())
+    print(
+        f"{case['scenario']:<22}{params:<44}"
+        f"p50 {case['p50_ms']:8.3f} ms  p99 {case['p99_ms']:8.3f} ms  "
+        f"{case['messages_per_second']:9.1f} msg/s"
+    )
+
+
+def case_key(case):
+    return case["scenario"], tuple(sorted(case["params"].items()))
+
+
+def compare(cases, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {case_key(case): case for case in json.load(f)["cases"]}
+    print(f"\nCompared to {baseline_path} (new / old):")
+    for case in cases:
+        old = baseline.get(case_key(case))
+        if old is None:
+            continue
+        params = " ".join(f"{key}={value}" for key, value in case["params"].items())
+        print(
+            f"{case['scenario']:<22}{params:<44}"
+            f"p50 x{case['p50_ms'] / old['p50_ms']:5.2f}  "
+            f"p99 x{case['p99_ms'] / old['p99_ms']:5.2f}  "
+            f"msg/s x{case['messages_per_second'] / old['messages_per_second']:5.2f}"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n", type=int, default=500, help="requests per case")
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[0, 1024, 16384])  # noqa: E501
+    parser.add_argument("--qos", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--quick", action="store_true", help="small smoke run")
+    parser.add_argument("--output", help="results file (default: results/<commit>.json)")  # noqa: E501
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.n = 50
+        args.payload_sizes = [0]
+        args.qos = [1]
+        args.concurrency = [1, 8]
+        args.batch_sizes = [1, 8]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sys.path.insert(0, ROOT)  # for orchestrator_client
+    commit = git_commit()
+    cases = run(args)
+    results = {
+        "commit": commit,
+        "time": strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+        "cases": cases,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved to {output}")
+    if args.compare:
+        compare(cases, args.compare)
+
+
+if __name__ == "__main__":
+    main()
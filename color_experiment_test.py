@@ -0,0 +1,105 @@
+import numpy as np
+from color_experiment import (
+    CHANNELS,
+    WEIGHTS,
+    run_color_experiment,
+    run_color_experiments,
+    rgb_grid,
+    RecursiveLeastSquares,
+    quadratic_features,
+    adaptive_search,
+    InverseSolver,
+)
+
+
+def reference_color_experiment(R, G, B):
+    """The original per-experiment dictionary comprehension."""
+    wavelengths = [410, 440, 470, 510, 550, 583, 620, 670]
+    rw = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.9, 1.0]
+    gw = [0.2, 0.4, 0.6, 0.8, 1.0, 0.8, 0.4, 0.2]
+    bw = [0.9, 1.0, 0.8, 0.6, 0.4, 0.2, 0.1, 0.0]
+    return {
+        f"ch{wavelength}": rw[i] * R + gw[i] * G + bw[i] * B
+        for i, wavelength in enumerate(wavelengths)
+    }
+
+
+def test_matches_reference():
+    rng = np.random.default_rng(42)
+    rgb = rng.integers(0, 256, size=(1000, 3))
+    sensor_data = run_color_experiments(rgb)
+    for (R, G, B), row in zip(rgb.tolist(), sensor_data):
+        expected = reference_color_experiment(R, G, B)
+        assert np.allclose(row, [expected[ch] for ch in CHANNELS], rtol=0, atol=1e-9)
+        sensor_data = run_color_experiment(R, G, B)
+        assert list(sensor_data) == list(expected)
+        assert np.allclose(
+            list(sensor_data.values()), list(expected.values()), rtol=0, atol=1e-9
+        )
+
+
+def test_chunked_matches_unchunked():
+    rgb = rgb_grid(17)
+    out = np.zeros((len(rgb), len(CHANNELS)))
+    chunked = run_color_experiments(rgb, max_bytes=1000, out=out)
+    assert chunked is out
+    assert np.array_equal(chunked, run_color_experiments(rgb))
+
+
+def test_recursive_least_squares_matches_batch_fit():
+    rng = np.random.default_rng(0)
+    X = quadratic_features(rng.integers(0, 256, size=(200, 3)))
+    Y = X @ rng.normal(size=(X.shape[1], len(CHANNELS))) + rng.normal(0, 0.01, (200, 8))  # noqa: E501
+    model = RecursiveLeastSquares(X.shape[1], len(CHANNELS))
+    for start in range(0, 200, 7):
+        model.update(X[start : start + 7], Y[start : start + 7])
+    coef, *_ = np.linalg.lstsq(X, Y, rcond=None)
+    assert model.n_samples == 200
+    assert np.allclose(model.coef, coef, atol=1e-4)
+    assert np.allclose(model.predict(X), X @ coef, atol=1e-3)
+
+
+def test_adaptive_search_beats_a_grid_sweep():
+    # a nonlinear, noisy device, unlike the model in run_color_experiments
+    rng = np.random.default_rng(1)
+
+    def device(commands):
+        rgb = np.array([[c["R"], c["G"], c["B"]] for c in commands], dtype=float)
+        sensor_data = run_color_experiments(255 * (rgb / 255) ** 2.2)
+        return sensor_data + rng.normal(0, 0.5, sensor_data.shape)
+
+    target = run_color_experiments([[40, 200, 90]])[0]
+    planner = adaptive_search(device, target, features="quadratic", rng=0)
+    grid = rgb_grid(16)
+    grid_errors = planner.errors(run_color_experiments(255 * (grid / 255) ** 2.2))
+    assert planner.converged
+    assert planner.n_evaluations < len(grid) / 10
+    assert planner.best_error < grid_errors.min() / 5
+    assert all(np.diff(planner.history) <= 0)
+
+
+def test_inverse_solver_round_trips_and_is_optimal():
+    solver = InverseSolver()
+    rng = np.random.default_rng(2)
+    rgb = rng.integers(0, 256, size=(1000, 3))
+    assert np.array_equal(solver.solve(run_color_experiments(rgb), refine=True), rgb)
+
+    # spectra out of gamut: the bounded solution satisfies the KKT conditions
+    spectra = run_color_experiments(rng.uniform(-100, 400, size=(1000, 3)))
+    spectra += rng.normal(0, 20, spectra.shape)
+    x = solver.solve(spectra)
+    assert np.all((x >= 0) & (x <= 255))
+    gradient = (x @ WEIGHTS - spectra) @ WEIGHTS.T
+    tol = 1e-6 * np.abs(spectra).max()
+    assert np.all(np.abs(gradient[(x > 0) & (x < 255)]) < tol)
+    assert np.all(gradient[x == 0] > -tol) and np.all(gradient[x == 255] < tol)
+    clipped = np.clip(solver.solve_unconstrained(spectra), 0, 255)
+    _, residual = solver.solve(spectra, return_residual=True)
+    clipped_residual = np.sqrt(np.mean((clipped @ WEIGHTS - spectra) ** 2, axis=1))
+    assert np.all(residual <= clipped_residual + 1e-9)
+
+    # the integer refinement is at least as good as plain rounding
+    _, refined = solver.solve(spectra, refine=True, return_residual=True)
+    rounded = np.rint(x)
+    rounded_residual = np.sqrt(np.mean((rounded @ WEIGHTS - spectra) ** 2, axis=1))
+    assert np.all(refined <= rounded_residual + 1e-9)
@@ -0,0 +1,521 @@
+import json
+import asyncio
+from time import time, sleep
+from queue import Queue
+
+import pytest
+import paho.mqtt.client as mqtt_client
+from communication import (
+    hivemq_communication,
+    MQTTSession,
+    RequestMultiplexer,
+    AsyncOrchestratorClient,
+    run_batch,
+)
+from color_experiment import SimulatedMicrocontroller, run_color_experiment
+from conftest import local_username, local_password
+
+command_topic = "test-course/neopixel"
+sensor_data_topic = "test-course/as7341"
+
+
+def connect_session(broker):
+    return MQTTSession(
+        broker.host, local_username, local_password, port=broker.port, tls=False
+    ).connect()
+
+
+@pytest.fixture
+def session(local_broker):
+    session = connect_session(local_broker)
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def microcontroller(local_broker):
+    session = connect_session(local_broker)
+    with SimulatedMicrocontroller(
+        session, command_topic, sensor_data_topic
+    ) as microcontroller:
+        yield microcontroller
+    session.close()
+
+
+def payload_dicts(n):
+    return [
+        {"command": {"R": i % 256, "G": 0, "B": 255}, "experiment_id": f"{i:08x}"}
+        for i in range(n)
+    ]
+
+
+def test_session_reused_across_calls(session):
+    for i in range(20):
+        message = json.dumps(f"message {i}")
+        assert hivemq_communication(message, "/test/topic", "/test/topic", session=session) == f"message {i}"  # noqa: E501
+
+
+def test_session_publish_timings_are_bounded(session):
+    from communication._session import MAX_TIMED_PUBLISHES
+
+    for qos in (0, 1, 2):
+        session.publish("/test/timings", b"", qos=qos).wait_for_publish(5)
+    # acks nobody published (e.g. resent from before a reconnect)
+    for mid in range(2 * MAX_TIMED_PUBLISHES):
+        session._on_publish(session.client, None, 60000 + mid)
+    assert not session._publish_times
+    assert len(session._early_acks) == MAX_TIMED_PUBLISHES
+    session._on_disconnect(session.client, None, 1)
+    assert not session._early_acks
+
+
+def test_multiplexer_many_in_flight(session, microcontroller):
+    multiplexer = RequestMultiplexer(session, sensor_data_topic, command_topic)
+    requests = payload_dicts(200)
+    futures = [multiplexer.submit(payload_dict) for payload_dict in requests]
+    for payload_dict, future in zip(requests, futures):
+        result = multiplexer.result(payload_dict, future, timeout=10)
+        cmd = payload_dict["command"]
+        assert result["experiment_id"] == payload_dict["experiment_id"]
+        assert result["sensor_data"] == run_color_experiment(cmd["R"], cmd["G"], cmd["B"])  # noqa: E501
+    assert multiplexer.in_flight == 0
+
+
+def test_multiplexer_counts_stray_replies(session, local_broker):
+    responder = connect_session(local_broker)
+
+    def reply_with_noise(message):
+        responder.publish(sensor_data_topic, message.payload)
+        responder.publish(sensor_data_topic, message.payload)
+        responder.publish(sensor_data_topic, b"not json")
+        responder.publish(sensor_data_topic, json.dumps({"experiment_id": "unknown"}))
+
+    responder.subscribe(command_topic, reply_with_noise)
+    try:
+        multiplexer = RequestMultiplexer(session, sensor_data_topic, command_topic)
+        assert multiplexer.request({"experiment_id": "a"}, timeout=5) == {"experiment_id": "a"}  # noqa: E501
+        with pytest.raises(TimeoutError):
+            multiplexer.request({"experiment_id": "b"}, timeout=0)
+
+        expected = {"duplicates": 1, "late": 2, "invalid": 2, "unmatched": 2}
+        deadline = time() + 5
+        while time() < deadline:
+            if all(multiplexer.stats[k] == v for k, v in expected.items()):
+                break
+            sleep(0.01)
+        assert {k: multiplexer.stats[k] for k in expected} == expected
+        assert multiplexer.stats["timeouts"] == 1
+    finally:
+        responder.close()
+
+
+def test_run_batch_returns_results_in_order(local_broker, microcontroller):
+    queue = Queue()
+    client = mqtt_client.Client()
+    client.username_pw_set(local_username, local_password)
+    client.on_message = lambda client, userdata, msg: queue.put(json.loads(msg.payload))
+    client.connect(local_broker.host, local_broker.port)
+    client.subscribe(sensor_data_topic, qos=2)
+    requests = payload_dicts(100)
+    results = run_batch(client, queue, command_topic, requests, window=8)
+    # run_batch started the network loop, so it stopped it again
+    assert client.loop_start() != mqtt_client.MQTT_ERR_INVAL
+    client.disconnect()
+    client.loop_stop()
+    assert [r["experiment_id"] for r in results] == [p["experiment_id"] for p in requests]  # noqa: E501
+
+
+def test_run_batch_fails_unsent_commands_straight_away():
+    client = mqtt_client.Client()  # never connected, so nothing can be sent
+    start = time()
+    results = run_batch(client, Queue(), command_topic, payload_dicts(3), queue_timeout=10)  # noqa: E501
+    assert results == [None, None, None]
+    assert time() - start < 5
+
+
+def test_async_client(local_broker, microcontroller):
+    async def main():
+        async with AsyncOrchestratorClient(
+            sensor_data_topic,
+            local_broker.host,
+            local_username,
+            local_password,
+            port=local_broker.port,
+            tls=False,
+        ) as client:
+            requests = payload_dicts(100)
+            results = await asyncio.gather(
+                *(client.send_and_receive(command_topic, p, timeout=10) for p in requests)
+            )
+            assert [r["experiment_id"] for r in results] == [p["experiment_id"] for p in requests]  # noqa: E501
+
+            task = asyncio.create_task(
+                client.send_and_receive("/nobody/listens", {"experiment_id": "x"})
+            )
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert not client._pending
+
+            # acks (including the subscription's on connecting) are only
+            # held while awaited, so no stale mid can complete a later publish
+            for qos in (0, 1, 2):
+                await asyncio.wait_for(client.publish("/nobody/listens", b"", qos=qos), 5)  # noqa: E501
+            assert not client._acks and client._early_acks is None
+
+            # the timeout also holds if the command is never acknowledged,
+            # e.g. because the connection dropped right after publishing
+            async def never_acked(mid, early_acks):
+                await asyncio.Event().wait()
+
+            client._wait_for_ack = never_acked
+            with pytest.raises(TimeoutError):
+                await client.send_and_receive(command_topic, requests[0], timeout=0.2)  # noqa: E501
+            with pytest.raises(TimeoutError):
+                await client.send_and_receive_batch(command_topic, requests[:2], timeout=0.2)  # noqa: E501
+            assert not client._pending
+
+    asyncio.run(main())
+
+
+def test_binary_payload_matches_json():
+    from communication import encode_payload, decode_payload
+
+    cmd = {"R": 48, "G": 213, "B": 200}
+    results_dict = {
+        "command": cmd,
+        "experiment_id": "0a1b2c3d",
+        "sensor_data": run_color_experiment(cmd["R"], cmd["G"], cmd["B"]),
+    }
+    binary = encode_payload(results_dict, "binary")
+    assert len(binary) < len(encode_payload(results_dict)) / 4
+    decoded = decode_payload(binary)
+    assert decoded["command"] == cmd
+    assert decoded["experiment_id"] == results_dict["experiment_id"]
+    for ch, value in results_dict["sensor_data"].items():
+        assert abs(decoded["sensor_data"][ch] - value) <= 1e-6 * abs(value)
+    assert decode_payload(encode_payload(results_dict)) == results_dict
+
+
+@pytest.mark.parametrize(
+    "command, experiment_id",
+    [
+        ({"R": 48.0, "G": 213, "B": 200}, "0a1b2c3d"),
+        ({"R": 48, "G": 256, "B": 200}, "0a1b2c3d"),
+        ({"R": 48, "G": 213, "B": -1}, "0a1b2c3d"),
+        ({"R": 48, "G": 213, "B": 200}, "x" * 256),
+    ],
+)
+def test_binary_payload_rejects_what_does_not_fit(command, experiment_id):
+    from communication import encode_payload
+
+    results_dict = {
+        "command": command,
+        "experiment_id": experiment_id,
+        "sensor_data": run_color_experiment(48, 213, 200),
+    }
+    with pytest.raises(ValueError):
+        encode_payload(results_dict, "binary")
+    # JSON has no such limits
+    assert encode_payload(results_dict)
+
+
+def test_multiplexer_binary_replies(session, microcontroller):
+    multiplexer = RequestMultiplexer(session, sensor_data_topic, command_topic)
+    payload_dict = {**payload_dicts(1)[0], "encoding": "binary"}
+    result = multiplexer.request(payload_dict, timeout=10)
+    assert result["experiment_id"] == payload_dict["experiment_id"]
+    assert result["command"] == payload_dict["command"]
+
+
+@pytest.mark.parametrize("encoding", ["json", "binary"])
+def test_batched_round_trip(local_broker, microcontroller, encoding):
+    from communication import decode_results
+
+    queue = Queue()
+    client = mqtt_client.Client()
+    client.username_pw_set(local_username, local_password)
+
+    def on_message(client, userdata, msg):
+        for results_dict in decode_results(msg.payload):
+            queue.put(results_dict)
+
+    client.on_message = on_message
+    client.connect(local_broker.host, local_broker.port)
+    client.subscribe(sensor_data_topic, qos=2)
+    requests = [{**p, "encoding": encoding} for p in payload_dicts(100)]
+    results = run_batch(client, queue, command_topic, requests, window=32, batch_size=10)  # noqa: E501
+    client.disconnect()
+    assert [r["experiment_id"] for r in results] == [p["experiment_id"] for p in requests]  # noqa: E501
+    assert len(microcontroller.received) == 100
+
+
+def test_multiplexer_batch(session, microcontroller):
+    multiplexer = RequestMultiplexer(session, sensor_data_topic, command_topic)
+    requests = payload_dicts(50)
+    futures = multiplexer.submit_batch(requests)
+    results = [multiplexer.result(p, f, timeout=10) for p, f in zip(requests, futures)]
+    assert [r["experiment_id"] for r in results] == [p["experiment_id"] for p in requests]  # noqa: E501
+    assert multiplexer.stats["replies"] == 50
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_simulated_microcontroller_runs_experiments_concurrently(local_broker, session, backend):  # noqa: E501
+    device_session = connect_session(local_broker)
+    topics = (f"{backend}-course/neopixel", f"{backend}-course/as7341")
+    multiplexer = RequestMultiplexer(session, topics[1], topics[0])
+    warm_up, *requests = payload_dicts(17)
+    delay = 0.2  # 3.2 s one experiment at a time
+    with SimulatedMicrocontroller(device_session, *topics, delay=delay, jitter=0.02, backend=backend, max_workers=8, max_pending=4, seed=0) as microcontroller:  # noqa: E501
+        # worker processes are started on the first command
+        multiplexer.result(warm_up, multiplexer.submit(warm_up), timeout=10)
+        start = time()
+        futures = [multiplexer.submit(p) for p in requests]
+        results = [multiplexer.result(p, f, timeout=10) for p, f in zip(requests, futures)]  # noqa: E501
+        elapsed = time() - start
+    device_session.close()
+    assert [r["experiment_id"] for r in results] == [p["experiment_id"] for p in requests]  # noqa: E501
+    assert results[2]["sensor_data"] == run_color_experiment(3, 0, 255)
+    assert elapsed < len(requests) * delay / 2
+    assert microcontroller.pool.completed == 17
+    assert microcontroller.pool.peak_pending == 4
+
+
+def test_dedup_cache_size_and_ttl():
+    from communication import DedupCache
+
+    now = [0.0]
+    seen = DedupCache(maxsize=3, ttl=10, clock=lambda: now[0])
+    assert [seen.add(key) for key in "abca"] == [True, True, True, False]
+    assert seen.duplicates == 1
+    seen.add("d")  # pushes out "a"
+    assert "a" not in seen and len(seen) == 3
+    now[0] = 11
+    assert len(seen) == 0
+    assert seen.add("b")
+
+
+def test_qos1_duplicate_commands_run_once(session, microcontroller):
+    multiplexer = RequestMultiplexer(session, sensor_data_topic, command_topic, qos=1)
+    payload_dict = payload_dicts(1)[0]
+    future = multiplexer.submit(payload_dict)
+    # a redelivered command must not be run (or answered) again
+    session.publish(command_topic, json.dumps(payload_dict), qos=1)
+    assert multiplexer.result(payload_dict, future, timeout=10)["experiment_id"] == payload_dict["experiment_id"]  # noqa: E501
+    sleep(0.2)
+    assert len(microcontroller.received) == 1
+    assert microcontroller.duplicates == 1
+    assert hivemq_communication(
+        json.dumps(payload_dicts(2)[1]), sensor_data_topic, command_topic, session=session, qos=1  # noqa: E501
+    )["experiment_id"] == payload_dicts(2)[1]["experiment_id"]
+
+
+def test_result_cache(tmp_path, local_broker, session, microcontroller):
+    from communication import ResultCache
+
+    now = [0.0]
+    path = str(tmp_path / "cache.jsonl")
+    cache = ResultCache(maxsize=2, ttl=60, path=path, clock=lambda: now[0])
+    requests = payload_dicts(3)
+    first = hivemq_communication(json.dumps(requests[0]), sensor_data_topic, command_topic, session=session, cache=cache)  # noqa: E501
+    # same command, new experiment id: answered without the device
+    repeat = {**requests[0], "experiment_id": "repeat"}
+    cached = hivemq_communication(json.dumps(repeat), sensor_data_topic, command_topic, session=session, cache=cache)  # noqa: E501
+    assert cached == {**repeat, "sensor_data": first["sensor_data"]}
+    assert len(microcontroller.received) == 1
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 1
+
+    queue = Queue()
+    client = mqtt_client.Client()
+    client.username_pw_set(local_username, local_password)
+    client.on_message = lambda client, userdata, msg: queue.put(json.loads(msg.payload))
+    client.connect(local_broker.host, local_broker.port)
+    client.subscribe(sensor_data_topic, qos=2)
+    results = run_batch(client, queue, command_topic, [{**repeat, "experiment_id": "r2"}] + requests[1:], cache=cache)  # noqa: E501
+    client.disconnect()
+    assert [r["experiment_id"] for r in results] == ["r2"] + [p["experiment_id"] for p in requests[1:]]  # noqa: E501
+    assert len(microcontroller.received) == 3
+    assert cache.stats["evictions"] == 1  # maxsize=2
+    cache.close()
+
+    # reloaded from disk, and expired once the TTL has passed
+    reloaded = ResultCache(maxsize=2, ttl=60, path=path, clock=lambda: now[0])
+    assert len(reloaded) == 2
+    assert reloaded.lookup(requests[2])["sensor_data"] == results[2]["sensor_data"]
+    now[0] = 61
+    assert reloaded.lookup(requests[2]) is None
+    reloaded.close()
+
+
+def test_result_cache_hands_out_copies():
+    from communication import ResultCache
+
+    cache = ResultCache()
+    results_dict = {**payload_dicts(1)[0], "sensor_data": {"ch410": 1.0}}
+    cache.store(results_dict)
+    results_dict["sensor_data"]["ch410"] = 2.0
+    reply = cache.lookup(payload_dicts(1)[0])
+    assert reply["sensor_data"] == {"ch410": 1.0}
+    reply["sensor_data"]["ch410"] = 3.0
+    assert cache.lookup(payload_dicts(1)[0])["sensor_data"] == {"ch410": 1.0}
+
+
+def test_fleet_scheduler_shares_work_and_retries(local_broker, session):
+    from communication import FleetScheduler, device_topics, status_topic
+
+    course_id = "fleet-course"
+    fleet = FleetScheduler(session, course_id, window=2, timeout=0.5, max_failures=1, cooldown=60)  # noqa: E501
+    sessions = [connect_session(local_broker) for _ in range(3)]
+    devices = [
+        SimulatedMicrocontroller(s, *device_topics(course_id, device_id), status_topic=status_topic(course_id, device_id), delay=delay)  # noqa: E501
+        for s, device_id, delay in zip(sessions, ["fast", "slow", "spare"], [0, 0.05, 0])  # noqa: E501
+    ]
+    try:
+        for device in devices:
+            device.start()
+        # a registered board that never answers
+        fleet.register("dead")
+        deadline = time() + 5
+        while len(fleet.devices) < 4 and time() < deadline:
+            sleep(0.01)
+        assert set(fleet.devices) == {"fast", "slow", "spare", "dead"}
+
+        requests = payload_dicts(60)
+        results = fleet.run(requests)
+        assert [r["experiment_id"] for r in results] == [p["experiment_id"] for p in requests]  # noqa: E501
+        assert fleet.devices["dead"].timeouts >= 1
+        assert fleet.devices["dead"].completed == 0
+        # the fast boards steal work from the slow one and the dead one
+        assert fleet.devices["fast"].completed > fleet.devices["slow"].completed
+        assert sum(d.completed for d in fleet.devices.values()) == 60
+    finally:
+        for device, s in zip(devices, sessions):
+            device.stop()
+            s.close()
+        fleet.close()
+
+
+def test_fleet_scheduler_gives_up_when_no_device_is_online(local_broker, session):
+    from communication import FleetScheduler
+
+    fleet = FleetScheduler(session, "offline-course", timeout=0.5)
+    try:
+        fleet.register("gone")
+        fleet.devices["gone"].online = False  # as if it announced "offline"
+        start = time()
+        assert fleet.run(payload_dicts(3)) == [None] * 3
+        assert time() - start < 5
+    finally:
+        fleet.close()
+
+
+def test_resilient_client_rides_out_a_broker_drop(local_broker):
+    from communication import ResilientClient, iter_batch, decode_results
+    from metrics import get_registry
+
+    # both ends keep persistent sessions, so nothing sent during the drop is lost
+    device_session = MQTTSession(
+        local_broker.host, local_username, local_password, port=local_broker.port, tls=False, client_id="resilient-device"  # noqa: E501
+    ).connect()
+    device_session.client.reconnect_delay_set(0.05, 0.2)
+    queue = Queue()
+    client = ResilientClient("resilient-orchestrator", min_delay=0.05, max_delay=0.2)
+    client.username_pw_set(local_username, local_password)
+    client.on_message = lambda client, userdata, msg: [queue.put(r) for r in decode_results(msg.payload)]  # noqa: E501
+    client.subscribe(sensor_data_topic, qos=1)
+    client.connect_async(local_broker.host, local_broker.port)
+    client.loop_start()
+    assert client.connected_event.wait(5)
+    disconnects = get_registry().counter("mqtt_disconnects_total").value
+
+    def drop_midway(requests):
+        for i, payload_dict in enumerate(requests):
+            if i == 20:
+                local_broker.disconnect_all()
+            yield payload_dict
+
+    requests = payload_dicts(40)
+    with SimulatedMicrocontroller(device_session, command_topic, sensor_data_topic, qos=1, delay=0.005):  # noqa: E501
+        results = dict(iter_batch(client, queue, command_topic, drop_midway(requests), window=8, queue_timeout=10, qos=1))  # noqa: E501
+        assert [results[i]["experiment_id"] for i in range(40)] == [p["experiment_id"] for p in requests]  # noqa: E501
+        assert get_registry().counter("mqtt_disconnects_total").value > disconnects
+
+        # held back while offline, and sent in order once reconnected
+        client.backoff.initial = client.backoff.maximum = 1.0
+        local_broker.disconnect_all()
+        deadline = time() + 5
+        while client.online and time() < deadline:
+            sleep(0.001)
+        infos = [client.publish("resilient/buffered", str(i), qos=1) for i in range(3)]
+        assert get_registry().gauge("mqtt_offline_buffer").value == 3
+        for info in infos:
+            info.wait_for_publish(5)
+            assert info.is_published()
+    client.disconnect()
+    client.loop_stop()
+    device_session.close()
+
+
+def test_record_and_replay(tmp_path, local_broker, microcontroller):
+    from communication import (
+        TransportRecorder,
+        Replayer,
+        ReplayError,
+        ReplaySession,
+        ReplayClient,
+        ResilientClient,
+        iter_batch,
+        decode_results,
+        read_log,
+    )
+
+    def run(session, client, prefix="batch"):
+        replies = [
+            hivemq_communication(json.dumps(p), sensor_data_topic, command_topic, session=session)  # noqa: E501
+            for p in payload_dicts(5)
+        ]
+        queue = Queue()
+        client.on_message = lambda client, userdata, msg: [queue.put(r) for r in decode_results(msg.payload)]  # noqa: E501
+        client.subscribe(sensor_data_topic, qos=1)
+        client.connect_async(local_broker.host, local_broker.port)
+        client.loop_start()
+        assert client.connected_event.wait(5)
+        requests = [dict(p, experiment_id=f"{prefix}-{i:02d}") for i, p in enumerate(payload_dicts(20))]  # noqa: E501
+        results = dict(iter_batch(client, queue, command_topic, requests, window=4, qos=1))  # noqa: E501
+        client.loop_stop()
+        return replies + [results[i] for i in range(20)]
+
+    path = str(tmp_path / "run.mqttlog")
+    recorder = TransportRecorder(path)
+    session = MQTTSession(local_broker.host, local_username, local_password, port=local_broker.port, tls=False, recorder=recorder).connect()  # noqa: E501
+    client = ResilientClient(recorder=recorder)
+    client.username_pw_set(local_username, local_password)
+    recorded = run(session, client)
+    session.close()
+    client.disconnect()
+    recorder.close()
+    entries = read_log(path)
+    assert len(entries) == recorder.records
+    # 25 commands and their replies (the session sees the client's replies too)
+    assert [e.direction for e in entries].count("publish") == 25
+    assert [(e.stream, e.direction) for e in entries].count((0, "receive")) >= 5
+    assert [(e.stream, e.direction) for e in entries].count((1, "receive")) == 20
+
+    # no broker involved: the replies come from the log, in the same order
+    replayer = Replayer.from_file(path)
+    replayed = run(ReplaySession(replayer).connect(), ReplayClient(replayer))
+    assert replayed == recorded
+    assert replayer.wait(5) and replayer.done
+    assert replayer.stats["matched"] == 25 and not replayer.mismatches
+
+    # commands with other (equally long) ids still match, and get their replies
+    replayer = Replayer(entries)
+    replayed = run(ReplaySession(replayer).connect(), ReplayClient(replayer), "again")
+    assert [r["experiment_id"] for r in replayed[5:]] == [f"again-{i:02d}" for i in range(20)]  # noqa: E501
+    assert [r["sensor_data"] for r in replayed] == [r["sensor_data"] for r in recorded]
+    assert replayer.stats["rewritten"] == 20 and not replayer.mismatches
+
+    strict = Replayer(entries, strict=True)
+    with pytest.raises(ReplayError):
+        ReplaySession(strict).connect().publish(command_topic, "something else")
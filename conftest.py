@@ -0,0 +1,73 @@
+import os
+import pytest
+from mqtt_broker import MQTTBroker
+from communication import MQTTSession, close_sessions
+from color_experiment import SimulatedMicrocontroller
+
+local_username = "local-user"
+local_password = "local-password"
+local_course_id = "local-course"
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--local-broker",
+        action="store_true",
+        help="Run against an in-process MQTT broker instead of HiveMQ Cloud, "
+        "with a simulated microcontroller, so that no network access or "
+        "secrets are needed.",
+    )
+
+
+@pytest.fixture(scope="session")
+def local_broker():
+    """In-process MQTT broker on a free localhost port."""
+    with MQTTBroker(username=local_username, password=local_password) as broker:
+        yield broker
+        close_sessions()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def hivemq_env(request):
+    """With --local-broker, point HIVEMQ_* and COURSE_ID at the local broker.
+
+    The environment is inherited by subprocesses, so orchestrator_client.py
+    connects to the local broker as well.
+    """
+    if not request.config.getoption("--local-broker"):
+        yield None
+        return
+    broker = request.getfixturevalue("local_broker")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("HIVEMQ_HOST", broker.host)
+        mp.setenv("HIVEMQ_PORT", str(broker.port))
+        mp.setenv("HIVEMQ_TLS", "0")
+        mp.setenv("HIVEMQ_USERNAME", local_username)
+        mp.setenv("HIVEMQ_PASSWORD", local_password)
+        mp.setenv("COURSE_ID", local_course_id)
+        # No real microcontroller can be racing the simulated one
+        mp.setenv("SIMULATED_RESPONSE_DELAY", "0")
+        yield broker
+
+
+@pytest.fixture
+def simulated_microcontroller(request, hivemq_env):
+    """With --local-broker, answer commands in place of the Pico W."""
+    if hivemq_env is None:
+        yield None
+        return
+    session = MQTTSession(
+        hivemq_env.host,
+        local_username,
+        local_password,
+        port=hivemq_env.port,
+        tls=False,
+    ).connect()
+    course_id = os.environ["COURSE_ID"]
+    try:
+        with SimulatedMicrocontroller(
+            session, f"{course_id}/neopixel", f"{course_id}/as7341"
+        ) as microcontroller:
+            yield microcontroller
+    finally:
+        session.close()
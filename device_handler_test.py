@@ -0,0 +1,94 @@
+import json
+import asyncio
+from benchmarks.bench_device_handler import FakeClient, ReferenceHandler, import_handler
+
+handler = import_handler()
+
+
+def command(experiment_id, priority=0, **rgb):
+    payload_dict = {
+        "command": {"R": 10, "G": 20, "B": 30, **rgb},
+        "experiment_id": experiment_id,
+    }
+    if priority:
+        payload_dict["priority"] = priority
+    return json.dumps(payload_dict).encode()
+
+
+async def run_handler(reference, client, msgs):
+    # receive every message before the worker starts, then let the worker and
+    # publisher drain both queues
+    for msg in msgs:
+        await client.incoming.put((reference.command_topic, msg, False))
+    await client.incoming.put(None)
+    await reference.messages(client)
+    received = list(reference.work_queue.items)
+    tasks = [
+        asyncio.create_task(reference.worker()),
+        asyncio.create_task(reference.publisher(client)),
+    ]
+    for _ in range(100):
+        await asyncio.sleep(0)
+    for task in tasks:
+        task.cancel()
+    assert not len(reference.work_queue) and not len(reference.outbox)
+    return [[p["experiment_id"] for p in item[0]] for _, item in received]
+
+
+def test_bounded_queue_orders_by_priority_and_drops_the_lowest():
+    async def main():
+        queue = handler.BoundedQueue(3)
+        assert queue.put_nowait("a") is None
+        assert queue.put_nowait("b", 1) is None
+        assert queue.put_nowait("c") is None
+        # full: a newcomer of no higher priority than the last is dropped
+        assert queue.put_nowait("d") == "d"
+        # a higher priority one replaces the newest of the lowest priority
+        assert queue.put_nowait("e", 2) == "c"
+        assert queue.max_depth == 3
+        return [await queue.get() for _ in range(len(queue))]
+
+    assert asyncio.run(main()) == ["e", "b", "a"]
+
+
+def test_reference_handler_skips_duplicates_and_forgets_dropped():
+    async def main():
+        reference = ReferenceHandler(handler, work_queue_len=2)
+        client = FakeClient(asyncio.Queue(), 0)
+        duplicates = handler.duplicates
+        msgs = [
+            command("dup-1"),
+            command("dup-2"),
+            command("dup-3", priority=1),  # the queue is full, so drops dup-2
+            command("dup-1"),
+        ]
+        assert await run_handler(reference, client, msgs) == [["dup-3"], ["dup-1"]]
+        assert handler.duplicates == duplicates + 1
+        assert reference.counters["commands"] == 3
+        assert reference.counters["dropped"] == 1
+        assert client.published == 2
+        # dropped before it ran, so it is run when delivered again
+        assert "dup-2" not in handler.seen_ids
+        assert await run_handler(reference, client, [command("dup-2")]) == [["dup-2"]]
+        assert client.published == 3
+
+    asyncio.run(main())
+
+
+class FailingClient(FakeClient):
+    async def publish(self, topic, payload, qos=0):
+        raise OSError("connection lost")
+
+
+def test_reference_handler_forgets_failed_commands():
+    async def main():
+        reference = ReferenceHandler(handler)
+        client = FailingClient(asyncio.Queue(), 0)
+        msgs = [command("fail-publish"), command("fail-run", B="blue")]
+        await run_handler(reference, client, msgs)
+        assert reference.counters["errors"] == 2
+        # neither was answered, so a redelivery is run rather than skipped
+        assert "fail-publish" not in handler.seen_ids
+        assert "fail-run" not in handler.seen_ids
+
+    asyncio.run(main())
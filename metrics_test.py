@@ -0,0 +1,68 @@
+import json
+import random
+
+from metrics import Histogram, MetricsRegistry, get_registry, to_prometheus, write_metrics
+from communication import RequestMultiplexer, MQTTSession, tls_context
+from color_experiment import SimulatedMicrocontroller
+from conftest import local_username, local_password
+
+
+def test_histogram_percentiles_within_precision():
+    values = [random.lognormvariate(-5, 1) for _ in range(20000)]
+    histogram = Histogram("latency_seconds")
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for q in (50, 90, 99, 99.9):
+        exact = values[int(q / 100 * len(values)) - 1]
+        assert abs(histogram.percentile(q) - exact) <= 0.01 * exact
+    assert histogram.count == len(values)
+    assert histogram.max == values[-1]
+
+
+def test_exporters(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter("timeouts_total", "Timeouts").inc(3)
+    registry.gauge("in_flight").set(5)
+    registry.histogram("reply_seconds").record(0.01)
+    registry.trace("reply_seconds", "abc", 0.01)
+
+    prometheus = to_prometheus(registry)
+    assert "# TYPE timeouts_total counter\ntimeouts_total 3\n" in prometheus
+    assert 'reply_seconds{quantile="0.99"}' in prometheus
+    assert "reply_seconds_count 1" in prometheus
+
+    write_metrics(str(tmp_path / "metrics.json"), registry=registry)
+    snapshot = json.loads((tmp_path / "metrics.json").read_text())
+    assert snapshot["in_flight"] == {"type": "gauge", "value": 5, "max": 5}
+    assert snapshot["traces"]["reply_seconds"] == [["abc", 0.01]]
+    write_metrics(str(tmp_path / "metrics.prom"), registry=registry)
+    assert (tmp_path / "metrics.prom").read_text() == prometheus
+
+
+def test_round_trip_is_instrumented(local_broker):
+    registry = get_registry()
+    registry.clear()
+    sessions = [
+        MQTTSession(local_broker.host, local_username, local_password, port=local_broker.port, tls=False).connect()  # noqa: E501
+        for _ in range(2)
+    ]
+    with SimulatedMicrocontroller(sessions[1], "metrics/neopixel", "metrics/as7341"):
+        multiplexer = RequestMultiplexer(sessions[0], "metrics/as7341", "metrics/neopixel")  # noqa: E501
+        for i in range(10):
+            multiplexer.request({"command": {"R": i, "G": 0, "B": 0}, "experiment_id": f"m{i}"}, timeout=10)  # noqa: E501
+    for session in sessions:
+        session.close()
+
+    metrics = registry.metrics()
+    assert metrics["mqtt_connect_seconds"].count == 2
+    assert metrics["mqtt_reply_seconds"].count == 10
+    assert metrics["mqtt_publish_ack_seconds"].count >= 10
+    assert metrics["mqtt_in_flight"].value == 0
+    assert [key for key, _ in registry.traces("mqtt_reply_seconds")] == [f"m{i}" for i in range(10)]  # noqa: E501
+
+
+def test_tls_context_times_handshakes():
+    context = tls_context()
+    assert context.sslsocket_class.__name__ == "_TimedSSLSocket"
+    assert context.verify_mode.name == "CERT_REQUIRED" and context.check_hostname
@@ -14,11 +14,27 @@ import ntptime
 from time import time, sleep
 import sys
 
-try;
+try:
+    import ustruct as struct
+except:
+    import struct
+
+try:
     from uio import StringIO
 except:
     from io import StringIO
 
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:  # CPython
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(end, start):
+        return end - start
+
 # NOTE: This differs from the usual CLSLab:Light instructions, in that the file
 # is now named `my_secrets.py` instead of `secrets.py`. Calling it secrets.py in
 # a MicroPython context is fine, but since we're doing autograding in Python,
@@ -33,52 +49,73 @@ from my_secrets import (
     SSID,
 )
 
-connectWiFi(SSID, PASSWORD, country="US")
-
-# To validate certificates, a valid time is required
-ntptime.timeout = 15  # type: ignore
-ntptime.host = "time.google.com"
+# Optional: give each board of a fleet its own DEVICE_ID in my_secrets.py, so
+# that communication.FleetScheduler can find it and share work between boards
 try:
-    ntptime.settime()
-except Exception as e:
-    print(f"{e} with {ntptime.host}. Trying again after 10 seconds")
-    sleep(10)
+    from my_secrets import DEVICE_ID
+except ImportError:
+    DEVICE_ID = None
+
+
+# Connect to WiFi, set the clock and configure MQTT (run by __main__ below, so
+# that the message handling can be imported, e.g. by the benchmarks)
+def setup():
+    connectWiFi(SSID, PASSWORD, country="US")
+
+    # To validate certificates, a valid time is required
+    ntptime.timeout = 15  # type: ignore
+    ntptime.host = "time.google.com"
     try:
         ntptime.settime()
     except Exception as e:
-        print(f"{e} with {ntptime.host}. Trying again with pool.ntp.org")
+        print(f"{e} with {ntptime.host}. Trying again after 10 seconds")
         sleep(10)
-        ntptime.host = "pool.ntp.org"
-        ntptime.settime()
+        try:
+            ntptime.settime()
+        except Exception as e:
+            print(f"{e} with {ntptime.host}. Trying again with pool.ntp.org")
+            sleep(10)
+            ntptime.host = "pool.ntp.org"
+            ntptime.settime()
+
+    print("Obtaining CA Certificate from file")
+    with open("hivemq-com-chain.der", "rb") as f:
+        cacert = f.read()
+    f.close()
+
+    # Local configuration
+    config.update(
+        {
+            "ssid": SSID,
+            "wifi_pw": PASSWORD,
+            "server": HIVEMQ_HOST,
+            "user": HIVEMQ_USERNAME,
+            "password": HIVEMQ_PASSWORD,
+            "ssl": True,
+            "ssl_params": {
+                "server_side": False,
+                "key": None,
+                "cert": None,
+                "cert_reqs": ussl.CERT_REQUIRED,
+                "cadata": cacert,
+                "server_hostname": HIVEMQ_HOST,
+            },
+            "keepalive": 30,
+        }
+    )
 
-print("Obtaining CA Certificate from file")
-with open("hivemq-com-chain.der", "rb") as f:
-    cacert = f.read()
-f.close()
-
-# Local configuration
-config.update(
-    {
-        "ssid": SSID,
-        "wifi_pw": PASSWORD,
-        "server": HIVEMQ_HOST,
-        "user": HIVEMQ_USERNAME,
-        "password": HIVEMQ_PASSWORD,
-        "ssl": True,
-        "ssl_params": {
-            "server_side": False,
-            "key": None,
-            "cert": None,
-            "cert_reqs": ussl.CERT_REQUIRED,
-            "cadata": cacert,
-            "server_hostname": HIVEMQ_HOST,
-        },
-        "keepalive": 30,
-    }
-)
 
+# Channel names and their R, G, B weights, computed once (the same weights are
+# in color_experiment.WEIGHTS)
+CHANNELS = ("ch410", "ch440", "ch470", "ch510", "ch550", "ch583", "ch620", "ch670")
+R_WEIGHTS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.9, 1.0)
+G_WEIGHTS = (0.2, 0.4, 0.6, 0.8, 1.0, 0.8, 0.4, 0.2)
+B_WEIGHTS = (0.9, 1.0, 0.8, 0.6, 0.4, 0.2, 0.1, 0.0)
+N_CHANNELS = len(CHANNELS)
 
-# Dummy function for running a color experiment
+
+# Dummy function for running a color experiment (kept free of numpy so that it
+# runs on MicroPython)
 def run_color_experiment(R, G, B):
     """
     Run a color experiment with the specified RGB values.
@@ -102,20 +139,241 @@ def run_color_experiment(R, G, B):
     >>> run_color_experiment(255, 0, 0)
     {'ch410': 25.5, 'ch440': 51.0, 'ch470': 76.5, 'ch510': 102.0, 'ch550': 127.5, 'ch583': 153.0, 'ch620': 229.5, 'ch670': 255.0} # noqa: E501
     """
-    wavelengths = [410, 440, 470, 510, 550, 583, 620, 670]
-    rw = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.9, 1.0]
-    gw = [0.2, 0.4, 0.6, 0.8, 1.0, 0.8, 0.4, 0.2]
-    bw = [0.9, 1.0, 0.8, 0.6, 0.4, 0.2, 0.1, 0.0]
-    sensor_data = {
-        f"ch{wavelength}": rw[i] * R + gw[i] * G + bw[i] * B
-        for i, wavelength in enumerate(wavelengths)
-    }
+    sensor_data = {}
+    for i in range(N_CHANNELS):
+        sensor_data[CHANNELS[i]] = (
+            R_WEIGHTS[i] * R + G_WEIGHTS[i] * G + B_WEIGHTS[i] * B
+        )
     return sensor_data
 
 
 # MQTT Topics
-command_topic = f"{COURSE_ID}/neopixel"
-sensor_data_topic = f"{COURSE_ID}/as7341"
+topic_prefix = COURSE_ID if DEVICE_ID is None else f"{COURSE_ID}/{DEVICE_ID}"
+command_topic = f"{topic_prefix}/neopixel"
+sensor_data_topic = f"{topic_prefix}/as7341"
+# retained "online"/"offline" announcement (the broker sends the will if the
+# board drops off without saying goodbye)
+status_topic = None if DEVICE_ID is None else f"{COURSE_ID}/devices/{DEVICE_ID}"
+if status_topic is not None:
+    config["will"] = (status_topic, "offline", True, 1)
+
+# Optional extensions of the protocol, only used if the orchestrator asks for
+# them: a command with "encoding": "binary" (SENSOR_DATA_ENCODING=binary in
+# orchestrator_client.py) is answered in this packed layout (see
+# communication._codec) instead of JSON:
+# version, message type, R, G, B, id length, 8 channels (float32), id
+#
+# and a batch of commands ({"batch": [...]}, from COMMANDS_PER_MESSAGE) with
+# one message: JSON {"batch": [...]} or the binary batch header (version,
+# message type, count) followed by one packed result per command
+WIRE_VERSION = 1
+RESULT_MESSAGE = 1
+BATCH_MESSAGE = 2
+RESULT_FORMAT = "<BBBBBB8f"
+BATCH_FORMAT = "<BBH"
+
+
+def encode_result(payload_dict, sensor_data):
+    experiment_id = payload_dict["experiment_id"].encode()
+    cmd = payload_dict["command"]
+    header = struct.pack(
+        RESULT_FORMAT,
+        WIRE_VERSION,
+        RESULT_MESSAGE,
+        cmd["R"],
+        cmd["G"],
+        cmd["B"],
+        len(experiment_id),
+        *[sensor_data[ch] for ch in CHANNELS],
+    )
+    return header + experiment_id
+
+
+RESULT_SIZE = struct.calcsize(RESULT_FORMAT)
+MAX_ID_LEN = 64  # longest experiment_id that fits a preallocated reply buffer
+
+
+def fill_sensor_values(R, G, B, values):
+    # run_color_experiment into a preallocated list, without building a dict
+    for i in range(N_CHANNELS):
+        values[i] = R_WEIGHTS[i] * R + G_WEIGHTS[i] * G + B_WEIGHTS[i] * B
+
+
+def encode_result_into(buf, payload_dict, values):
+    # encode_result into a preallocated buffer; returns the number of bytes
+    experiment_id = payload_dict["experiment_id"]
+    n = len(experiment_id)
+    cmd = payload_dict["command"]
+    # explicit arguments rather than *values, which would allocate a tuple
+    struct.pack_into(
+        RESULT_FORMAT,
+        buf,
+        0,
+        WIRE_VERSION,
+        RESULT_MESSAGE,
+        cmd["R"],
+        cmd["G"],
+        cmd["B"],
+        n,
+        values[0],
+        values[1],
+        values[2],
+        values[3],
+        values[4],
+        values[5],
+        values[6],
+        values[7],
+    )
+    for i in range(n):
+        buf[RESULT_SIZE + i] = ord(experiment_id[i])
+    return RESULT_SIZE + n
+
+
+# mqtt_as supports QoS 0 and 1. QoS 1 may deliver a command more than once, so
+# the ids of recently run experiments are remembered (at most DEDUP_SIZE of
+# them, for DEDUP_TTL seconds) and repeated commands are skipped
+QOS = 1
+DEDUP_SIZE = 64
+DEDUP_TTL = 600
+seen_ids = {}  # experiment id -> time first seen
+seen_order = []  # experiment ids, oldest first
+duplicates = 0
+
+
+def first_time(experiment_id):
+    global duplicates
+    now = time()
+    while seen_order and (
+        len(seen_order) >= DEDUP_SIZE or now - seen_ids[seen_order[0]] > DEDUP_TTL
+    ):
+        del seen_ids[seen_order.pop(0)]
+    if experiment_id in seen_ids:
+        duplicates += 1
+        return False
+    seen_ids[experiment_id] = now
+    seen_order.append(experiment_id)
+    return True
+
+
+def forget(experiment_id):
+    # a command dropped before it ran is run if it is delivered again
+    if seen_ids.pop(experiment_id, None) is not None:
+        seen_order.remove(experiment_id)
+
+
+class Histogram:
+    # Millisecond latencies in power-of-two buckets (HDR-style, but small
+    # enough for the Pico W): bucket i counts values below 2**i ms
+    def __init__(self, n_buckets=18):
+        self.buckets = [0] * n_buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ms):
+        i = 0
+        while (1 << i) <= ms and i < len(self.buckets) - 1:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, percent):
+        # upper bound of the bucket holding the given percentile
+        rank = max(1, (percent * self.count + 99) // 100)
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return 1 << i
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return "n=0"
+        return "n={} mean={}ms p50<{}ms p99<{}ms max={}ms".format(
+            self.count,
+            self.total // self.count,
+            self.percentile(50),
+            self.percentile(99),
+            self.max,
+        )
+
+
+# A bounded queue, e.g. to hand commands from the receiver to a separate task
+# that runs the experiments, so a slow experiment never holds up receiving
+class BoundedQueue:
+    # asyncio queue with a maximum length and priorities (MicroPython's
+    # asyncio has no Queue). Items are kept highest priority first, and in
+    # arrival order within a priority (commands may set e.g. "priority": 1;
+    # the default is 0)
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.items = []  # (priority, item)
+        self.max_depth = 0
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+    def __len__(self):
+        return len(self.items)
+
+    def _insert(self, item, priority):
+        i = len(self.items)
+        while i and self.items[i - 1][0] < priority:
+            i -= 1
+        self.items.insert(i, (priority, item))
+        self.max_depth = max(self.max_depth, len(self.items))
+        self.not_empty.set()
+        if len(self.items) >= self.maxlen:
+            self.not_full.clear()
+
+    def put_nowait(self, item, priority=0):
+        # Returns the item that had to be dropped to stay within maxlen (the
+        # new one, unless an older one has a lower priority), or None
+        if len(self.items) < self.maxlen:
+            self._insert(item, priority)
+            return None
+        if self.items[-1][0] >= priority:
+            return item
+        dropped = self.items.pop()[1]
+        self._insert(item, priority)
+        return dropped
+
+    async def put(self, item, priority=0):
+        # Waits while the queue is full
+        while len(self.items) >= self.maxlen:
+            await self.not_full.wait()
+        self._insert(item, priority)
+
+    async def get(self):
+        while not self.items:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        item = self.items.pop(0)[1]
+        if not self.items:
+            self.not_empty.clear()
+        self.not_full.set()
+        return item
+
+
+# latencies (e.g. the time to connect) and event counts, printed every few
+# seconds by main()
+histograms = {"connect": Histogram()}
+counters = {"messages": 0, "commands": 0, "dropped": 0, "errors": 0}
+
+
+def metrics_report(client):
+    lines = ["{}: {}".format(name, h.summary()) for name, h in histograms.items()]
+    lines.append(
+        ", ".join("{}={}".format(name, value) for name, value in counters.items())
+        + ", duplicates={}, queue discards={}".format(
+            duplicates, getattr(client.queue, "discards", "n/a")
+        )
+    )
+    return "\n".join(lines)
 
 
 async def messages(client):  # Respond to incoming messages
@@ -147,11 +405,15 @@ async def up(client):  # Respond to connectivity being (re)established
     while True:
         await client.up.wait()  # Wait on an Event
         client.up.clear()
-        await client.subscribe(command_topic, 1)  # renew subscriptions
+        await client.subscribe(command_topic, QOS)  # renew subscriptions
+        if status_topic is not None:
+            await client.publish(status_topic, "online", retain=True, qos=QOS)
 
 
 async def main(client):
+    t0 = ticks_ms()
     await client.connect()
+    histograms["connect"].record(ticks_diff(ticks_ms(), t0))
     for coroutine in (up, messages):
         asyncio.create_task(coroutine(client))
 
@@ -161,12 +423,20 @@ async def main(client):
         await asyncio.sleep(5)
         elapsed_time = round(time() - start_time)
         print(f"Elapsed: {elapsed_time}s")
+        print(metrics_report(client))
 
 
-config["queue_len"] = 5  # Use event interface with specified queue length
-MQTTClient.DEBUG = True  # Optional: print diagnostic messages
-client = MQTTClient(config)
-try:
-    asyncio.run(main(client))
-finally:
-    client.close()  # Prevent LmacRxBlk:1 errors
+# Run only as the board's main script (main.py), so that the message handling
+# can be imported without connecting
+if __name__ == "__main__":
+    setup()
+    config["queue_len"] = 5  # Use event interface with specified queue length
+    # Persistent session: the broker keeps the subscription and queues commands
+    # sent while the board is reconnecting, so none are lost to a WiFi blip
+    config["clean"] = False
+    MQTTClient.DEBUG = True  # Optional: print diagnostic messages
+    client = MQTTClient(config)
+    try:
+        asyncio.run(main(client))
+    finally:
+        client.close()  # Prevent LmacRxBlk:1 errors
@@ -5,6 +5,7 @@ import numpy as np
 import secrets
 from queue import Empty
 import warnings
+import pytest
 from orchestrator_client_test import flatten_dict
 
 username_key = "HIVEMQ_USERNAME"
@@ -13,6 +14,7 @@ host_key = "HIVEMQ_HOST"
 course_id_key = "COURSE_ID"
 
 
+@pytest.mark.usefixtures("simulated_microcontroller")
 def test_send_and_receive():
     """act as the orchestrator"""
 
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+from mqtt_as import MQTTClient, config
+from conftest import local_username, local_password
+
+
+def client(broker, client_id, **settings):
+    return MQTTClient(
+        {
+            **config,
+            "server": broker.host,
+            "port": broker.port,
+            "user": local_username,
+            "password": local_password,
+            "client_id": client_id,
+            "queue_len": 64,
+            "response_time": 2,
+            **settings,
+        }
+    )
+
+
+async def receive(client, n, timeout=5):
+    async def take():
+        return [message async for message in _first(client.queue, n)]
+
+    return await asyncio.wait_for(take(), timeout)
+
+
+async def _first(iterable, n):
+    async for item in iterable:
+        yield item
+        n -= 1
+        if not n:
+            return
+
+
+@pytest.mark.parametrize("qos", [0, 1])
+def test_publish_and_receive(local_broker, qos):
+    async def main():
+        device = client(local_broker, f"device-{qos}")
+        orchestrator = client(local_broker, f"orchestrator-{qos}", max_inflight=4)
+        await device.connect()
+        await orchestrator.connect()
+        assert device.up.is_set() and device.isconnected()
+        await device.subscribe(f"as/{qos}/#", qos)
+        payloads = [f"{i}".encode() for i in range(50)]
+        # bytearray and memoryview payloads, as the device's reusable buffers
+        payloads[1] = bytearray(b"buffer")
+        payloads[2] = memoryview(b"view")
+        await asyncio.gather(
+            *(orchestrator.publish(f"as/{qos}/cmd", p, qos=qos) for p in payloads)
+        )
+        messages = await receive(device, len(payloads))
+        assert messages == [(f"as/{qos}/cmd".encode(), bytes(p), False) for p in payloads]  # noqa: E501
+        assert orchestrator.REPUB_COUNT == 0
+        with pytest.raises(ValueError):
+            await orchestrator.publish("as/qos2", b"", qos=2)
+        await orchestrator.disconnect()
+        await device.disconnect()
+
+    asyncio.run(main())
+
+
+def test_queue_len_discards_oldest(local_broker):
+    async def main():
+        device = client(local_broker, "small-queue", queue_len=3)
+        await device.connect()
+        await device.subscribe("as/queue", 1)
+        for i in range(5):
+            await device.publish("as/queue", str(i), qos=1)
+        await asyncio.sleep(0.2)
+        assert device.queue.discards == 2
+        assert [msg for _, msg, _ in await receive(device, 3)] == [b"2", b"3", b"4"]
+        device.close()
+
+    asyncio.run(main())
+
+
+def test_keepalive_and_reconnect(local_broker):
+    async def main():
+        # dropped by the outage as well, but keeps its subscription
+        watcher = client(local_broker, "watcher", clean=False)
+        watcher.RECONNECT_DELAY = 0.05
+        await watcher.connect()
+        await watcher.subscribe("as/status/#", 1)
+        will = ("as/status/device", "offline", True, 1)
+        device = client(local_broker, "device-persistent", keepalive=1, clean=False, will=will)  # noqa: E501
+        device.RECONNECT_DELAY = 0.05
+        await device.connect()
+        await device.subscribe("as/persistent", 1)
+        await device.publish("as/status/device", "online", retain=True, qos=1)
+        device.up.clear()
+        # idle for longer than the broker's 1.5 x keepalive: pings keep it up
+        await asyncio.sleep(2)
+        assert device.isconnected() and not device.down.is_set()
+
+        # an outage: the will is published, the session and its QoS 1
+        # messages are kept, and the device reconnects by itself
+        local_broker.disconnect_all()
+        await asyncio.wait_for(device.down.wait(), 5)
+        await watcher.publish("as/persistent", "while away", qos=1)
+        await asyncio.wait_for(device.up.wait(), 5)
+        assert (await receive(device, 1))[0][1] == b"while away"
+        statuses = [msg for _, msg, _ in await receive(watcher, 2)]
+        assert statuses == [b"online", b"offline"]
+        # publishing after the outage is acknowledged on the new connection
+        await device.publish("as/status/device", "online", retain=True, qos=1)
+        assert (await receive(watcher, 1))[0][1] == b"online"
+        await device.disconnect()
+        watcher.close()
+
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+import socket
+import struct
+import logging
+import threading
+from queue import Queue
+
+import pytest
+import paho.mqtt.client as mqtt_client
+from mqtt_broker import MQTTBroker, topic_matches
+from conftest import local_username, local_password
+
+
+def connect(broker, password=local_password, client_id="", clean_session=True):
+    messages = Queue()
+    connected = threading.Event()
+    result = {}
+
+    def on_connect(client, userdata, flags, rc):
+        result["rc"] = rc
+        connected.set()
+
+    client = mqtt_client.Client(client_id=client_id, clean_session=clean_session)
+    client.username_pw_set(local_username, password)
+    client.on_connect = on_connect
+    client.on_message = lambda client, userdata, msg: messages.put(msg)
+    client.connect(broker.host, broker.port)
+    client.loop_start()
+    assert connected.wait(5)
+    return client, messages, result["rc"]
+
+
+@pytest.mark.parametrize(
+    "topic_filter, topic, expected",
+    [
+        ("course/neopixel", "course/neopixel", True),
+        ("course/+", "course/as7341", True),
+        ("course/+", "course/pico/as7341", False),
+        ("course/#", "course/pico/as7341", True),
+        ("+/as7341", "$SYS/as7341", False),
+    ],
+)
+def test_topic_matches(topic_filter, topic, expected):
+    assert topic_matches(topic_filter, topic) is expected
+
+
+@pytest.mark.parametrize("qos", [0, 1, 2])
+def test_publish_qos(local_broker, qos):
+    client, messages, _ = connect(local_broker)
+    client.subscribe("qos/#", qos=2)
+    client.publish("qos/test", b"hello", qos=qos).wait_for_publish(5)
+    message = messages.get(timeout=5)
+    assert (message.topic, message.payload, message.qos) == ("qos/test", b"hello", qos)
+    client.disconnect()
+    client.loop_stop()
+
+
+def test_retained_message(local_broker):
+    publisher, _, _ = connect(local_broker)
+    publisher.publish("retained/status", b"online", qos=1, retain=True).wait_for_publish(5)  # noqa: E501
+    subscriber, messages, _ = connect(local_broker)
+    subscriber.subscribe("retained/+", qos=1)
+    message = messages.get(timeout=5)
+    assert (message.payload, message.retain) == (b"online", True)
+
+    # An empty retained payload clears the retained message
+    publisher.publish("retained/status", b"", qos=1, retain=True).wait_for_publish(5)
+    assert "retained/status" not in local_broker.retained
+    for client in (publisher, subscriber):
+        client.disconnect()
+        client.loop_stop()
+
+
+def test_persistent_session(local_broker):
+    subscriber, _, _ = connect(local_broker, client_id="keeper", clean_session=False)
+    subscriber.subscribe("persistent/#", qos=1)
+    subscriber.disconnect()
+    subscriber.loop_stop()
+
+    # published while the subscriber is away; QoS 0 is not kept
+    publisher, _, _ = connect(local_broker)
+    publisher.publish("persistent/test", b"kept", qos=1).wait_for_publish(5)
+    publisher.publish("persistent/test", b"dropped", qos=0).wait_for_publish(5)
+
+    subscriber, messages, _ = connect(local_broker, client_id="keeper", clean_session=False)  # noqa: E501
+    assert messages.get(timeout=5).payload == b"kept"
+    # subscriptions are kept too
+    publisher.publish("persistent/test", b"live", qos=1).wait_for_publish(5)
+    assert messages.get(timeout=5).payload == b"live"
+    assert messages.empty()
+    for client in (publisher, subscriber):
+        client.disconnect()
+        client.loop_stop()
+
+
+def test_rejects_bad_credentials():
+    with MQTTBroker(username=local_username, password=local_password) as broker:
+        client, _, rc = connect(broker, password="wrong")
+        client.loop_stop()
+    assert rc == mqtt_client.CONNACK_REFUSED_BAD_USERNAME_PASSWORD
+
+
+def mqtt_string(value):
+    return struct.pack("!H", len(value)) + value
+
+
+CONNECT = mqtt_string(b"MQTT") + bytes([4, 0xC2, 0, 60]) + b"".join(
+    mqtt_string(value)
+    for value in (b"raw", local_username.encode(), local_password.encode())
+)
+
+
+@pytest.mark.parametrize(
+    "packets",
+    [
+        [bytes([0x10, 4]) + b"\x00\x04MQ"],  # CONNECT cut short
+        [bytes([0x10, len(CONNECT)]) + CONNECT, bytes([0x82, 1, 0])],  # SUBSCRIBE
+        [bytes([0x10, len(CONNECT)]) + CONNECT, bytes([0x30, 4]) + b"\x00\x02\xff\xfe"],
+    ],
+)
+def test_closes_connection_on_malformed_packet(local_broker, caplog, packets):
+    with socket.create_connection((local_broker.host, local_broker.port), 5) as sock:
+        sock.settimeout(5)
+        for packet in packets:
+            sock.sendall(packet)
+        # the CONNACK, if connected, then the broker hangs up
+        while sock.recv(1024):
+            pass
+
+    # and keeps serving everyone else
+    client, messages, _ = connect(local_broker)
+    client.subscribe("malformed/#", qos=1)
+    client.publish("malformed/test", b"still up", qos=1).wait_for_publish(5)
+    assert messages.get(timeout=5).payload == b"still up"
+    client.disconnect()
+    client.loop_stop()
+    assert "malformed packet" in caplog.text
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
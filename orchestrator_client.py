@@ -6,10 +6,24 @@
 import os
 from queue import Queue, Empty
 import json
-from time import time, sleep
+from time import time
 import secrets
 import paho.mqtt.client as paho
 import threading
+from communication import (
+    create_client,
+    run_batch,
+    iter_batch,
+    env_port,
+    env_tls,
+    env_qos,
+    FleetScheduler,
+    get_session,
+    tls_context,
+)
+from results_io import ResultsWriter
+from color_experiment import AdaptivePlanner
+from metrics import get_registry, to_text, write_metrics
 
 course_id = os.environ["COURSE_ID"]
 username = os.environ["HIVEMQ_USERNAME"]
@@ -19,6 +33,35 @@ host = os.environ["HIVEMQ_HOST"]
 # Topics
 neopixel_topic = f"{course_id}/neopixel"
 as7341_topic = f"{course_id}/as7341"
+# "done" is published here once the results have been written (for autograding)
+status_topic = f"{course_id}/orchestrator_status"
+
+# "json" (default) or "binary" for the compact packed sensor data format
+sensor_data_encoding = os.getenv("SENSOR_DATA_ENCODING", "json")
+
+# number of commands sent together in one {"batch": [...]} message
+commands_per_message = int(os.getenv("COMMANDS_PER_MESSAGE", 1))
+
+# number of commands awaiting their sensor data at once. With this and
+# COMMANDS_PER_MESSAGE at 1, the commands are run one by one with
+# run_experiment; otherwise they are pipelined (see run_experiments)
+experiments_in_flight = int(os.getenv("EXPERIMENTS_IN_FLIGHT", 1))
+
+# optional file to export latency/throughput metrics to at the end of the run
+# (.json for JSON, .prom for Prometheus' textfile format, otherwise text)
+metrics_file = os.getenv("METRICS_FILE")
+
+# comma-separated DEVICE_IDs of a fleet of boards (see microcontroller_client.py)
+# to share the commands between; unset for a single board on the topics above
+device_ids = [d for d in os.getenv("DEVICE_IDS", "").split(",") if d]
+
+# target spectrum (JSON, e.g. {"ch410": ..., ..., "ch670": ...}) to search RGB
+# space for, instead of running the gemstone commands below
+target_spectrum = os.getenv("TARGET_SPECTRUM")
+
+# QoS 2 by default; with MQTT_QOS=0 or 1, duplicate results are dropped by
+# experiment_id instead
+qos = env_qos()
 
 # Commands for three gemstone colors
 commands = [
@@ -27,19 +70,33 @@ commands = [
     {"R": 80, "G": 200, "B": 120},  # emerald
 ]
 
-# Later, this should be populated with the payload dictionaries from the microcontroller
-results_dicts = []
-
-
 # - Set up the on_message and on_connect event handlers for the client.
 # - Connect to the MQTT broker and subscribe to the provided topic.
 # - Return the configured client instance.
+#
+# The client reconnects on its own (with exponential backoff and jitter) if
+# the connection drops, renews the subscription, and holds back commands
+# published while offline until it is connected again. Its persistent session
+# (fixed client id) makes the broker keep sensor data that arrive meanwhile,
+# so experiments in flight carry on instead of timing out.
 def get_client_and_queue(
-    subscribe_topic, host, username, password=None, port=8883, tls=True
+    subscribe_topic,
+    host,
+    username,
+    password=None,
+    port=8883,
+    tls=True,
+    qos=2,
+    client_id=None,
+    connect_timeout=10.0,
 ):
-    client = paho.Client()  # create new instance
+    if client_id is None:
+        client_id = f"orchestrator-{secrets.token_hex(4)}"
+    # a ResilientClient, recording to MQTT_RECORD if set, or with MQTT_REPLAY
+    # set, a client playing a recording back without a broker
+    client = create_client(client_id)  # create new instance
     queue = Queue()  # Create queue to store sensor data
-    connected_event = threading.Event()  # event to wait for connection
+    subscribed_event = threading.Event()  # event to wait for the subscription
 
     def on_message(client, userdata, msg):
         print(f"Received message on topic {msg.topic}: {msg.payload}")
@@ -48,39 +105,75 @@ def get_client_and_queue(
         ...
 
     def on_connect(client, userdata, flags, rc):
-        client.subscribe(subscribe_topic, qos=2)
-        connected_event.set()
+        if rc != 0:
+            print(f"Connection refused: {paho.connack_string(rc)}")
+        elif subscribed_event.is_set():
+            print(f"Reconnected to {host}")
+
+    def on_disconnect(client, userdata, rc):
+        if rc != paho.MQTT_ERR_SUCCESS:
+            print(f"Connection lost ({paho.error_string(rc)}), reconnecting")
+
+    def on_subscribe(client, userdata, mid, granted_qos):
+        subscribed_event.set()
 
     client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
     client.on_message = on_message
+    client.on_subscribe = on_subscribe
 
-    # enable TLS for secure connection
+    # enable TLS for secure connection (the context also times the handshake)
     if tls:
-        client.tls_set(tls_version=paho.ssl.PROTOCOL_TLS_CLIENT)
+        client.tls_set_context(tls_context())
 
     # set username and password
     client.username_pw_set(username, password)
 
-    # connect to HiveMQ Cloud on port 8883 (default for MQTT)
-    client.connect(host, port)
+    # subscribed to on connecting, and again on every reconnect
+    client.subscribe(subscribe_topic, qos=qos)
 
-    client.subscribe(subscribe_topic, qos=2)
+    # connect to HiveMQ Cloud on port 8883 (default for MQTT), retrying with
+    # backoff if the broker can't be reached straight away
+    start = time()
+    client.connect_async(host, port)
+    client.loop_start()
 
-    # wait for connection to be established
-    connected_event.wait(timeout=10.0)
+    # wait until the broker has confirmed the subscription, so that no sensor
+    # data can be missed
+    if not subscribed_event.wait(timeout=connect_timeout):
+        client.loop_stop()
+        if client.connect_rc not in (None, 0):
+            raise ConnectionRefusedError(
+                f"{host} refused the connection: {paho.connack_string(client.connect_rc)}"  # noqa: E501
+            )
+        raise TimeoutError(f"Could not subscribe to {subscribe_topic} on {host}")
+    get_registry().histogram(
+        "mqtt_connect_seconds", "Time from connect() to the subscription being acknowledged"  # noqa: E501
+    ).record(time() - start)
     return client, queue
 
 
 # Function to send a command to the neopixel and wait for sensor data
 def run_experiment(
-    client, queue, command_topic, payload_dict, queue_timeout=30, function_timeout=300
+    client,
+    queue,
+    command_topic,
+    payload_dict,
+    queue_timeout=30,
+    function_timeout=300,
+    qos=2,
+    cache=None,
 ):
+    # answer repeated commands from the cache (a ResultCache), if given
+    if cache is not None:
+        cached = cache.lookup(payload_dict)
+        if cached is not None:
+            return cached
+
     # TODO: Convert payload_dict into a JSON string
     # TODO: Publish the JSON string to the command_topic with qos=2
     ...
 
-    client.loop_start()
-
     t0 = time()
     while True:
         if time() - t0 > function_timeout:
@@ -99,41 +192,169 @@ def run_experiment(
             isinstance(results, dict)
             and results["experiment_id"] == payload_dict["experiment_id"]
         ):
-            client.loop_stop()
+            if cache is not None:
+                cache.store(results)
             return results
 
 
-# Orchestrator subscribes to the sensor data topic
-client, queue = get_client_and_queue(as7341_topic, host, username, password=password)
+# Function to send many commands at once and wait for all of their sensor data
+def run_experiments(
+    client,
+    queue,
+    command_topic,
+    payload_dicts,
+    window=16,
+    queue_timeout=30,
+    batch_size=1,
+    qos=2,
+    cache=None,
+):
+    # results come back in the same order as payload_dicts (None if timed out)
+    return run_batch(
+        client,
+        queue,
+        command_topic,
+        payload_dicts,
+        window=window,
+        queue_timeout=queue_timeout,
+        batch_size=batch_size,
+        qos=qos,
+        cache=cache,
+    )
+
+
+# Search for the command whose sensor data best match target: each round, a
+# surrogate model of the device (updated with every batch of results) picks
+# the next batch of commands to run, until the match stops improving (see
+# color_experiment.AdaptivePlanner). Yields (index, results_dict) like
+# iter_batch, for every command run
+def search_experiments(
+    client,
+    queue,
+    command_topic,
+    target,
+    payload_writer,
+    max_rounds=50,
+    queue_timeout=30,
+    qos=2,
+    **kwargs,
+):
+    planner = AdaptivePlanner(target, **kwargs)
+    index = 0
+    while not planner.converged and planner.rounds < max_rounds:
+        commands = planner.propose()
+        payload_dicts = list(generate_payload_dicts(commands, payload_writer))
+        results = run_experiments(
+            client,
+            queue,
+            command_topic,
+            payload_dicts,
+            window=len(payload_dicts),
+            queue_timeout=queue_timeout,
+            qos=qos,
+        )
+        planner.observe(
+            commands, [r["sensor_data"] if r is not None else None for r in results]
+        )
+        for results_dict in results:
+            yield index, results_dict
+            index += 1
+    print(
+        f"Best match {planner.best_command} (relative RMS error {planner.best_error:.2g}) "  # noqa: E501
+        f"after {planner.n_evaluations} experiments in {planner.rounds} rounds"
+    )
+
 
-payload_dicts = []
+# random experiment id to keep track where the sensor data is from, with each
+# payload dictionary recorded as it is sent (for autograding)
+def generate_payload_dicts(commands, payload_writer):
+    for command in commands:
+        experiment_id = secrets.token_hex(4)  # 4 bytes = 8 characters
+        payload_dict = {"command": command, "experiment_id": experiment_id}
+        if sensor_data_encoding != "json":
+            payload_dict["encoding"] = sensor_data_encoding
+        payload_writer.write(payload_dict)
+        yield payload_dict
 
-sleep(5.0)
 
-# Run the experiments
-for command in commands:
-    # random experiment id to keep track where the sensor data is from
-    experiment_id = secrets.token_hex(4)  # 4 bytes = 8 characters
-    payload_dict = {"command": command, "experiment_id": experiment_id}
-    payload_dicts.append(payload_dict)
+def main():
+    if device_ids and target_spectrum is None:
+        # the fleet routes every device's sensor data over the one pooled
+        # session, so the single-device client isn't opened as well
+        session = get_session(host, username, password, port=env_port(), tls=env_tls())
+        client = queue = None
+    else:
+        # Orchestrator subscribes to the sensor data topic
+        client, queue = get_client_and_queue(
+            as7341_topic,
+            host,
+            username,
+            password=password,
+            port=env_port(),
+            tls=env_tls(),
+            qos=qos,
+        )
 
-    print(f"Sending {payload_dict} to {neopixel_topic}")
-    results_dict = run_experiment(client, queue, neopixel_topic, payload_dict)
+    # Run the experiments and append each result to results.json (as JSON
+    # Lines) as soon as it arrives, so a crash doesn't lose the whole run
+    if target_spectrum is None:
+        print(f"Sending {len(commands)} commands to {neopixel_topic}")
+    with ResultsWriter("payload_dicts.json") as payload_writer, ResultsWriter(
+        "results.json"
+    ) as results_writer:
+        payload_dicts = generate_payload_dicts(commands, payload_writer)
+        if target_spectrum is not None:
+            print(f"Searching for {target_spectrum} on {neopixel_topic}")
+            results = search_experiments(
+                client,
+                queue,
+                neopixel_topic,
+                json.loads(target_spectrum),
+                payload_writer,
+                qos=qos,
+            )
+        elif client is None:
+            fleet = FleetScheduler(session, course_id, qos=qos, discover=False)
+            for device_id in device_ids:
+                fleet.register(device_id)
+            results = fleet.iter_results(payload_dicts)
+        elif commands_per_message > 1 or experiments_in_flight > 1:
+            results = iter_batch(
+                client,
+                queue,
+                neopixel_topic,
+                payload_dicts,
+                window=max(experiments_in_flight, commands_per_message),
+                batch_size=commands_per_message,
+                qos=qos,
+            )
+        else:
+            results = (
+                (i, run_experiment(client, queue, neopixel_topic, p, qos=qos))
+                for i, p in enumerate(payload_dicts)
+            )
+        for _, results_dict in results:
+            # results_dict should be of the form:
+            # {
+            #     "command": {"R": ..., "G": ..., "B": ...},
+            #     "sensor_data": {"ch410": ..., "ch440": ..., ..., "ch670": ...},
+            #     "experiment_id": "...",
+            # }
+            if results_dict is not None:
+                results_writer.write(results_dict)
 
-    # results_dict should be of the form:
-    # {
-    #     "command": {"R": ..., "G": ..., "B": ...},
-    #     "sensor_data": {"ch410": ..., "ch440": ..., ..., "ch670": ...},
-    #     "experiment_id": "...",
-    # }
+    # let anyone waiting on the results (e.g. the autograder) know they are ready
+    publisher = session if client is None else client
+    publisher.publish(status_topic, "done", qos=2).wait_for_publish(timeout=10.0)
+    if client is not None:
+        client.loop_stop()
 
-    results_dicts.append(results_dict)
-    sleep(1)
+    print(to_text())
+    if metrics_file:
+        write_metrics(metrics_file)
 
-# write the commands with experiment ids to a file (for autograding)
-with open("payload_dicts.json", "w") as f:
-    json.dump(payload_dicts, f)
 
-# write the results to a file (for autograding)
-with open("results.json", "w") as f:
-    json.dump(results_dicts, f)
+# Run only when executed as a script, so the functions above can be imported
+# (e.g. by the benchmarks)
+if __name__ == "__main__":
+    main()
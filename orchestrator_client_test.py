@@ -1,5 +1,5 @@
 import os
-from time import time, sleep
+from time import time
 import json
 import subprocess
 import warnings
@@ -7,6 +7,9 @@ import paho.mqtt.client as mqtt_client
 from pprint import pformat
 from pathlib import Path
 import threading
+from color_experiment import ExperimentPool
+from communication import env_port, env_tls, encode_payload, encode_batch
+from results_io import load_results
 
 username_key = "HIVEMQ_USERNAME"
 password_key = "HIVEMQ_PASSWORD"
@@ -16,6 +19,10 @@ course_id_key = "COURSE_ID"
 sensor_data_fname = "results.json"
 payload_dict_fname = "payload_dicts.json"
 
+# seconds the fake microcontroller waits before replying, so that a real
+# microcontroller running at the same time gets to go first
+response_delay_key = "SIMULATED_RESPONSE_DELAY"
+
 
 def flatten_dict(d, parent_key="", sep="_"):
     items = []
@@ -31,19 +38,6 @@ def flatten_dict(d, parent_key="", sep="_"):
     return flattened
 
 
-def run_color_experiment(R, G, B):
-    """Dummy function for receiving R, G, B values and returning sensor data."""
-    wavelengths = [410, 440, 470, 510, 550, 583, 620, 670]
-    rw = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.9, 1.0]
-    gw = [0.2, 0.4, 0.6, 0.8, 1.0, 0.8, 0.4, 0.2]
-    bw = [0.9, 1.0, 0.8, 0.6, 0.4, 0.2, 0.1, 0.0]
-    sensor_data = {
-        f"ch{wavelength}": rw[i] * R + gw[i] * G + bw[i] * B
-        for i, wavelength in enumerate(wavelengths)
-    }
-    return sensor_data
-
-
 def test_orchestrator_client():
     """Pretend to be the microcontroller"""
 
@@ -74,25 +68,31 @@ def test_orchestrator_client():
 
     command_topic = f"{course_id}/neopixel"
     sensor_data_topic = f"{course_id}/as7341"
+    status_topic = f"{course_id}/orchestrator_status"
+    response_delay = float(os.getenv(response_delay_key, 1.0))
 
     # Remove files if they exist
     for filename in [sensor_data_fname, payload_dict_fname]:
         file_path = Path(filename)
         file_path.unlink(missing_ok=True)
 
-    connected_event = threading.Event()
+    subscribed_event = threading.Event()
+    done_event = threading.Event()  # set when the orchestrator reports "done"
 
     def on_connect(client, userdata, flags, rc):
         print(f"Connected with result code {rc}")
-        client.subscribe(command_topic, qos=2)
-        connected_event.set()
+        client.subscribe([(command_topic, 2), (status_topic, 2)])
+
+    def on_subscribe(client, userdata, mid, granted_qos):
+        subscribed_event.set()
 
     # Create lists to store commands and sensor data
     received_payloads = []
     sent_payload_dicts = []
 
-    # Create queue to store sensor data
-    # payload_dict_queue = Queue()
+    # slight delay per experiment to allow a real microcontroller to go first
+    # if it's running at the same time
+    experiments = ExperimentPool("thread", max_pending=16, delay=response_delay)
 
     def on_message(client, userdata, message):
         topic = message.topic
@@ -100,38 +100,46 @@ def test_orchestrator_client():
 
         print(f"Received message on topic {topic}: {msg}")
 
+        if topic == status_topic and msg == "done":
+            done_event.set()
+
         if topic == command_topic:
             print("Topic matches command_topic")
-            received_payload_dict = json.loads(msg)
-            received_payloads.append(
-                received_payload_dict
-            )  # Store the received command
-            cmd = received_payload_dict["command"]
-            sensor_data = run_color_experiment(cmd["R"], cmd["G"], cmd["B"])
-
-            # Join params and sensor_data into the payload
-            payload_dict = {**received_payload_dict, "sensor_data": sensor_data}
-            payload = json.dumps(payload_dict)
-
-            # slight delay to allow real microcontroller to go first if
-            # it's running at the same time
-            sleep(1.0)
-
-            client.publish(sensor_data_topic, payload, qos=2)
-            sent_payload_dicts.append(payload_dict)  # Store the sent sensor data
-            # payload_dict_queue.put(payload_dict)  # Add sensor data to the queue
+            received_dict = json.loads(msg)
+            # several commands may arrive together as {"batch": [...]}
+            received_payload_dicts = received_dict.get("batch", [received_dict])
+            received_payloads.extend(
+                received_payload_dicts
+            )  # Store the received commands
+
+            encoding = received_payload_dicts[0].get("encoding", "json")
+            batched = "batch" in received_dict
+
+            def reply(payload_dicts):
+                if batched:
+                    payload = encode_batch(payload_dicts, encoding)
+                else:
+                    payload = encode_payload(payload_dicts[0], encoding)
+                client.publish(sensor_data_topic, payload, qos=2)
+                sent_payload_dicts.extend(payload_dicts)  # Store the sent sensor data
+
+            # run the experiments in a worker thread, so that their delay
+            # doesn't hold up paho's network loop
+            experiments.submit(received_payload_dicts, reply)
 
     client = mqtt_client.Client()
     client.username_pw_set(username, password)
     client.on_connect = on_connect
+    client.on_subscribe = on_subscribe
     client.on_message = on_message
 
-    client.tls_set(tls_version=mqtt_client.ssl.PROTOCOL_TLS_CLIENT)
-    client.connect(host, port=8883)
+    if env_tls():
+        client.tls_set(tls_version=mqtt_client.ssl.PROTOCOL_TLS_CLIENT)
+    client.connect(host, port=env_port())
     client.loop_start()
 
-    # Wait for the client to connect
-    connected_event.wait(timeout=10.0)
+    # Wait for the client to connect and subscribe
+    subscribed_event.wait(timeout=10.0)
 
     orchestrator_client_process = subprocess.Popen(
         ["python", script_name],
@@ -139,22 +147,23 @@ def test_orchestrator_client():
         stderr=subprocess.PIPE,
     )
 
-    sleep(5.0)
-
     try:
-        # give the data some time to be sent
+        # Finished once the orchestrator reports "done" or, if it doesn't
+        # publish a status, once it has exited
         start_time = time()
         timeout = 30  # seconds
-        lower_limit = 15  # seconds, to ensure success even when microcontroller is running concurrently
-
-        while (
-            not os.path.exists(sensor_data_fname)
-            and not os.path.exists(payload_dict_fname)
-        ) or time() - start_time < lower_limit:
-            sleep(1)
+        while not done_event.wait(timeout=0.1):
+            if orchestrator_client_process.poll() is not None:
+                break
             if time() - start_time > timeout:
                 raise TimeoutError(
-                    f"{sensor_data_fname} and {payload_dict_fname} not found within {timeout} s. Number of commands received so far: {len(received_payloads)}"  # noqa: E501
+                    f"{script_name} did not finish within {timeout} s. Number of commands received so far: {len(received_payloads)}"  # noqa: E501
+                )
+
+        for filename in [sensor_data_fname, payload_dict_fname]:
+            if not os.path.exists(filename):
+                raise FileNotFoundError(
+                    f"{filename} not found after {script_name} finished. Number of commands received so far: {len(received_payloads)}"  # noqa: E501
                 )
 
         if len(received_payloads) != len(rgb_values):
@@ -183,11 +192,9 @@ def test_orchestrator_client():
             received_payloads
         ), f"Received commands {received_payloads} do not have unique experiment_id keys"  # noqa: E501
 
-        with open(sensor_data_fname) as f:
-            results_dicts = json.load(f)
-
-        with open(payload_dict_fname) as f:
-            payload_dicts_for_microcontroller = json.load(f)
+        # either a JSON list or JSON Lines (one dictionary per line)
+        results_dicts = load_results(sensor_data_fname)
+        payload_dicts_for_microcontroller = load_results(payload_dict_fname)
 
         sent_rgb_values = [
             {k: v for k, v in payload_dict["command"].items() if k in ("R", "G", "B")}
@@ -253,6 +260,8 @@ def test_orchestrator_client():
         print("STDERR:")
         print(stderr.decode())
 
+        experiments.close()
+
         print(f"TERMINATING {script_name} process")
         orchestrator_client_process.terminate()
         orchestrator_client_process.wait()
@@ -0,0 +1,141 @@
+import json
+import pytest
+import numpy as np
+from results_io import (
+    ResultsWriter,
+    iter_results,
+    load_results,
+    completed_experiment_ids,
+    results_to_columnar,
+    save_columnar,
+    load_columnar,
+    json_to_columnar,
+    columnar_to_json,
+    Schema,
+    validate_results,
+)
+
+results_dicts = [
+    {
+        "command": {"R": 15, "G": 82, "B": 186},
+        "sensor_data": {"ch410": 185.4, "ch670": 31.4},
+        "experiment_id": f"{i:08x}",
+    }
+    for i in range(5)
+]
+
+
+def test_jsonl_round_trip(tmp_path):
+    path = tmp_path / "results.json"
+    with ResultsWriter(path, fsync_every=2) as writer:
+        for results_dict in results_dicts:
+            writer.write(results_dict)
+    assert load_results(path) == results_dicts
+    assert completed_experiment_ids(path) == {d["experiment_id"] for d in results_dicts}
+
+
+def test_reads_json_array(tmp_path):
+    path = tmp_path / "results.json"
+    path.write_text(json.dumps(results_dicts))
+    assert list(iter_results(path)) == results_dicts
+
+
+def test_resume_after_truncated_write(tmp_path):
+    path = tmp_path / "results.json"
+    with ResultsWriter(path) as writer:
+        writer.write(results_dicts[0])
+    with open(path, "a") as f:
+        f.write(json.dumps(results_dicts[1])[:10])  # crash mid-write
+    assert load_results(path) == results_dicts[:1]
+
+    with ResultsWriter(path, append=True) as writer:
+        writer.write(results_dicts[2])
+    # the partial line is now followed by a newline, so it is corrupt, not truncated
+    with pytest.raises(ValueError):
+        load_results(path)
+
+
+def test_missing_file_has_no_completed_ids(tmp_path):
+    assert completed_experiment_ids(tmp_path / "missing.json") == set()
+
+
+def test_columnar_round_trip(tmp_path):
+    results = results_to_columnar(results_dicts)
+    assert results.command.dtype == np.uint8
+    assert results.sensor_data.shape == (5, 2)
+    save_columnar(tmp_path / "results", results)
+    loaded = load_columnar(tmp_path / "results")
+    assert isinstance(loaded.sensor_data, np.memmap)
+    assert loaded.to_results_dicts() == results_dicts
+
+
+def test_json_columnar_conversion(tmp_path):
+    src = tmp_path / "results.json"
+    src.write_text(json.dumps(results_dicts))
+    columnar = json_to_columnar(src, tmp_path / "columnar", chunk_size=2)
+    assert columnar.channels == ("ch410", "ch670")
+    columnar_to_json(tmp_path / "columnar", tmp_path / "roundtrip.json")
+    assert load_results(tmp_path / "roundtrip.json") == results_dicts
+
+
+def test_columnar_rejects_out_of_range_commands():
+    with pytest.raises(ValueError):
+        results_to_columnar([{**results_dicts[0], "command": {"R": 256, "G": 0, "B": 0}}])  # noqa: E501
+
+
+def test_validation_reports_every_mismatch_with_row():
+    results = [
+        {**d, "sensor_data": dict(d["sensor_data"])} for d in results_dicts
+    ]
+    results[1]["sensor_data"]["ch410"] = 185.4 * (1 + 1e-6)  # within rtol
+    results[2]["sensor_data"]["ch670"] = 40.0
+    del results[3]["experiment_id"]
+    results[4]["command"] = {"R": "15", "G": 82, "B": 186}
+    report = validate_results(results, results_dicts)
+    assert not report.ok
+    assert report.rows() == [2, 3, 4]
+    assert [(m.row, m.field, m.kind) for m in report] == [
+        (2, "sensor_data.ch670", "value"),
+        (3, "experiment_id", "missing"),
+        (4, "command.R", "type"),
+    ]
+    assert report.mismatches[0].expected == 31.4
+    with pytest.raises(AssertionError, match="row 2: sensor_data.ch670"):
+        report.raise_if_invalid()
+
+
+def test_validation_matches_rows_and_columnar():
+    expected = [{**d, "experiment_id": f"id{i}"} for i, d in enumerate(results_dicts)]
+    shuffled = expected[::-1]
+    assert validate_results(shuffled, expected, match_on="experiment_id").ok
+    report = validate_results(
+        shuffled[:3] + [shuffled[0]], expected, match_on="experiment_id"
+    )
+    assert report.counts() == {
+        ("experiment_id", "duplicate row"): 1,
+        ("experiment_id", "missing row"): 2,
+    }
+    columnar = results_to_columnar(expected)
+    assert validate_results(columnar, expected).ok
+    strict = Schema.from_example(expected[0], allow_extra=False)
+    report = strict.validate([{**expected[0], "extra": 1}])
+    assert [(m.row, m.field, m.kind) for m in report] == [(0, "extra", "extra")]
+
+
+def test_validation_against_one_example():
+    # as microcontroller_client_test checks a reply: the expected keys are a
+    # subset of the record's, and values agree within np.isclose tolerances
+    expected = {
+        "experiment_id": "abc123",
+        "sensor_data": {"ch410": 0.0, "ch670": 185.4},
+    }
+    record = {
+        "command": {"R": 64, "G": 224, "B": 208},
+        "experiment_id": "abc123",
+        "sensor_data": {"ch410": 5e-9, "ch670": 185.4 * (1 + 5e-5)},
+    }
+    schema = Schema.from_example(expected)
+    assert schema.validate([record], expected).ok
+    assert not schema.validate([record], expected, atol=0).ok
+    report = schema.validate([{**record, "experiment_id": "def456"}], expected)
+    assert [(m.field, m.kind) for m in report] == [("experiment_id", "value")]
@@ -0,0 +1,18 @@
+"""Simulated colour experiment used in place of the real light sensor"""
+from color_experiment._color_experiment import (
+    WAVELENGTHS,
+    CHANNELS,
+    WEIGHTS,
+    run_color_experiment,
+    run_color_experiments,
+    iter_color_experiments,
+    rgb_grid,
+)
+from color_experiment._responder import SimulatedMicrocontroller, ExperimentPool
+from color_experiment._surrogate import (
+    RecursiveLeastSquares,
+    linear_features,
+    quadratic_features,
+)
+from color_experiment._planner import AdaptivePlanner, adaptive_search
+from color_experiment._inverse import InverseSolver, spectrum_to_rgb
@@ -0,0 +1,140 @@
+import numpy as np
+
+WAVELENGTHS = (410, 440, 470, 510, 550, 583, 620, 670)
+CHANNELS = tuple(f"ch{wavelength}" for wavelength in WAVELENGTHS)
+
+# Contribution of one unit of R, G and B to each channel, shape (3, 8)
+WEIGHTS = np.array(
+    [
+        [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.9, 1.0],  # rw
+        [0.2, 0.4, 0.6, 0.8, 1.0, 0.8, 0.4, 0.2],  # gw
+        [0.9, 1.0, 0.8, 0.6, 0.4, 0.2, 0.1, 0.0],  # bw
+    ]
+)
+
+_ROW_BYTES = (3 + len(WAVELENGTHS)) * np.dtype(np.float64).itemsize
+
+
+def _as_spectra(sensor_data):
+    # sensor_data dict(s) keyed by channel name, or rows of values in the
+    # order of CHANNELS -> (N, 8) array
+    if isinstance(sensor_data, dict):
+        sensor_data = [sensor_data]
+    if not isinstance(sensor_data, np.ndarray):
+        sensor_data = [
+            [row[channel] for channel in CHANNELS] if isinstance(row, dict) else row
+            for row in sensor_data
+        ]
+    return np.asarray(sensor_data, dtype=np.float64).reshape(-1, len(CHANNELS))
+
+
+def _as_rgb(commands):
+    return np.array(
+        [
+            [c["R"], c["G"], c["B"]] if isinstance(c, dict) else c
+            for c in commands
+        ],
+        dtype=np.float64,
+    ).reshape(-1, 3)
+
+
+def _chunk_rows(n_rows, max_bytes):
+    if max_bytes is None:
+        return max(n_rows, 1)
+    return max(int(max_bytes // _ROW_BYTES), 1)
+
+
+def iter_color_experiments(rgb, max_bytes=64 * 2**20):
+    """Yield ``(start, sensor_data)`` chunks of :func:`run_color_experiments`.
+
+    Each chunk covers ``rgb[start : start + len(sensor_data)]`` and uses at
+    most about ``max_bytes`` of working memory, so arbitrarily large sweeps
+    can be streamed (e.g. to disk) without materialising the full result.
+    """
+    rgb = np.asarray(rgb)
+    chunk = _chunk_rows(len(rgb), max_bytes)
+    for start in range(0, len(rgb), chunk):
+        yield start, rgb[start : start + chunk].astype(np.float64) @ WEIGHTS
+
+
+def run_color_experiments(rgb, max_bytes=None, out=None):
+    """
+    Run many color experiments at once with one matrix multiply.
+
+    Parameters
+    ----------
+    rgb : array_like, shape (N, 3)
+        The R, G, B components of each color, between 0 and 255.
+    max_bytes : int, optional
+        If given, process ``rgb`` in chunks using at most about this much
+        working memory on top of ``out``.
+    out : ndarray, shape (N, 8), optional
+        Array (e.g. a ``numpy.memmap``) to write the sensor data into.
+
+    Returns
+    -------
+    ndarray, shape (N, 8)
+        The sensor data of each experiment, with columns in the order of
+        ``CHANNELS``.
+
+    Examples
+    --------
+    >>> run_color_experiments([[255, 0, 0], [0, 0, 255]])
+    array([[ 25.5,  51. ,  76.5, 102. , 127.5, 153. , 229.5, 255. ],
+           [229.5, 255. , 204. , 153. , 102. ,  51. ,  25.5,   0. ]])
+    """
+    rgb = np.asarray(rgb)
+    if rgb.ndim != 2 or rgb.shape[1] != 3:
+        raise ValueError(f"Expected an (N, 3) array of RGB values, got shape {rgb.shape}")
+    if out is None:
+        out = np.empty((len(rgb), len(WAVELENGTHS)))
+    for start, sensor_data in iter_color_experiments(rgb, max_bytes=max_bytes):
+        out[start : start + len(sensor_data)] = sensor_data
+    return out
+
+
+def run_color_experiment(R, G, B):
+    """
+    Run a color experiment with the specified RGB values.
+
+    Parameters
+    ----------
+    R : int
+        The red component of the color, between 0 and 255.
+    G : int
+        The green component of the color, between 0 and 255.
+    B : int
+        The blue component of the color, between 0 and 255.
+
+    Returns
+    -------
+    dict
+        A dictionary with the sensor data from the experiment.
+
+    Examples
+    --------
+    >>> run_color_experiment(255, 0, 0)
+    {'ch410': 25.5, 'ch440': 51.0, 'ch470': 76.5, 'ch510': 102.0, 'ch550': 127.5, 'ch583': 153.0, 'ch620': 229.5, 'ch670': 255.0}
+    """
+    sensor_data = run_color_experiments([[R, G, B]])[0]
+    return dict(zip(CHANNELS, sensor_data.tolist()))
+
+
+def rgb_grid(levels=256):
+    """Return every combination of ``levels`` evenly spaced R, G, B values.
+
+    Examples
+    --------
+    >>> rgb_grid(2)
+    array([[  0,   0,   0],
+           [  0,   0, 255],
+           [  0, 255,   0],
+           [  0, 255, 255],
+           [255,   0,   0],
+           [255,   0, 255],
+           [255, 255,   0],
+           [255, 255, 255]], dtype=uint8)
+    """
+    values = np.linspace(0, 255, levels).round().astype(np.uint8)
+    r, g, b = np.meshgrid(values, values, values, indexing="ij")
+    return np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
@@ -0,0 +1,171 @@
+from itertools import product
+
+import numpy as np
+
+from color_experiment._color_experiment import WEIGHTS, _as_spectra
+
+# each of R, G, B is either solved for, or held at the lower or upper bound
+_FREE, _LOWER, _UPPER = 0, 1, 2
+
+
+class InverseSolver:
+    """Find the RGB command that best produces a given spectrum.
+
+    Inverts the linear model ``sensor_data = rgb @ weights + offset`` (by
+    default the one in :func:`run_color_experiments`) by least squares,
+    with every component kept between ``low`` and ``high``.
+
+    Everything that does not depend on the spectra is factorised once, on
+    creation. That covers the Gram matrix ``weights @ weights.T`` and the
+    inverse of each of its principal submatrices. :meth:`solve` then handles
+    any number of spectra in one vectorised call.
+
+    With only three unknowns, every combination of components held at
+    their bounds (27 active sets) can be tried for all spectra at once.
+    The feasible candidate with the smallest residual is the exact
+    box-constrained optimum. Clipping the unconstrained solution is
+    generally not the optimum, and searching on the device is not needed.
+
+    Parameters
+    ----------
+    weights : array_like, shape (3, n_channels)
+        Contribution of one unit of R, G and B to each channel.
+    offset : array_like, shape (n_channels,), optional
+        Signal at ``rgb = 0`` (e.g. a dark reading).
+    low, high : float
+        Bounds of each component.
+
+    Examples
+    --------
+    >>> from color_experiment import run_color_experiment, run_color_experiments
+    >>> solver = InverseSolver()
+    >>> solver.solve_command(run_color_experiment(15, 82, 186))
+    {'R': 15, 'G': 82, 'B': 186}
+    >>> too_bright = 1.5 * run_color_experiments([[255, 40, 0]])
+    >>> solver.solve_unconstrained(too_bright).round(1)
+    array([[382.5,  60. ,  -0. ]])
+    >>> rgb, residual = solver.solve(too_bright, refine=True, return_residual=True)
+    >>> rgb, residual.round(1)  # clipping the above would leave 74.3
+    (array([[255, 150,   0]]), array([49.7]))
+    """
+
+    def __init__(self, weights=WEIGHTS, offset=None, low=0.0, high=255.0):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        if offset is None:
+            offset = np.zeros(self.weights.shape[1])
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.low = low
+        self.high = high
+        self.gram = self.weights @ self.weights.T
+        self.gram_inv = np.linalg.pinv(self.gram)
+        # Moore-Penrose pseudo-inverse, for the unconstrained solution
+        self.pinv = np.linalg.pinv(self.weights)
+        # for rounding: the 8 corners of a unit cube, and G_ij for every pair
+        # of components both rounded up at each corner
+        self._corners = np.array(list(product((0, 1), repeat=3)), dtype=np.float64)
+        both_up = self._corners[:, :, np.newaxis] * self._corners[:, np.newaxis, :]
+        self._corner_gram = (both_up * self.gram).reshape(len(self._corners), 9).T
+        self._active_sets = []
+        for states in product((_FREE, _LOWER, _UPPER), repeat=3):
+            states = np.array(states)
+            free = states == _FREE
+            fixed_values = np.where(states == _UPPER, high, low)[~free]
+            gram_inv = (
+                np.linalg.pinv(self.gram[np.ix_(free, free)]) if free.any() else None
+            )
+            self._active_sets.append((free, fixed_values, gram_inv))
+
+    def solve_unconstrained(self, sensor_data):
+        """Least-squares RGB for each spectrum, ignoring the bounds."""
+        return (_as_spectra(sensor_data) - self.offset) @ self.pinv
+
+    def solve(self, sensor_data, refine=False, return_residual=False):
+        """Bounded least-squares RGB for each spectrum, shape ``(N, 3)``.
+
+        Parameters
+        ----------
+        sensor_data : dict, array_like or list of either
+            Spectra as ``sensor_data`` dictionaries or rows of values in
+            the order of ``CHANNELS``.
+        refine : bool
+            Round to the best integer command. The best of the 8 neighbouring
+            integer commands is picked by its residual. Plain rounding can
+            be one level off.
+        return_residual : bool
+            Also return the RMS residual of each solution.
+        """
+        spectra = _as_spectra(sensor_data) - self.offset
+        b = spectra @ self.weights.T  # (N, 3)
+        best = b @ self.gram_inv.T  # unconstrained solution
+        # only spectra whose solution is out of bounds need the active sets
+        outside = np.flatnonzero(
+            np.any((best < self.low) | (best > self.high), axis=1)
+        )
+        if len(outside):
+            best[outside] = self._solve_bounded(b[outside])
+        if refine:
+            best = self._refine(best, b)
+        if not return_residual:
+            return best
+        residual = best @ self.weights - spectra
+        return best, np.sqrt(np.mean(residual**2, axis=1))
+
+    def _solve_bounded(self, b):
+        best = np.zeros((len(b), 3))
+        best_cost = np.full(len(b), np.inf)
+        eps = 1e-9 * max(abs(self.low), abs(self.high), 1.0)
+        for free, fixed_values, gram_inv in self._active_sets:
+            x = np.empty_like(best)
+            x[:, ~free] = fixed_values
+            if gram_inv is not None:
+                rhs = b[:, free] - fixed_values @ self.gram[np.ix_(~free, free)]
+                solved = rhs @ gram_inv.T
+                x[:, free] = solved
+                feasible = np.all(
+                    (solved >= self.low - eps) & (solved <= self.high + eps), axis=1
+                )
+            else:
+                feasible = np.ones(len(x), dtype=bool)
+            cost = self._cost(x, b)
+            better = feasible & (cost < best_cost)
+            best[better] = x[better]
+            best_cost[better] = cost[better]
+        return np.clip(best, self.low, self.high)
+
+    def _cost(self, x, b):
+        # ||x @ weights - y||**2 without the constant ||y||**2
+        return np.sum((x @ self.gram - 2 * b) * x, axis=1)
+
+    def _refine(self, x, b):
+        lower = np.clip(np.floor(x), self.low, self.high)
+        step = np.clip(np.ceil(x), self.low, self.high) - lower  # 0 or 1
+        # cost(lower + e) - cost(lower) = 2 e.(G lower - b) + e.G.e for the
+        # 8 ways e = corner * step of rounding each component down or up
+        slope = 2 * (lower @ self.gram - b) * step
+        pairs = (step[:, :, np.newaxis] * step[:, np.newaxis, :]).reshape(len(x), 9)
+        deltas = slope @ self._corners.T + pairs @ self._corner_gram
+        chosen = self._corners[np.argmin(deltas, axis=1)]
+        return (lower + chosen * step).astype(int)
+
+    def solve_command(self, sensor_data):
+        """Integer command (``{"R": ..., "G": ..., "B": ...}``) for one spectrum."""
+        rgb = self.solve([sensor_data], refine=True)[0]
+        return dict(zip("RGB", (int(v) for v in rgb)))
+
+
+_default_solver = None
+
+
+def spectrum_to_rgb(sensor_data, refine=True):
+    """Solve spectra for RGB with :class:`InverseSolver`'s default model.
+
+    Examples
+    --------
+    >>> spectrum_to_rgb([[25.5, 51.0, 76.5, 102.0, 127.5, 153.0, 229.5, 255.0]])
+    array([[255,   0,   0]])
+    """
+    global _default_solver
+    if _default_solver is None:
+        _default_solver = InverseSolver()
+    return _default_solver.solve(sensor_data, refine=refine)
+
@@ -0,0 +1,207 @@
+import numpy as np
+
+from color_experiment._color_experiment import CHANNELS, _as_spectra, _as_rgb
+from color_experiment._surrogate import FEATURES, RecursiveLeastSquares
+from color_experiment._inverse import InverseSolver
+
+
+class AdaptivePlanner:
+    """Closed-loop search for the RGB command that produces a target spectrum.
+
+    Alternates :meth:`propose` (a batch of commands to run) and
+    :meth:`observe` (their sensor data). A surrogate model of the device
+    (:class:`RecursiveLeastSquares`, from RGB to the eight channels) is
+    updated with each batch rather than refitted. Each round scores
+    ``n_candidates`` commands at once with the surrogate and proposes the
+    ``batch_size`` most promising ones. The candidates are
+
+    - the surrogate's own best guess (its inverse, see
+      :class:`InverseSolver`, with linear features),
+    - random steps around the best command measured so far, within a
+      radius that halves whenever a round brings no improvement, and
+    - uniformly random commands.
+
+    A candidate's score is its predicted RMS distance to the target, less
+    ``exploration`` times the prediction's standard deviation. The search
+    has converged once the best measured RMS error is within ``tol``
+    (relative to the target's RMS), or after ``patience`` rounds without
+    improvement at the smallest radius.
+
+    Parameters
+    ----------
+    target : dict or array_like
+        Target spectrum, as ``sensor_data`` (channel name -> value) or eight
+        values in the order of ``CHANNELS``.
+    batch_size : int
+        Commands proposed per round, i.e. per device round trip.
+    n_candidates : int
+        Commands scored with the surrogate per round.
+    features : {"linear", "quadratic"}
+        Surrogate features; ``"quadratic"`` also fits a nonlinear device.
+    tol : float
+        Relative RMS error at which to stop.
+    patience : int
+        Rounds without improvement at the smallest radius before stopping.
+    exploration : float
+        Weight of the prediction uncertainty in the score.
+    radius : float
+        Initial standard deviation of the steps around the best command.
+    forgetting : float
+        See :class:`RecursiveLeastSquares`.
+    rng : numpy.random.Generator or int, optional
+        Random generator or seed.
+
+    Examples
+    --------
+    >>> from color_experiment import run_color_experiments
+    >>> def device(commands):
+    ...     return run_color_experiments([[c["R"], c["G"], c["B"]] for c in commands])
+    >>> target = run_color_experiments([[40, 200, 90]])[0]
+    >>> planner = adaptive_search(device, target, rng=0)
+    >>> planner.best_command, planner.n_evaluations
+    ({'R': 40, 'G': 200, 'B': 90}, 16)
+    """
+
+    def __init__(
+        self,
+        target,
+        batch_size=8,
+        n_candidates=2048,
+        features="linear",
+        tol=1e-3,
+        patience=3,
+        exploration=1.0,
+        radius=32.0,
+        forgetting=1.0,
+        rng=None,
+    ):
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+        if features not in FEATURES:
+            raise ValueError(f"features must be one of {sorted(FEATURES)}, got {features!r}")  # noqa: E501
+        self.target = _as_spectra([target])[0]
+        self.batch_size = batch_size
+        self.n_candidates = n_candidates
+        self.features = features
+        self.tol = tol
+        self.patience = patience
+        self.exploration = exploration
+        self.radius = radius
+        self.rng = np.random.default_rng(rng)
+        self._featurize = FEATURES[features]
+        n_features = self._featurize(np.zeros((1, 3))).shape[1]
+        self.model = RecursiveLeastSquares(n_features, len(CHANNELS), forgetting)
+        self._scale = max(np.sqrt(np.mean(self.target**2)), 1e-12)
+        self.rounds = 0
+        self.n_evaluations = 0
+        self.best_rgb = None
+        self.best_sensor_data = None
+        self.best_error = np.inf
+        self.history = []  # best relative RMS error after each round
+        self._stale = 0  # rounds without improvement at the smallest radius
+        self._measured = set()
+
+    @property
+    def best_command(self):
+        if self.best_rgb is None:
+            return None
+        return dict(zip("RGB", (int(v) for v in self.best_rgb)))
+
+    @property
+    def converged(self):
+        return self.best_error <= self.tol or self._stale >= self.patience
+
+    def errors(self, sensor_data):
+        """Relative RMS distance of each spectrum to the target."""
+        spectra = _as_spectra(sensor_data)
+        return np.sqrt(np.mean((spectra - self.target) ** 2, axis=1)) / self._scale
+
+    def _candidates(self):
+        n_random = self.n_candidates // 2
+        parts = [self.rng.uniform(0, 255, (n_random, 3))]
+        if self.best_rgb is not None:
+            steps = self.rng.normal(0, self.radius, (self.n_candidates - n_random, 3))
+            parts.append(self.best_rgb + steps)
+        if self.features == "linear" and self.model.n_samples >= 4:
+            # inverse of the surrogate: the command whose prediction is
+            # closest to the target (features are RGB / 255, then 1)
+            coef = self.model.coef
+            solver = InverseSolver(coef[:3] / 255, offset=coef[3])
+            parts.append(solver.solve([self.target]))
+        candidates = np.clip(np.rint(np.concatenate(parts)), 0, 255)
+        return np.unique(candidates, axis=0)
+
+    def score(self, rgb):
+        """Predicted relative RMS error minus the exploration bonus (lower is better)."""  # noqa: E501
+        predicted, std = self.model.predict(self._featurize(rgb), return_std=True)
+        error = np.sqrt(np.mean((predicted - self.target) ** 2, axis=1))
+        return (error - self.exploration * std) / self._scale
+
+    def propose(self):
+        """Return the next batch of commands (``{"R": ..., "G": ..., "B": ...}``)."""
+        n_features = len(self.model.coef)
+        if self.model.n_samples < n_features:
+            # too few samples to fit the surrogate: spread the first commands
+            # over the RGB cube
+            n = max(self.batch_size, n_features - self.model.n_samples)
+            candidates = np.rint(self.rng.uniform(0, 255, (n, 3)))
+        else:
+            candidates = self._candidates()
+            fresh = np.array(
+                [tuple(rgb) not in self._measured for rgb in candidates.tolist()],
+                dtype=bool,
+            )
+            candidates = candidates[fresh]
+            order = np.argsort(self.score(candidates), kind="stable")
+            candidates = candidates[order[: self.batch_size]]
+        return [dict(zip("RGB", map(int, rgb))) for rgb in candidates]
+
+    def observe(self, commands, sensor_data):
+        """Update the surrogate and the best command with measured results.
+
+        Commands whose ``sensor_data`` is ``None`` (e.g. timed out) are
+        ignored.
+        """
+        pairs = [(c, s) for c, s in zip(commands, sensor_data) if s is not None]
+        self.rounds += 1
+        if pairs:
+            rgb = _as_rgb([c for c, _ in pairs])
+            spectra = _as_spectra([s for _, s in pairs])
+            self.model.update(self._featurize(rgb), spectra)
+            self.n_evaluations += len(rgb)
+            self._measured.update(map(tuple, rgb.tolist()))
+            errors = self.errors(spectra)
+            best = int(np.argmin(errors))
+            improved = errors[best] < self.best_error
+            if improved:
+                self.best_error = float(errors[best])
+                self.best_rgb = rgb[best]
+                self.best_sensor_data = dict(zip(CHANNELS, spectra[best].tolist()))
+        else:
+            improved = False
+        if improved or self.best_rgb is None:
+            self._stale = 0
+        elif self.radius > 1:
+            self.radius = max(self.radius / 2, 1.0)
+        else:
+            self._stale += 1
+        self.history.append(self.best_error)
+
+
+def adaptive_search(evaluate, target, max_rounds=50, **kwargs):
+    """Run an :class:`AdaptivePlanner` against ``evaluate`` until it converges.
+
+    ``evaluate`` runs a list of commands (``{"R": ..., "G": ..., "B": ...}``)
+    and returns their sensor data, e.g. by sending them to the device (see
+    ``orchestrator_client.search_experiments``) or, offline, with
+    :func:`run_color_experiments`; ``None`` marks a command that failed.
+    Other keyword arguments are passed on to :class:`AdaptivePlanner`.
+    Returns the planner, whose ``best_command`` is the closest match found.
+    """
+    planner = AdaptivePlanner(target, **kwargs)
+    while not planner.converged and planner.rounds < max_rounds:
+        commands = planner.propose()
+        if not commands:
+            break
+        planner.observe(commands, evaluate(commands))
+    return planner
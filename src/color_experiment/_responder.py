@@ -0,0 +1,325 @@
+import json
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from time import sleep
+
+import numpy as np
+
+from color_experiment._color_experiment import run_color_experiment
+from communication._codec import (
+    encode_batch,
+    encode_payload,
+    unpack_batch,
+    BATCH_KEY,
+    JSON_ENCODING,
+)
+from communication._dedup import DedupCache
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("inline", "thread", "process")
+
+
+def _run_experiments(payload_dicts, latencies):
+    # module level, so that a process pool can pickle it
+    results_dicts = []
+    for payload_dict, latency in zip(payload_dicts, latencies):
+        if latency > 0:
+            sleep(latency)
+        cmd = payload_dict["command"]
+        sensor_data = run_color_experiment(cmd["R"], cmd["G"], cmd["B"])
+        results_dicts.append({**payload_dict, "sensor_data": sensor_data})
+    return results_dicts
+
+
+class ExperimentPool:
+    """Run simulated experiments off the thread that received them.
+
+    :meth:`submit` hands a list of commands to the backend and returns
+    straight away. The callback gets the results as soon as they are done,
+    in whatever order the jobs complete. At most ``max_pending`` jobs are
+    queued or running at once; beyond that :meth:`submit` blocks until one
+    completes, which pushes back on the sender instead of growing a queue
+    without bound.
+
+    Each experiment takes ``delay`` seconds plus normally distributed
+    ``jitter`` (standard deviation, truncated at zero), like a real device
+    that is busy for a while per command. The latencies are drawn when the
+    job is submitted, so a ``seed`` makes a run reproducible whatever the
+    backend.
+
+    Parameters
+    ----------
+    backend : {"inline", "thread", "process"} or concurrent.futures.Executor
+        ``"inline"`` runs each job in :meth:`submit` itself (the caller
+        waits out the latency), ``"thread"`` and ``"process"`` in a pool of
+        ``max_workers`` threads or processes. A given executor is used as
+        is and not shut down on :meth:`close`.
+    max_workers : int, optional
+        Size of the pool; the ``concurrent.futures`` default if omitted.
+    max_pending : int
+        Most jobs queued or running at once.
+    delay, jitter : float
+        Mean and standard deviation of the seconds each experiment takes.
+    seed : int, optional
+        Seed of the latencies.
+
+    Examples
+    --------
+    >>> results = []
+    >>> with ExperimentPool("thread", delay=0.01, jitter=0.005, seed=0) as pool:
+    ...     for i in range(4):
+    ...         command = {"R": i, "G": 0, "B": 0}
+    ...         pool.submit([{"experiment_id": i, "command": command}], results.extend)
+    >>> sorted(r["experiment_id"] for r in results), pool.completed
+    ([0, 1, 2, 3], 4)
+    """
+
+    def __init__(
+        self,
+        backend="inline",
+        max_workers=None,
+        max_pending=64,
+        delay=0.0,
+        jitter=0.0,
+        seed=None,
+    ):
+        if isinstance(backend, Executor):
+            self._executor, self._owns_executor = backend, False
+        elif backend == "inline":
+            self._executor, self._owns_executor = None, False
+        elif backend == "thread":
+            self._executor = ThreadPoolExecutor(max_workers, "simulated-experiment")
+            self._owns_executor = True
+        elif backend == "process":
+            # forking a process that runs network threads can deadlock
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn"
+            )
+            self._executor = ProcessPoolExecutor(max_workers, mp_context=context)
+            self._owns_executor = True
+        else:
+            raise ValueError(f"backend must be one of {BACKENDS} or an Executor, got {backend!r}")  # noqa: E501
+        if max_pending < 1:
+            raise ValueError(f"max_pending must be at least 1, got {max_pending}")
+        self.backend = backend
+        self.max_pending = max_pending
+        self.delay = delay
+        self.jitter = jitter
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.peak_pending = 0
+        self._rng = np.random.default_rng(seed)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+
+    @property
+    def pending(self):
+        """Jobs queued or running."""
+        return self._pending
+
+    def latencies(self, n):
+        """Draw the seconds each of ``n`` experiments takes."""
+        if not self.jitter:
+            return [float(self.delay)] * n
+        with self._lock:
+            latencies = self._rng.normal(self.delay, self.jitter, n)
+        return np.maximum(latencies, 0.0).tolist()
+
+    def submit(self, payload_dicts, callback):
+        """Run ``payload_dicts`` and call ``callback(results_dicts)`` when done.
+
+        ``results_dicts`` are the payload dictionaries extended with their
+        ``sensor_data``. Blocks while ``max_pending`` jobs are in flight.
+        """
+        latencies = self.latencies(len(payload_dicts))
+        self._slots.acquire()
+        with self._lock:
+            self.submitted += 1
+            self._pending += 1
+            self.peak_pending = max(self.peak_pending, self._pending)
+        if self._executor is None:
+            try:
+                results_dicts = _run_experiments(payload_dicts, latencies)
+            except BaseException:
+                self._finish(False)
+                raise
+            self._complete(callback, results_dicts)
+            return
+        future = self._executor.submit(_run_experiments, payload_dicts, latencies)
+        future.add_done_callback(partial(self._on_done, callback))
+
+    def _on_done(self, callback, future):
+        try:
+            results_dicts = future.result()
+        except BaseException:
+            logger.exception("Simulated experiment failed")
+            self._finish(False)
+            return
+        self._complete(callback, results_dicts)
+
+    def _complete(self, callback, results_dicts):
+        try:
+            callback(results_dicts)
+        finally:
+            self._finish(True)
+
+    def _finish(self, ok):
+        with self._lock:
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self._pending -= 1
+            self._idle.notify_all()
+        self._slots.release()
+
+    def wait(self, timeout=None):
+        """Wait until no jobs are in flight; return whether that happened."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self):
+        """Wait for the jobs in flight and shut down an own pool."""
+        self.wait()
+        if self._owns_executor:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SimulatedMicrocontroller:
+    """Answer commands the way microcontroller_client.py does.
+
+    Each command published to ``command_topic`` is run through
+    :func:`run_color_experiment` and the payload dictionary, extended with
+    its ``sensor_data``, is published to ``sensor_data_topic``. A batch of
+    commands (``{"batch": [...]}``) is answered with one batched message.
+    Received and sent payload dictionaries are kept in ``received`` and
+    ``sent``. Like the device, commands whose ``experiment_id`` was already
+    run are skipped (and counted in ``duplicates``), so redelivery at QoS 1
+    never runs an experiment twice.
+
+    By default each experiment runs inline in the session's network
+    thread, so a slow one holds up every other message. With a
+    ``"thread"`` or ``"process"`` ``backend``, commands are handed to an
+    :class:`ExperimentPool` instead and each reply is published as soon as
+    its experiments are done, e.g. to load test an orchestrator at a
+    realistic number of concurrent experiments.
+
+    Parameters
+    ----------
+    session : communication.MQTTSession
+        Connected session to receive commands and publish results on.
+    command_topic, sensor_data_topic : str
+        E.g. ``f"{COURSE_ID}/neopixel"`` and ``f"{COURSE_ID}/as7341"``.
+    qos : int
+        QoS to subscribe and publish with.
+    dedup : communication.DedupCache, optional
+        Cache of experiment ids already run.
+    status_topic : str, optional
+        Topic to announce the device on with a retained ``online`` (on
+        :meth:`start`) and ``offline`` (on :meth:`stop`), for discovery by
+        ``communication.FleetScheduler``.
+    delay : float
+        Seconds each experiment takes, to simulate slow hardware.
+    jitter : float
+        Standard deviation of the seconds each experiment takes.
+    backend : {"inline", "thread", "process"} or concurrent.futures.Executor
+        Where experiments run, see :class:`ExperimentPool`.
+    max_workers, max_pending : int, optional
+        Size of the pool and most commands in flight at once.
+    seed : int, optional
+        Seed of the experiments' latencies.
+    """
+
+    def __init__(
+        self,
+        session,
+        command_topic,
+        sensor_data_topic,
+        qos=2,
+        dedup=None,
+        status_topic=None,
+        delay=0.0,
+        jitter=0.0,
+        backend="inline",
+        max_workers=None,
+        max_pending=64,
+        seed=None,
+    ):
+        self.session = session
+        self.command_topic = command_topic
+        self.sensor_data_topic = sensor_data_topic
+        self.qos = qos
+        self.status_topic = status_topic
+        self.pool = ExperimentPool(
+            backend, max_workers, max_pending, delay=delay, jitter=jitter, seed=seed
+        )
+        self.received = []
+        self.sent = []
+        self.dedup = DedupCache() if dedup is None else dedup
+        self._lock = threading.Lock()
+
+    @property
+    def delay(self):
+        return self.pool.delay
+
+    @property
+    def duplicates(self):
+        return self.dedup.duplicates
+
+    def _on_message(self, message):
+        message_dict = json.loads(message.payload)
+        payload_dicts = [
+            payload_dict
+            for payload_dict in unpack_batch(message_dict)
+            if self.dedup.add(payload_dict["experiment_id"])
+        ]
+        if not payload_dicts:
+            return
+        with self._lock:
+            self.received.extend(payload_dicts)
+        # reply in the encoding the (first) command asked for, as the device does
+        encoding = payload_dicts[0].get("encoding", JSON_ENCODING)
+        reply = partial(self._reply, encoding, BATCH_KEY in message_dict)
+        self.pool.submit(payload_dicts, reply)
+
+    def _reply(self, encoding, batched, results_dicts):
+        if batched:
+            payload = encode_batch(results_dicts, encoding)
+        else:
+            payload = encode_payload(results_dicts[0], encoding)
+        self.session.publish(self.sensor_data_topic, payload, qos=self.qos)
+        with self._lock:
+            self.sent.extend(results_dicts)
+
+    def start(self):
+        self.session.subscribe(self.command_topic, self._on_message, qos=self.qos)
+        if self.status_topic is not None:
+            self.session.publish(self.status_topic, "online", qos=self.qos, retain=True)
+        return self
+
+    def stop(self):
+        self.session.remove_handler(self.command_topic, self._on_message)
+        # publish the replies still in flight before going offline
+        self.pool.close()
+        if self.status_topic is not None:
+            self.session.publish(self.status_topic, "offline", qos=self.qos, retain=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
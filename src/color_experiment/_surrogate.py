@@ -0,0 +1,96 @@
+import numpy as np
+
+
+def linear_features(rgb):
+    """Map ``(N, 3)`` RGB values to ``[R, G, B, 1] / 255`` features.
+
+    Examples
+    --------
+    >>> linear_features([[255, 0, 51]])
+    array([[1. , 0. , 0.2, 1. ]])
+    """
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    return np.column_stack([rgb, np.ones(len(rgb))])
+
+
+def quadratic_features(rgb):
+    """Linear features plus the squares and pairwise products of R, G, B."""
+    x = np.asarray(rgb, dtype=np.float64) / 255.0
+    r, g, b = x.T
+    return np.column_stack([x, x**2, r * g, r * b, g * b, np.ones(len(x))])
+
+
+FEATURES = {"linear": linear_features, "quadratic": quadratic_features}
+
+
+class RecursiveLeastSquares:
+    """Multi-output linear regression updated one batch of samples at a time.
+
+    Each :meth:`update` folds ``k`` new samples into the coefficients and the
+    inverse Gram matrix ``P`` with a rank-``k`` (Woodbury) update, costing
+    ``O(k * n_features**2)`` instead of a refit on every sample seen so far.
+    ``P`` also gives the uncertainty of each prediction, which a planner
+    can use to explore.
+
+    Parameters
+    ----------
+    n_features, n_outputs : int
+        Width of the inputs and outputs.
+    forgetting : float
+        Factor (at most 1) by which older samples are down-weighted on every
+        update, to track a drifting device; 1 weights all samples equally.
+    prior : float
+        Initial variance of the coefficients; large means an uninformative
+        prior, so the fit approaches ordinary least squares.
+
+    Examples
+    --------
+    >>> rng = np.random.default_rng(0)
+    >>> X, coef = rng.random((20, 3)), np.array([[1.0], [2.0], [3.0]])
+    >>> model = RecursiveLeastSquares(3, 1)
+    >>> for start in range(0, 20, 5):
+    ...     model.update(X[start : start + 5], X[start : start + 5] @ coef)
+    >>> np.round(model.coef.ravel(), 4)
+    array([1., 2., 3.])
+    """
+
+    def __init__(self, n_features, n_outputs, forgetting=1.0, prior=1e6):
+        if not 0 < forgetting <= 1:
+            raise ValueError(f"forgetting must be in (0, 1], got {forgetting}")
+        self.forgetting = forgetting
+        self.coef = np.zeros((n_features, n_outputs))
+        self.P = np.eye(n_features) * prior
+        self.n_samples = 0
+        self._sse = 0.0  # residual sum of squares, for the noise level
+
+    @property
+    def noise_variance(self):
+        """Residual variance per output, estimated from the samples so far."""
+        dof = self.n_samples - len(self.coef)
+        if dof <= 0:
+            return 1.0
+        return self._sse / (dof * self.coef.shape[1])
+
+    def update(self, X, Y):
+        """Fold samples ``X`` (``(k, n_features)``) and ``Y`` into the fit."""
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        Y = np.asarray(Y, dtype=np.float64).reshape(len(X), -1)
+        PXt = self.P @ X.T
+        S = self.forgetting * np.eye(len(X)) + X @ PXt
+        gain = np.linalg.solve(S, PXt.T).T  # (n_features, k)
+        self.coef += gain @ (Y - X @ self.coef)
+        P = (self.P - gain @ PXt.T) / self.forgetting
+        self.P = (P + P.T) / 2  # keep it symmetric despite rounding
+        self._sse = self.forgetting * self._sse + float(
+            np.sum((Y - X @ self.coef) ** 2)
+        )
+        self.n_samples += len(X)
+
+    def predict(self, X, return_std=False):
+        """Predicted outputs, and optionally their standard deviation per row."""
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        mean = X @ self.coef
+        if not return_std:
+            return mean
+        variance = np.einsum("ij,jk,ik->i", X, self.P, X) * self.noise_variance
+        return mean, np.sqrt(np.maximum(variance, 0.0))
@@ -1,2 +1,42 @@
 """Mock function that  gets installed by requirements.txt"""
 from communication._communication import hivemq_communication
+from communication._session import (
+    MQTTSession,
+    get_session,
+    close_sessions,
+    env_port,
+    env_tls,
+    env_qos,
+    tls_context,
+)
+from communication._reconnect import ResilientClient, Backoff
+from communication._replay import (
+    TransportRecorder,
+    LogEntry,
+    read_log,
+    Replayer,
+    ReplayError,
+    ReplaySession,
+    ReplayClient,
+    create_client,
+    env_recorder,
+    env_replayer,
+)
+from communication._dedup import DedupCache
+from communication._result_cache import ResultCache, canonical_command
+from communication._fleet import FleetScheduler, Device, device_topics, status_topic
+from communication._multiplexer import RequestMultiplexer, get_multiplexer
+from communication._batch import run_batch, iter_batch
+from communication._aio import AsyncOrchestratorClient, MessageQueue
+from communication._codec import (
+    encode_payload,
+    decode_payload,
+    encode_result,
+    decode_result,
+    is_binary,
+    encode_batch,
+    decode_batch,
+    encode_commands,
+    decode_results,
+    unpack_batch,
+)
@@ -0,0 +1,410 @@
+import asyncio
+import json
+import logging
+from time import perf_counter
+
+from paho.mqtt import client as mqtt_client
+
+from communication._codec import decode_results, encode_commands
+from communication._dedup import DedupCache
+from communication._paho import client_kwargs
+from communication._session import tls_context
+from communication._instrument import (
+    record_reply,
+    record_timeout,
+    in_flight,
+    queue_depth,
+)
+from metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+
+class MessageQueue:
+    """Async-iterable queue of ``(topic, msg, retained)`` tuples.
+
+    Mirrors the ``client.queue`` interface of ``mqtt_as``: ``topic`` and
+    ``msg`` are bytes, and when ``maxsize`` is reached the oldest message is
+    discarded (and counted in ``discards``) rather than blocking the network.
+    """
+
+    def __init__(self, maxsize=0):
+        self._queue = asyncio.Queue()
+        self.maxsize = maxsize
+        self.discards = 0
+
+    def put_nowait(self, item):
+        if self.maxsize and self._queue.qsize() >= self.maxsize:
+            self._queue.get_nowait()
+            self.discards += 1
+        self._queue.put_nowait(item)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+
+class AsyncOrchestratorClient:
+    """asyncio-native orchestrator client driven from the event loop.
+
+    paho's socket is registered with the running loop (``add_reader`` and
+    ``add_writer``) instead of being serviced by a background thread, and
+    replies are routed by ``experiment_id`` to per-request futures. A single
+    loop can therefore keep thousands of experiments in flight without a
+    thread per wait. The interface follows ``mqtt_as.MQTTClient``: an ``up``
+    event that is set on every (re)connection and a ``queue`` of
+    ``(topic, msg, retained)`` tuples for messages no request is waiting for.
+
+    Parameters
+    ----------
+    subscribe_topic : str
+        Topic the sensor data arrives on, e.g. ``f"{course_id}/as7341"``.
+    host : str
+        Hostname of the MQTT broker.
+    username, password : str, optional
+        Broker credentials.
+    port : int
+        Broker port, 8883 for HiveMQ Cloud.
+    tls : bool
+        Whether to enable TLS.
+    queue_len : int
+        Maximum length of ``queue`` (0 for unbounded).
+    keepalive : int
+        MQTT keepalive interval in seconds.
+    qos : int
+        Default QoS for the sensor topic subscription and for commands. At
+        QoS 0 or 1 a reply redelivered after its request completed is
+        dropped (and counted in ``duplicates``) instead of being queued.
+
+    Examples
+    --------
+    >>> async def main():  # doctest: +SKIP
+    ...     async with AsyncOrchestratorClient(
+    ...         as7341_topic, host, username, password
+    ...     ) as client:
+    ...         results = await asyncio.gather(
+    ...             *(client.send_and_receive(neopixel_topic, p) for p in payload_dicts)
+    ...         )
+    """
+
+    def __init__(
+        self,
+        subscribe_topic,
+        host,
+        username=None,
+        password=None,
+        port=8883,
+        tls=True,
+        queue_len=0,
+        keepalive=60,
+        qos=2,
+    ):
+        self.subscribe_topic = subscribe_topic
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.qos = qos
+        self.up = asyncio.Event()
+        self.queue = MessageQueue(queue_len)
+        self.duplicates = 0
+
+        self._loop = None
+        self._pending = {}  # experiment id -> Future
+        self._completed = DedupCache()  # experiment ids already answered
+        self._sent_at = {}  # experiment id -> perf_counter() at publish
+        self._acks = {}  # mid -> Future
+        self._early_acks = None  # while sending, mids acknowledged meanwhile
+        self._connect_future = None
+        self._misc_task = None
+        self._reconnect_task = None
+        self._closing = False
+
+        self._client = mqtt_client.Client(**client_kwargs())
+        self._client.username_pw_set(username, password)
+        if tls:
+            self._client.tls_set_context(tls_context())
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message = self._on_message
+        self._client.on_publish = self._on_ack
+        self._client.on_subscribe = self._on_subscribe
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = self._on_socket_register_write
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _call_in_loop(self, callback, *args):
+        # Socket callbacks also fire from the executor thread that runs the
+        # blocking connect, and must then hand the work over to the loop
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call_in_loop(self._loop.add_reader, sock, self._read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call_in_loop(self._loop.remove_reader, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call_in_loop(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call_in_loop(self._loop.remove_writer, sock)
+
+    def _read(self):
+        self._client.loop_read()
+        # TLS may have decrypted more than one packet, which select can't see
+        sock = self._client.socket()
+        while sock is not None and getattr(sock, "pending", lambda: 0)():
+            self._client.loop_read()
+
+    async def _misc_loop(self):
+        while self._client.loop_misc() == mqtt_client.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        future = self._connect_future
+        if rc != 0:
+            if future is not None and not future.done():
+                future.set_exception(
+                    ConnectionError(f"Connection to {self.host} refused with result code {rc}")  # noqa: E501
+                )
+            return
+        client.subscribe(self.subscribe_topic, qos=self.qos)
+        if self._misc_task is None or self._misc_task.done():
+            self._misc_task = self._loop.create_task(self._misc_loop())
+        self.up.set()
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.up.clear()
+        if not self._closing and self._reconnect_task is None:
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+
+    async def _reconnect(self, max_delay=30):
+        delay = 1
+        try:
+            while not self._closing:
+                await asyncio.sleep(delay)
+                try:
+                    await self._loop.run_in_executor(None, self._client.reconnect)
+                    return
+                except OSError as e:
+                    logger.warning("Reconnecting to %s failed: %s", self.host, e)
+                    delay = min(delay * 2, max_delay)
+        finally:
+            self._reconnect_task = None
+
+    def _on_ack(self, client, userdata, mid):
+        future = self._acks.pop(mid, None)
+        if future is None:
+            # acks nobody waits for (e.g. the subscription on connecting)
+            # are dropped, so a reused mid can't match a stale one
+            if self._early_acks is not None:
+                self._early_acks.add(mid)
+        elif not future.done():
+            future.set_result(mid)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        self._on_ack(client, userdata, mid)
+
+    def _on_message(self, client, userdata, message):
+        topic = message.topic.encode()
+        try:
+            replies = decode_results(message.payload)
+        except (ValueError, TypeError):
+            replies = []
+        unclaimed = []
+        for reply in replies:
+            experiment_id = (
+                reply.get("experiment_id") if isinstance(reply, dict) else None
+            )
+            future = self._pending.pop(experiment_id, None)
+            if future is not None:
+                self._completed.add(experiment_id)
+                in_flight().dec()
+                record_reply(experiment_id, perf_counter() - self._sent_at.pop(experiment_id))  # noqa: E501
+                if not future.done():
+                    future.set_result(reply)
+            elif experiment_id is not None and experiment_id in self._completed:
+                self.duplicates += 1
+            else:
+                unclaimed.append(reply)
+        if not unclaimed and replies:
+            return
+        if len(unclaimed) == len(replies):
+            self.queue.put_nowait((topic, message.payload, message.retain))
+        else:
+            # only part of a batch was claimed; queue the rest one by one
+            for reply in unclaimed:
+                self.queue.put_nowait((topic, json.dumps(reply).encode(), message.retain))  # noqa: E501
+        queue_depth().set(self.queue.qsize())
+
+    def _send(self, send, *args, **kwargs):
+        # paho may acknowledge a message from within publish() (QoS 0, when
+        # it can be written straight away), before its mid is known to wait
+        # on. Returns send's result and the mids acknowledged meanwhile
+        self._early_acks = set()
+        try:
+            return send(*args, **kwargs), self._early_acks
+        finally:
+            self._early_acks = None
+
+    async def _wait_for_ack(self, mid, early_acks):
+        if mid in early_acks:
+            return
+        future = self._loop.create_future()
+        self._acks[mid] = future
+        try:
+            await future
+        finally:
+            self._acks.pop(mid, None)
+
+    async def connect(self, timeout=10):
+        """Connect (TLS handshake off the loop) and subscribe to the sensor topic."""
+        self._loop = asyncio.get_running_loop()
+        self._closing = False
+        self._connect_future = self._loop.create_future()
+        start = perf_counter()
+        await self._loop.run_in_executor(
+            None, self._client.connect, self.host, self.port, self.keepalive
+        )
+        await asyncio.wait_for(self._connect_future, timeout)
+        get_registry().histogram(
+            "mqtt_connect_seconds", "Time from connect() to CONNACK"
+        ).record(perf_counter() - start)
+        return self
+
+    async def subscribe(self, topic, qos=2):
+        (_, mid), early_acks = self._send(self._client.subscribe, topic, qos=qos)
+        await self._wait_for_ack(mid, early_acks)
+
+    async def publish(self, topic, payload, qos=2, retain=False):
+        """Publish and wait until the broker has acknowledged the message."""
+        start = perf_counter()
+        info, early_acks = self._send(
+            self._client.publish, topic, payload, qos=qos, retain=retain
+        )
+        if info.rc != mqtt_client.MQTT_ERR_SUCCESS:
+            raise ConnectionError(f"Publish to {topic} failed: {mqtt_client.error_string(info.rc)}")  # noqa: E501
+        await self._wait_for_ack(info.mid, early_acks)
+        get_registry().histogram(
+            "mqtt_publish_ack_seconds", "Time from publish to PUBACK/PUBCOMP"
+        ).record(perf_counter() - start)
+
+    def _track(self, experiment_ids, futures):
+        sent_at = perf_counter()
+        for experiment_id, future in zip(experiment_ids, futures):
+            self._pending[experiment_id] = future
+            self._sent_at[experiment_id] = sent_at
+        in_flight().inc(len(futures))
+
+    def _untrack(self, experiment_ids, futures):
+        for experiment_id, future in zip(experiment_ids, futures):
+            if self._pending.get(experiment_id) is future:
+                del self._pending[experiment_id]
+                del self._sent_at[experiment_id]
+                in_flight().dec()
+
+    async def _publish_then_wait(self, command_topic, payload, qos, replies):
+        await self.publish(command_topic, payload, qos=self.qos if qos is None else qos)
+        return await replies
+
+    async def send_and_receive(
+        self, command_topic, payload_dict, timeout=30, qos=None
+    ):
+        """Publish ``payload_dict`` and return the reply with its experiment_id.
+
+        ``timeout`` covers the acknowledgement of the command as well as the
+        reply. Cancelling the call (or hitting ``timeout``) forgets the
+        request, so a reply arriving afterwards lands in ``queue`` instead.
+        """
+        experiment_id = payload_dict["experiment_id"]
+        if experiment_id in self._pending:
+            raise ValueError(f"Request {experiment_id} is already in flight")
+        future = self._loop.create_future()
+        self._track([experiment_id], [future])
+        try:
+            return await asyncio.wait_for(
+                self._publish_then_wait(
+                    command_topic, json.dumps(payload_dict), qos, future
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            record_timeout()
+            raise TimeoutError(
+                f"Sensor data retrieval timed out ({timeout} seconds)"
+            ) from None
+        finally:
+            self._untrack([experiment_id], [future])
+
+    async def send_and_receive_batch(
+        self, command_topic, payload_dicts, timeout=30, qos=None
+    ):
+        """Publish ``payload_dicts`` as one batch and return their replies.
+
+        Replies are returned in the order of ``payload_dicts``; a
+        :class:`TimeoutError` is raised unless the batch is acknowledged and
+        all of them arrive within ``timeout``.
+        """
+        experiment_ids = [p["experiment_id"] for p in payload_dicts]
+        if len(set(experiment_ids)) != len(experiment_ids):
+            raise ValueError("Duplicate experiment_id in batch")
+        for experiment_id in experiment_ids:
+            if experiment_id in self._pending:
+                raise ValueError(f"Request {experiment_id} is already in flight")
+        futures = [self._loop.create_future() for _ in experiment_ids]
+        self._track(experiment_ids, futures)
+        try:
+            return await asyncio.wait_for(
+                self._publish_then_wait(
+                    command_topic,
+                    encode_commands(payload_dicts),
+                    qos,
+                    asyncio.gather(*futures),
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            record_timeout(sum(not f.done() or f.cancelled() for f in futures))
+            raise TimeoutError(
+                f"Sensor data retrieval timed out ({timeout} seconds)"
+            ) from None
+        finally:
+            self._untrack(experiment_ids, futures)
+
+    async def results(self):
+        """Iterate over sensor data not claimed by :meth:`send_and_receive`."""
+        async for topic, msg, retained in self.queue:
+            try:
+                for results_dict in decode_results(msg):
+                    yield results_dict
+            except ValueError:
+                logger.debug("Skipping undecodable message on %s", topic)
+
+    async def close(self):
+        self._closing = True
+        for task in (self._misc_task, self._reconnect_task):
+            if task is not None:
+                task.cancel()
+        self._client.disconnect()
+        self.up.clear()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
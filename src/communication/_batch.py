@@ -0,0 +1,203 @@
+import logging
+from collections import OrderedDict
+from queue import Empty
+from time import monotonic
+
+from paho.mqtt import client as mqtt_client
+
+from communication._codec import decode_results, encode_commands, unpack_batch
+from communication._instrument import (
+    record_reply,
+    record_timeout,
+    in_flight as in_flight_gauge,
+    queue_depth,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def iter_batch(
+    client,
+    queue,
+    command_topic,
+    payload_dicts,
+    window=16,
+    queue_timeout=30,
+    qos=2,
+    batch_size=1,
+    cache=None,
+):
+    """Yield ``(index, results_dict)`` pairs in the order results arrive.
+
+    Like :func:`run_batch`, but ``payload_dicts`` may be any iterable (it is
+    consumed lazily, ``window`` commands ahead) and nothing is accumulated,
+    so arbitrarily long campaigns run in constant memory. Experiments that
+    time out, or whose command could not be published, are yielded as
+    ``(index, None)``. Commands found in ``cache`` (a :class:`ResultCache`)
+    are yielded straight away without being sent.
+    Latencies, timeouts, commands in flight and the depth of ``queue`` are
+    recorded in the :mod:`metrics` registry.
+    """
+    if window < 1:
+        raise ValueError(f"window must be at least 1, got {window}")
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+
+    payload_dicts = iter(payload_dicts)
+    in_flight = OrderedDict()  # experiment id -> (index, deadline), oldest first
+    next_index = 0
+    exhausted = False
+
+    # Leave the network loop running afterwards if the caller started it
+    # (paho 1.x returns None rather than MQTT_ERR_SUCCESS on starting it)
+    started_loop = client.loop_start() != mqtt_client.MQTT_ERR_INVAL
+    try:
+        while not exhausted or in_flight:
+            while not exhausted and len(in_flight) < window:
+                batch = []
+                while len(batch) < batch_size and len(in_flight) < window:
+                    payload_dict = next(payload_dicts, None)
+                    if payload_dict is None:
+                        exhausted = True
+                        break
+                    experiment_id = payload_dict["experiment_id"]
+                    if experiment_id in in_flight:
+                        raise ValueError(f"Duplicate experiment_id {experiment_id}")
+                    cached = cache.lookup(payload_dict) if cache is not None else None
+                    if cached is not None:
+                        yield next_index, cached
+                        next_index += 1
+                        continue
+                    in_flight[experiment_id] = (next_index, monotonic() + queue_timeout)
+                    in_flight_gauge().inc()
+                    batch.append(payload_dict)
+                    next_index += 1
+                if not batch:
+                    continue
+                info = client.publish(command_topic, encode_commands(batch), qos=qos)
+                if info.rc != mqtt_client.MQTT_ERR_SUCCESS:
+                    # not sent (e.g. disconnected), so no reply is coming
+                    logger.warning(
+                        "Publishing %d command(s) failed: %s",
+                        len(batch),
+                        mqtt_client.error_string(info.rc),
+                    )
+                    for payload_dict in batch:
+                        index, _ = in_flight.pop(payload_dict["experiment_id"])
+                        in_flight_gauge().dec()
+                        yield index, None
+
+            # Deadlines are in publish order, so the oldest expires first
+            now = monotonic()
+            for experiment_id, (index, deadline) in list(in_flight.items()):
+                if deadline > now:
+                    break
+                del in_flight[experiment_id]
+                in_flight_gauge().dec()
+                record_timeout()
+                logger.warning(
+                    "Sensor data for %s timed out (%s seconds)",
+                    experiment_id,
+                    queue_timeout,
+                )
+                yield index, None
+            if not in_flight:
+                continue
+
+            _, deadline = next(iter(in_flight.values()))
+            try:
+                message = queue.get(True, timeout=max(deadline - monotonic(), 0))
+            except Empty:
+                continue
+            queue_depth().set(queue.qsize())
+
+            # Results already answered (e.g. redelivered at QoS 0/1) are no
+            # longer in flight, so duplicates are dropped here
+            for result in _unpack(message):
+                if not isinstance(result, dict):
+                    continue
+                if result.get("experiment_id") not in in_flight:
+                    continue
+                index, deadline = in_flight.pop(result["experiment_id"])
+                in_flight_gauge().dec()
+                record_reply(result["experiment_id"], monotonic() - (deadline - queue_timeout))  # noqa: E501
+                if cache is not None:
+                    cache.store(result)
+                yield index, result
+    finally:
+        in_flight_gauge().dec(len(in_flight))
+        if started_loop:
+            client.loop_stop()
+
+
+def _unpack(message):
+    # The queue may hold decoded dictionaries, batches included, or raw
+    # payloads (JSON or the packed binary format)
+    if isinstance(message, (bytes, bytearray, str)):
+        return decode_results(message)
+    return unpack_batch(message)
+
+
+def run_batch(
+    client,
+    queue,
+    command_topic,
+    payload_dicts,
+    window=16,
+    queue_timeout=30,
+    qos=2,
+    batch_size=1,
+    cache=None,
+):
+    """Run many experiments with up to ``window`` commands in flight at once.
+
+    Commands are published as earlier ones complete, and results are matched
+    to commands by ``experiment_id`` as they arrive on ``queue`` (e.g. the
+    queue returned by ``orchestrator_client.get_client_and_queue``). A sweep
+    therefore takes roughly ``len(payload_dicts) / window`` round trips rather
+    than one round trip per command.
+
+    Parameters
+    ----------
+    client : paho.mqtt.client.Client
+        Connected client that ``queue`` is being filled from.
+    queue : queue.Queue
+        Queue receiving the sensor data, as dictionaries (``{"batch": [...]}``
+        included) or as the raw message payloads.
+    command_topic : str
+        Topic to publish the commands to.
+    payload_dicts : list of dict
+        Payload dictionaries, each with a unique ``experiment_id``.
+    window : int
+        Maximum number of commands awaiting results.
+    queue_timeout : float
+        Seconds to wait for each result after its command was published.
+    qos : int
+        QoS to publish the commands with.
+    batch_size : int
+        Maximum number of commands sent together in one ``{"batch": [...]}``
+        message. Batching amortises the per-message broker and network cost
+        when each experiment is cheap.
+    cache : ResultCache, optional
+        Cache answering repeated commands without an MQTT round trip.
+
+    Returns
+    -------
+    list
+        The results dictionaries in the order of ``payload_dicts``, with
+        ``None`` for experiments that timed out or could not be sent.
+    """
+    results = [None] * len(payload_dicts)
+    for index, result in iter_batch(
+        client,
+        queue,
+        command_topic,
+        payload_dicts,
+        window=window,
+        queue_timeout=queue_timeout,
+        qos=qos,
+        batch_size=batch_size,
+        cache=cache,
+    ):
+        results[index] = result
+    return results
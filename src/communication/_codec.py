@@ -0,0 +1,161 @@
+import json
+import numbers
+import struct
+
+# Packed binary layout of a sensor data message (little-endian):
+#
+#   version (B) | message type (B) | R, G, B (3B) | id length (B)
+#   | ch410 ... ch670 (8f) | experiment id (ASCII)
+#
+# The leading version byte can never start a JSON document, so JSON and
+# binary messages can share a topic and be told apart by their first byte.
+#
+# A batch of results is sent as
+#
+#   version (B) | message type (B) | count (H) | count result messages
+#
+# and in JSON as {"batch": [results_dict, ...]}; commands are batched the
+# same way, as {"batch": [payload_dict, ...]}.
+WIRE_VERSION = 1
+RESULT_MESSAGE = 1
+BATCH_MESSAGE = 2
+CHANNELS = ("ch410", "ch440", "ch470", "ch510", "ch550", "ch583", "ch620", "ch670")
+RESULT_HEADER = struct.Struct("<BBBBBB8f")
+BATCH_HEADER = struct.Struct("<BBH")
+BATCH_KEY = "batch"
+
+JSON_ENCODING = "json"
+BINARY_ENCODING = "binary"
+
+
+def encode_result(results_dict):
+    """Pack a results dictionary into the binary wire format.
+
+    Raises ``ValueError`` if it doesn't fit: R, G and B must be integers from
+    0 to 255, and the experiment id at most 255 bytes long.
+
+    Examples
+    --------
+    >>> payload = encode_result(
+    ...     {
+    ...         "command": {"R": 255, "G": 0, "B": 0},
+    ...         "experiment_id": "abc123",
+    ...         "sensor_data": dict.fromkeys(CHANNELS, 1.5),
+    ...     }
+    ... )
+    >>> len(payload)
+    44
+    """
+    command = results_dict["command"]
+    sensor_data = results_dict["sensor_data"]
+    experiment_id = results_dict["experiment_id"].encode()
+    for key in ("R", "G", "B"):
+        value = command[key]
+        if not isinstance(value, numbers.Integral) or not 0 <= value <= 255:
+            raise ValueError(
+                f"{key} must be an integer from 0 to 255 to be sent as binary, not {value!r}"  # noqa: E501
+            )
+    if len(experiment_id) > 255:
+        raise ValueError(
+            f"Experiment ids sent as binary are at most 255 bytes, not {len(experiment_id)}"  # noqa: E501
+        )
+    header = RESULT_HEADER.pack(
+        WIRE_VERSION,
+        RESULT_MESSAGE,
+        command["R"],
+        command["G"],
+        command["B"],
+        len(experiment_id),
+        *(sensor_data[ch] for ch in CHANNELS),
+    )
+    return header + experiment_id
+
+
+def is_binary(payload):
+    return isinstance(payload, (bytes, bytearray)) and payload[:1] == bytes(
+        [WIRE_VERSION]
+    )
+
+
+def decode_result(payload):
+    """Unpack a binary sensor data message into a results dictionary.
+
+    Sensor data are sent as 32-bit floats, so values agree with the JSON
+    encoding to about 7 significant digits.
+    """
+    version, message_type, R, G, B, id_length, *values = RESULT_HEADER.unpack_from(
+        payload
+    )
+    if version != WIRE_VERSION or message_type != RESULT_MESSAGE:
+        raise ValueError(f"Unsupported message (version {version}, type {message_type})")  # noqa: E501
+    experiment_id = bytes(payload[RESULT_HEADER.size : RESULT_HEADER.size + id_length])
+    return {
+        "command": {"R": R, "G": G, "B": B},
+        "experiment_id": experiment_id.decode(),
+        "sensor_data": dict(zip(CHANNELS, values)),
+    }
+
+
+def decode_batch(payload):
+    """Unpack a binary batch message into a list of results dictionaries."""
+    version, message_type, count = BATCH_HEADER.unpack_from(payload)
+    if version != WIRE_VERSION or message_type != BATCH_MESSAGE:
+        raise ValueError(f"Unsupported message (version {version}, type {message_type})")  # noqa: E501
+    results_dicts = []
+    offset = BATCH_HEADER.size
+    for _ in range(count):
+        end = offset + RESULT_HEADER.size + payload[offset + 5]
+        results_dicts.append(decode_result(payload[offset:end]))
+        offset = end
+    return results_dicts
+
+
+def decode_payload(payload):
+    """Decode a message that is either JSON or in the binary wire format.
+
+    Binary batches are returned as ``{"batch": [...]}``, like JSON batches.
+    """
+    if is_binary(payload):
+        if payload[1] == BATCH_MESSAGE:
+            return {BATCH_KEY: decode_batch(payload)}
+        return decode_result(payload)
+    return json.loads(payload)
+
+
+def unpack_batch(message):
+    """Return the list of dictionaries carried by a decoded message."""
+    if isinstance(message, dict) and BATCH_KEY in message:
+        return message[BATCH_KEY]
+    return [message]
+
+
+def decode_results(payload):
+    """Decode a single or batched message into a list of dictionaries."""
+    return unpack_batch(decode_payload(payload))
+
+
+def encode_payload(results_dict, encoding=JSON_ENCODING):
+    """Encode a results dictionary as JSON (default) or packed binary."""
+    if encoding == BINARY_ENCODING:
+        return encode_result(results_dict)
+    if encoding != JSON_ENCODING:
+        raise ValueError(f"Unknown encoding {encoding!r}")
+    return json.dumps(results_dict)
+
+
+def encode_commands(payload_dicts):
+    """Encode commands as one message, batched if there is more than one."""
+    if len(payload_dicts) == 1:
+        return json.dumps(payload_dicts[0])
+    return json.dumps({BATCH_KEY: list(payload_dicts)})
+
+
+def encode_batch(results_dicts, encoding=JSON_ENCODING):
+    """Encode several results dictionaries as one batched message."""
+    if encoding == BINARY_ENCODING:
+        return BATCH_HEADER.pack(WIRE_VERSION, BATCH_MESSAGE, len(results_dicts)) + b"".join(  # noqa: E501
+            encode_result(results_dict) for results_dict in results_dicts
+        )
+    if encoding != JSON_ENCODING:
+        raise ValueError(f"Unknown encoding {encoding!r}")
+    return json.dumps({BATCH_KEY: results_dicts})
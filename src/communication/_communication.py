@@ -1,59 +1,88 @@
-import os
-from paho.mqtt import client as mqtt_client
-import threading
-
 import json
-
-username_key = "HIVEMQ_USERNAME"
-password_key = "HIVEMQ_PASSWORD"
-host_key = "HIVEMQ_HOST"
-
-
-def hivemq_communication(outgoing_message, subscribe_topic, publish_topic):
-    broker = os.environ[host_key]
-    username = os.environ[username_key]
-    password = os.environ[password_key]
-    # print(f"Connecting to {broker} with username {username} and password {password}")
-
-    received_messages = []  # avoid using nonlocal by using mutable data structure
-    message_received_event = threading.Event()
-    connected_event = threading.Event()
-
-    def on_connect(client, userdata, flags, rc):
-        client.subscribe(subscribe_topic, qos=2)
-        connected_event.set()
-
-    def on_message(client, userdata, message):
-        received_message = json.loads(message.payload)
-        received_messages.append(received_message)
-        message_received_event.set()
-
-    client = mqtt_client.Client()
-    client.username_pw_set(username, password)
-    client.on_connect = on_connect
-    client.on_message = on_message
-
-    client.tls_set(
-        tls_version=mqtt_client.ssl.PROTOCOL_TLS_CLIENT
-    )  # Enable TLS with specific version
-    client.connect(broker, port=8883)  # Connect to the broker on port 8883
-    client.loop_start()
-
-    connected_event.wait(timeout=10)  # Wait for the connection to be established
-
-    client.publish(publish_topic, outgoing_message, qos=2)
-
-    message_received_event.wait(timeout=20)  # Wait for the message to be received
-
-    if not message_received_event.is_set():
-        raise TimeoutError("No message received within the specified timeout")
-
-    client.loop_stop()
-
-    assert (
-        len(received_messages) == 1
-    ), f"Expected 1 message, got {len(received_messages)}"
-    received_message = received_messages[0]
+from queue import Queue, Empty
+
+from communication._session import (  # noqa: F401
+    get_session,
+    username_key,
+    password_key,
+    host_key,
+    port_key,
+    tls_key,
+    qos_key,
+    env_qos,
+)
+from communication._multiplexer import get_multiplexer
+from communication._codec import decode_payload
+from communication._instrument import record_timeout
+
+
+def hivemq_communication(
+    outgoing_message,
+    subscribe_topic,
+    publish_topic,
+    timeout=20,
+    session=None,
+    qos=None,
+    cache=None,
+):
+    """Publish ``outgoing_message`` and return the reply to it.
+
+    The message is sent through a pooled :class:`MQTTSession` (see
+    :func:`get_session`), so only the first call per broker pays for the TLS
+    handshake and the subscription; later calls cost one publish plus one
+    receive.
+
+    If ``outgoing_message`` is a JSON object with an ``experiment_id``, the
+    reply with the same ``experiment_id`` is returned (see
+    :class:`RequestMultiplexer`), so concurrent calls on the same topics do
+    not steal each other's replies. Otherwise the next message received on
+    ``subscribe_topic`` is returned.
+
+    ``qos`` defaults to ``MQTT_QOS`` (see :func:`env_qos`). At QoS 0 or 1,
+    duplicate replies are dropped by ``experiment_id``.
+
+    With a :class:`ResultCache` as ``cache``, a command measured before is
+    answered from the cache without contacting the device, and new replies
+    are added to it.
+
+    Connect, publish and reply latencies and timeouts are recorded in the
+    :mod:`metrics` registry; see :func:`metrics.write_metrics` to export them.
+    """
+    if session is None:
+        session = get_session()
+    if qos is None:
+        qos = env_qos()
+
+    try:
+        payload_dict = json.loads(outgoing_message)
+    except ValueError:
+        payload_dict = None
+    if isinstance(payload_dict, dict) and "experiment_id" in payload_dict:
+        if cache is not None:
+            cached = cache.lookup(payload_dict)
+            if cached is not None:
+                return cached
+        multiplexer = get_multiplexer(session, subscribe_topic, publish_topic, qos=qos)
+        reply = multiplexer.request(payload_dict, timeout=timeout, payload=outgoing_message)
+        if cache is not None:
+            cache.store(reply)
+        return reply
+
+    received_messages = Queue()
+
+    def on_message(message):
+        received_messages.put(decode_payload(message.payload))
+
+    session.subscribe(subscribe_topic, on_message, qos=qos)
+    try:
+        session.publish(publish_topic, outgoing_message, qos=qos)
+        try:
+            received_message = received_messages.get(timeout=timeout)
+        except Empty:
+            record_timeout()
+            raise TimeoutError("No message received within the specified timeout")
+    finally:
+        session.remove_handler(subscribe_topic, on_message)
 
     return received_message
 
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class DedupCache:
+    """Bounded, expiring record of recently seen ids.
+
+    QoS 0 and 1 trade delivery guarantees for throughput: QoS 1 may deliver a
+    message more than once, and a sender retrying after a lost QoS 0 message
+    may do the same. Remembering the ``experiment_id`` of each command run or
+    result accepted turns that into effectively-once processing, without
+    the extra round trip of QoS 2.
+
+    At most ``maxsize`` ids are kept, each for at most ``ttl`` seconds, so a
+    long campaign runs in constant memory. Values can be attached to ids
+    (e.g. the state of a finished request).
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of ids remembered; the oldest are forgotten first.
+    ttl : float or None
+        Seconds an id is remembered for, or ``None`` to keep ids until they
+        are pushed out by ``maxsize``.
+    clock : callable
+        Returns the current time in seconds.
+
+    Examples
+    --------
+    >>> seen = DedupCache(maxsize=2)
+    >>> seen.add("a"), seen.add("a"), seen.add("b"), seen.add("c"), seen.add("a")
+    (True, False, True, True, True)
+    """
+
+    def __init__(self, maxsize=10000, ttl=600, clock=monotonic):
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be at least 1, got {maxsize}")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # id -> (expiry, value), oldest first
+
+    def _expire(self, now):
+        if self.ttl is None:
+            return
+        while self._entries:
+            expiry, _ = next(iter(self._entries.values()))
+            if expiry > now:
+                break
+            self._entries.popitem(last=False)
+
+    def add(self, key, value=True):
+        """Remember ``key``; return ``False`` if it was already known."""
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            if key in self._entries:
+                self.duplicates += 1
+                return False
+            expiry = now + self.ttl if self.ttl is not None else None
+            self._entries[key] = (expiry, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._expire(self.clock())
+            entry = self._entries.get(key)
+        return default if entry is None else entry[1]
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        with self._lock:
+            self._expire(self.clock())
+            return len(self._entries)
@@ -0,0 +1,310 @@
+import threading
+import logging
+from collections import deque
+from queue import Queue, Empty
+from time import monotonic
+
+from communication._multiplexer import get_multiplexer
+
+logger = logging.getLogger(__name__)
+
+ONLINE = "online"
+OFFLINE = "offline"
+
+
+def device_topics(course_id, device_id=None):
+    """Return the ``(command_topic, sensor_data_topic)`` pair of a device.
+
+    Without a ``device_id`` these are the single-device topics
+    ``{course_id}/neopixel`` and ``{course_id}/as7341``.
+
+    Examples
+    --------
+    >>> device_topics("my-course", "pico-3")
+    ('my-course/pico-3/neopixel', 'my-course/pico-3/as7341')
+    """
+    prefix = course_id if device_id is None else f"{course_id}/{device_id}"
+    return f"{prefix}/neopixel", f"{prefix}/as7341"
+
+
+def status_topic(course_id, device_id="+"):
+    """Topic a device announces itself on (retained ``online``/``offline``)."""
+    return f"{course_id}/devices/{device_id}"
+
+
+class Device:
+    """Load and health of one device as seen by :class:`FleetScheduler`."""
+
+    def __init__(self, device_id, command_topic, sensor_data_topic, multiplexer):
+        self.device_id = device_id
+        self.command_topic = command_topic
+        self.sensor_data_topic = sensor_data_topic
+        self.multiplexer = multiplexer
+        self.jobs = deque()  # jobs assigned to this device but not yet sent
+        self.in_flight = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.consecutive_failures = 0
+        self.online = True
+        self.unhealthy_until = 0.0
+
+    def healthy(self, now):
+        return self.online and now >= self.unhealthy_until
+
+    def __repr__(self):
+        return (
+            f"Device({self.device_id!r}, in_flight={self.in_flight}, "
+            f"completed={self.completed}, timeouts={self.timeouts})"
+        )
+
+
+class _Job:
+    __slots__ = ("index", "payload_dict", "attempts", "tried")
+
+    def __init__(self, index, payload_dict):
+        self.index = index
+        self.payload_dict = payload_dict
+        self.attempts = 0
+        self.tried = set()  # ids of devices that timed out on this job
+
+
+class FleetScheduler:
+    """Spread experiments over several devices, each on its own topic pair.
+
+    Devices are registered with :meth:`register` or, with ``discover=True``,
+    found from the retained ``online`` messages they publish on
+    ``{course_id}/devices/<device_id>``. Each device then has the topics
+    returned by :func:`device_topics`.
+
+    Experiments are dealt out round-robin into per-device queues and at most
+    ``window`` are in flight per device. A device that runs out of work
+    steals from the back of the longest queue, so fast boards pick up the
+    slack of slow ones. An experiment that gets no reply within ``timeout``
+    is retried on another device (up to ``max_retries`` times). A device that
+    fails ``max_failures`` times in a row is benched for ``cooldown``
+    seconds, and its queued work is stolen by the others. If no device can
+    take the remaining work for ``timeout`` seconds (e.g. all of them went
+    offline), it is given up on.
+
+    Parameters
+    ----------
+    session : MQTTSession
+        Connected session shared by all devices.
+    course_id : str
+        Topic prefix, as for the single-device topics.
+    window : int
+        Maximum number of experiments in flight per device.
+    timeout : float
+        Seconds to wait for a reply before retrying elsewhere.
+    max_retries : int
+        Number of times an experiment is re-sent before giving up on it.
+    max_failures : int
+        Consecutive timeouts after which a device is benched.
+    cooldown : float
+        Seconds a benched device is left alone.
+    qos : int
+        QoS for commands and replies.
+    discover : bool
+        Whether to register devices announcing themselves on the status topic.
+    """
+
+    def __init__(
+        self,
+        session,
+        course_id,
+        window=4,
+        timeout=30,
+        max_retries=2,
+        max_failures=3,
+        cooldown=30,
+        qos=2,
+        discover=True,
+    ):
+        self.session = session
+        self.course_id = course_id
+        self.window = window
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.qos = qos
+        self.devices = {}  # device id -> Device
+        self._lock = threading.Lock()
+        self._wakeup = Queue()  # finished futures and device announcements
+        if discover:
+            session.subscribe(status_topic(course_id), self._on_status, qos=qos)
+
+    def register(self, device_id, command_topic=None, sensor_data_topic=None):
+        """Add a device (idempotent) and return its :class:`Device`."""
+        default_command_topic, default_sensor_data_topic = device_topics(
+            self.course_id, device_id
+        )
+        command_topic = command_topic or default_command_topic
+        sensor_data_topic = sensor_data_topic or default_sensor_data_topic
+        # subscribes and waits for the broker, so not while holding the lock
+        multiplexer = get_multiplexer(
+            self.session, sensor_data_topic, command_topic, qos=self.qos
+        )
+        with self._lock:
+            device = self.devices.get(device_id)
+            if device is None:
+                device = Device(
+                    device_id, command_topic, sensor_data_topic, multiplexer
+                )
+                self.devices[device_id] = device
+            device.online = True
+        self._wakeup.put(None)
+        return device
+
+    def _on_status(self, message):
+        device_id = message.topic.rsplit("/", 1)[-1]
+        status = message.payload.decode(errors="replace")
+        if status == ONLINE:
+            # registering subscribes, which must not block the network thread
+            threading.Thread(
+                target=self.register, args=(device_id,), daemon=True
+            ).start()
+        elif status == OFFLINE:
+            with self._lock:
+                device = self.devices.get(device_id)
+                if device is not None:
+                    device.online = False
+            self._wakeup.put(None)
+
+    def _next_job(self, device):
+        if device.jobs:
+            return device.jobs.popleft()
+        # steal from the back of the longest queue of another device
+        victims = [d for d in self.devices.values() if d is not device and d.jobs]
+        if not victims:
+            return None
+        victim = max(victims, key=lambda d: len(d.jobs))
+        # don't steal a job this device already timed out on
+        for i in range(len(victim.jobs) - 1, -1, -1):
+            job = victim.jobs[i]
+            if device.device_id not in job.tried:
+                del victim.jobs[i]
+                return job
+        return None
+
+    def _assign(self, job, exclude=()):
+        now = monotonic()
+        devices = [
+            d
+            for d in self.devices.values()
+            if d.healthy(now) and d.device_id not in exclude
+        ] or [d for d in self.devices.values() if d.device_id not in exclude]
+        devices = devices or list(self.devices.values())
+        device = min(devices, key=lambda d: d.in_flight + len(d.jobs))
+        device.jobs.append(job)
+
+    def iter_results(self, payload_dicts):
+        """Yield ``(index, results_dict)`` pairs in the order results arrive.
+
+        Experiments that fail on every attempt, or that no device could take
+        for ``timeout`` seconds, are yielded as ``(index, None)``.
+        """
+        with self._lock:
+            if not self.devices:
+                raise RuntimeError(
+                    f"No devices registered for {self.course_id}; call register() or wait for discovery"  # noqa: E501
+                )
+            device_list = list(self.devices.values())
+        n_jobs = 0
+        for index, payload_dict in enumerate(payload_dicts):
+            device_list[index % len(device_list)].jobs.append(_Job(index, payload_dict))
+            n_jobs += 1
+
+        sent = {}  # future -> (job, device, deadline)
+        remaining = n_jobs
+        stalled_since = None  # when no device could take the queued jobs
+        while remaining:
+            now = monotonic()
+            with self._lock:
+                devices = list(self.devices.values())
+                for device in devices:
+                    while device.healthy(now) and device.in_flight < self.window:
+                        job = self._next_job(device)
+                        if job is None:
+                            break
+                        future = device.multiplexer.submit(job.payload_dict)
+                        job.attempts += 1
+                        device.in_flight += 1
+                        sent[future] = (job, device, now + self.timeout)
+                        future.add_done_callback(self._wakeup.put)
+                # with nothing in flight and no benched device to wait for,
+                # nobody can take the queued jobs (e.g. all devices offline)
+                stalled = not sent and not any(
+                    d.online and d.unhealthy_until > now for d in devices
+                )
+                given_up = []
+                if not stalled:
+                    stalled_since = None
+                elif stalled_since is None:
+                    stalled_since = now
+                elif now - stalled_since >= self.timeout:
+                    for device in devices:
+                        given_up.extend(device.jobs)
+                        device.jobs.clear()
+            if given_up:
+                logger.warning(
+                    "No device took %d experiment(s) for %s s, giving up",
+                    len(given_up),
+                    self.timeout,
+                )
+                for job in sorted(given_up, key=lambda job: job.index):
+                    remaining -= 1
+                    yield job.index, None
+                continue
+
+            deadline = min((d for _, _, d in sent.values()), default=now + 1)
+            try:
+                future = self._wakeup.get(timeout=max(deadline - monotonic(), 0))
+            except Empty:
+                future = None
+
+            if future is not None and future in sent and not future.cancelled():
+                job, device, _ = sent.pop(future)
+                with self._lock:
+                    device.in_flight -= 1
+                    device.completed += 1
+                    device.consecutive_failures = 0
+                remaining -= 1
+                yield job.index, future.result()
+
+            now = monotonic()
+            for future, (job, device, deadline) in list(sent.items()):
+                if deadline > now:
+                    continue
+                del sent[future]
+                future.cancel()  # the multiplexer counts it as timed out
+                with self._lock:
+                    device.in_flight -= 1
+                    device.timeouts += 1
+                    device.consecutive_failures += 1
+                    if device.consecutive_failures >= self.max_failures:
+                        logger.warning("Benching %s for %s s", device.device_id, self.cooldown)  # noqa: E501
+                        device.unhealthy_until = now + self.cooldown
+                        device.consecutive_failures = 0
+                    job.tried.add(device.device_id)
+                    if job.attempts <= self.max_retries:
+                        self._assign(job, exclude=job.tried)
+                        continue
+                logger.warning(
+                    "Sensor data for %s timed out after %d attempts",
+                    job.payload_dict.get("experiment_id"),
+                    job.attempts,
+                )
+                remaining -= 1
+                yield job.index, None
+
+    def run(self, payload_dicts):
+        """Run ``payload_dicts`` and return the results in the same order."""
+        payload_dicts = list(payload_dicts)
+        results = [None] * len(payload_dicts)
+        for index, result in self.iter_results(payload_dicts):
+            results[index] = result
+        return results
+
+    def close(self):
+        self.session.remove_handler(status_topic(self.course_id), self._on_status)
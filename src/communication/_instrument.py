@@ -0,0 +1,26 @@
+from metrics import get_registry
+
+# Names of the metrics recorded along the orchestrator's request/reply path
+REPLY_SECONDS = "mqtt_reply_seconds"
+TIMEOUTS = "mqtt_timeouts_total"
+IN_FLIGHT = "mqtt_in_flight"
+QUEUE_DEPTH = "mqtt_queue_depth"
+
+
+def record_reply(experiment_id, seconds):
+    """Record the publish-to-reply latency of one experiment."""
+    registry = get_registry()
+    registry.histogram(REPLY_SECONDS, "Time from publishing a command to its reply").record(seconds)  # noqa: E501
+    registry.trace(REPLY_SECONDS, experiment_id, seconds)
+
+
+def record_timeout(count=1):
+    get_registry().counter(TIMEOUTS, "Commands that got no reply in time").inc(count)
+
+
+def in_flight():
+    return get_registry().gauge(IN_FLIGHT, "Commands awaiting a reply")
+
+
+def queue_depth():
+    return get_registry().gauge(QUEUE_DEPTH, "Received messages waiting to be processed")  # noqa: E501
@@ -0,0 +1,215 @@
+import json
+import threading
+import logging
+from collections import Counter
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from time import perf_counter
+
+from communication._codec import decode_results, encode_commands
+from communication._dedup import DedupCache
+from communication._instrument import record_reply, record_timeout, in_flight
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMultiplexer:
+    """Request/response over one session, with replies routed by experiment id.
+
+    Every request gets its own ``concurrent.futures.Future``, so any number of
+    requests can be in flight on one connection. Replies that do not belong
+    to an outstanding request are counted in ``stats`` instead of raising,
+    so at QoS 0 or 1 a redelivered reply is never returned twice:
+
+    - ``duplicates``: a second reply for a request that already completed
+    - ``late``: a reply for a request that timed out or was cancelled
+    - ``unmatched``: a reply with an unknown or missing experiment id
+    - ``invalid``: a payload that could not be decoded
+
+    Publish-to-reply latencies, timeouts and the number of requests in
+    flight are also recorded in the :mod:`metrics` registry.
+
+    Parameters
+    ----------
+    session : MQTTSession
+        Connected session to publish and receive on.
+    subscribe_topic, publish_topic : str
+        Topics for replies and requests, e.g. ``f"{COURSE_ID}/as7341"`` and
+        ``f"{COURSE_ID}/neopixel"``.
+    qos : int
+        QoS for publishing and subscribing.
+    id_key : str
+        Key of the correlation id in requests and replies.
+    history : int
+        Number of finished request ids remembered for classifying stray
+        replies.
+    ttl : float or None
+        Seconds a finished request id is remembered for.
+    """
+
+    def __init__(
+        self,
+        session,
+        subscribe_topic,
+        publish_topic,
+        qos=2,
+        id_key="experiment_id",
+        history=10000,
+        ttl=600,
+    ):
+        self.session = session
+        self.subscribe_topic = subscribe_topic
+        self.publish_topic = publish_topic
+        self.qos = qos
+        self.id_key = id_key
+        self.history = history
+        self.stats = Counter()
+
+        self._lock = threading.Lock()
+        self._pending = {}  # experiment id -> Future
+        self._sent_at = {}  # experiment id -> perf_counter() at publish
+        # experiment id -> "completed" | "expired"
+        self._finished = DedupCache(maxsize=history, ttl=ttl)
+
+        session.subscribe(subscribe_topic, self._on_message, qos=qos)
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def _decode(self, payload):
+        """Return the list of reply dictionaries carried by ``payload``."""
+        return decode_results(payload)
+
+    def _on_message(self, message):
+        try:
+            replies = self._decode(message.payload)
+        except Exception:
+            with self._lock:
+                self.stats["invalid"] += 1
+            logger.debug("Could not decode message on %s", message.topic)
+            return
+        for reply in replies:
+            self._route(reply)
+
+    def _route(self, reply):
+        experiment_id = reply.get(self.id_key) if isinstance(reply, dict) else None
+        with self._lock:
+            future = self._pending.pop(experiment_id, None)
+            sent_at = self._sent_at.pop(experiment_id, None)
+            if future is None:
+                state = self._finished.get(experiment_id)
+                if state == "completed":
+                    self.stats["duplicates"] += 1
+                elif state == "expired":
+                    self.stats["late"] += 1
+                else:
+                    self.stats["unmatched"] += 1
+                return
+            self._finished.add(experiment_id, "completed")
+            self.stats["replies"] += 1
+        in_flight().dec()
+        if sent_at is not None:
+            record_reply(experiment_id, perf_counter() - sent_at)
+        # The caller may have cancelled the future in the meantime
+        if not future.set_running_or_notify_cancel():
+            return
+        future.set_result(reply)
+
+    def _expire(self, experiment_id):
+        with self._lock:
+            expired = self._pending.pop(experiment_id, None) is not None
+            self._sent_at.pop(experiment_id, None)
+            if expired:
+                self._finished.add(experiment_id, "expired")
+                self.stats["timeouts"] += 1
+        if expired:
+            in_flight().dec()
+            record_timeout()
+
+    def submit(self, payload_dict, payload=None):
+        """Publish a request and return a future for its reply.
+
+        ``payload`` is the already-encoded message to send; by default it is
+        ``json.dumps(payload_dict)``.
+        """
+        if payload is None:
+            payload = json.dumps(payload_dict)
+        return self._submit([payload_dict], payload)[0]
+
+    def submit_batch(self, payload_dicts):
+        """Publish several requests in one message and return their futures.
+
+        The requests are sent as ``{"batch": [...]}``; replies may come back
+        batched or one by one.
+        """
+        return self._submit(payload_dicts, encode_commands(payload_dicts))
+
+    def _submit(self, payload_dicts, payload):
+        experiment_ids = [payload_dict[self.id_key] for payload_dict in payload_dicts]
+        if len(set(experiment_ids)) != len(experiment_ids):
+            raise ValueError(f"Duplicate {self.id_key} in batch")
+        futures = []
+        with self._lock:
+            for experiment_id in experiment_ids:
+                if experiment_id in self._pending:
+                    raise ValueError(f"Request {experiment_id} is already in flight")
+            sent_at = perf_counter()
+            for experiment_id in experiment_ids:
+                future = Future()
+                self._pending[experiment_id] = future
+                self._sent_at[experiment_id] = sent_at
+                futures.append(future)
+            self.stats["requests"] += len(futures)
+        in_flight().inc(len(futures))
+
+        def expire_if_cancelled(experiment_id):
+            def on_done(future):
+                if future.cancelled():
+                    self._expire(experiment_id)
+
+            return on_done
+
+        for experiment_id, future in zip(experiment_ids, futures):
+            future.add_done_callback(expire_if_cancelled(experiment_id))
+        try:
+            self.session.publish(self.publish_topic, payload, qos=self.qos)
+        except Exception:
+            with self._lock:
+                for experiment_id in experiment_ids:
+                    self._pending.pop(experiment_id, None)
+                    self._sent_at.pop(experiment_id, None)
+            in_flight().dec(len(futures))
+            raise
+        return futures
+
+    def result(self, payload_dict, future, timeout=None):
+        """Wait for ``future``, expiring its request if ``timeout`` passes."""
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self._expire(payload_dict[self.id_key])
+            raise TimeoutError(
+                f"No reply to {payload_dict[self.id_key]} on {self.subscribe_topic} within {timeout} s"  # noqa: E501
+            ) from None
+
+    def request(self, payload_dict, timeout=20, payload=None):
+        """Publish a request and block until its reply arrives."""
+        future = self.submit(payload_dict, payload=payload)
+        return self.result(payload_dict, future, timeout=timeout)
+
+
+_multiplexers = {}
+_multiplexers_lock = threading.Lock()
+
+
+def get_multiplexer(session, subscribe_topic, publish_topic, qos=2):
+    """Return the shared multiplexer for this session and topic pair."""
+    key = (session, subscribe_topic, publish_topic, qos)
+    with _multiplexers_lock:
+        multiplexer = _multiplexers.get(key)
+        if multiplexer is None or session.closed:
+            multiplexer = RequestMultiplexer(
+                session, subscribe_topic, publish_topic, qos=qos
+            )
+            _multiplexers[key] = multiplexer
+    return multiplexer
@@ -0,0 +1,14 @@
+from paho.mqtt import client as mqtt_client
+
+
+def client_kwargs(**kwargs):
+    """Keyword arguments for ``paho.mqtt.client.Client`` under paho 1.x and 2.x.
+
+    paho 2 takes the callback API version first; version 1 keeps the
+    callback signatures used throughout this package.
+    """
+    if hasattr(mqtt_client, "CallbackAPIVersion"):
+        kwargs.setdefault(
+            "callback_api_version", mqtt_client.CallbackAPIVersion.VERSION1
+        )
+    return kwargs
@@ -0,0 +1,337 @@
+import random
+import logging
+import threading
+from collections import deque
+from time import monotonic
+
+from paho.mqtt import client as mqtt_client
+
+from metrics import get_registry
+from communication._paho import client_kwargs
+
+logger = logging.getLogger(__name__)
+
+# CONNACK codes that retrying cannot fix (bad protocol/credentials/authorization)
+FATAL_CONNACK_CODES = (1, 2, 4, 5)
+
+
+class Backoff:
+    """Exponential backoff with jitter for reconnect attempts.
+
+    The ``n``-th delay is drawn uniformly from the upper half of
+    ``min(maximum, initial * multiplier ** n)`` ("equal jitter"), so many
+    clients dropped at once by the same broker blip do not reconnect in
+    lockstep, while each still waits a growing minimum.
+
+    Examples
+    --------
+    >>> backoff = Backoff(initial=1, maximum=8, rng=random.Random(0))
+    >>> [round(backoff.next(), 2) for _ in range(5)]
+    [0.92, 1.76, 2.84, 5.04, 6.05]
+    >>> backoff.reset()
+    >>> backoff.next() <= 1
+    True
+    """
+
+    def __init__(self, initial=0.5, maximum=30.0, multiplier=2.0, rng=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.attempts = 0
+        self._rng = random.Random() if rng is None else rng
+
+    def next(self):
+        ceiling = min(self.maximum, self.initial * self.multiplier**self.attempts)
+        self.attempts += 1
+        return ceiling / 2 + self._rng.uniform(0, ceiling / 2)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class _BufferedMessageInfo:
+    # Stands in for the MQTTMessageInfo of a message held back while offline
+    # (or rejected, with rc MQTT_ERR_QUEUE_SIZE) and follows the real one once
+    # the message has been sent. Only paho's public MQTTMessageInfo interface
+    # is mirrored: rc, mid, (rc, mid) unpacking, wait_for_publish and
+    # is_published
+
+    def __init__(self, rc=mqtt_client.MQTT_ERR_SUCCESS):
+        self.mid = 0
+        self.rc = rc
+        self._sent = threading.Event()
+        self._info = None
+
+    def __iter__(self):
+        return iter((self.rc, self.mid))
+
+    def __getitem__(self, index):
+        return (self.rc, self.mid)[index]
+
+    def _flushed(self, info):
+        self._info = info
+        self.mid = info.mid
+        self.rc = info.rc
+        self._sent.set()
+
+    def wait_for_publish(self, timeout=None):
+        if self.rc == mqtt_client.MQTT_ERR_QUEUE_SIZE:
+            raise ValueError("Message is not queued due to ERR_QUEUE_SIZE")
+        start = monotonic()
+        if not self._sent.wait(timeout):
+            return
+        if timeout is not None:
+            timeout = max(timeout - (monotonic() - start), 0)
+        self._info.wait_for_publish(timeout)
+
+    def is_published(self):
+        return self._info is not None and self._info.is_published()
+
+
+class ResilientClient(mqtt_client.Client):
+    """paho client that rides out broker and network outages.
+
+    A drop-in ``paho.mqtt.client.Client`` whose network thread
+    (:meth:`loop_start`) reconnects with exponential backoff and jitter
+    (see :class:`Backoff`) instead of giving up or retrying at a fixed rate.
+    On every reconnect it
+
+    - renews all subscriptions made through :meth:`subscribe`, before
+    - publishing the messages that :meth:`publish` held back while offline,
+      in order, from a buffer of at most ``buffer_size`` messages (further
+      messages are rejected with ``MQTT_ERR_QUEUE_SIZE``), and
+    - lets paho retransmit QoS 1/2 messages that were not yet acknowledged.
+
+    With a fixed ``client_id`` and ``clean_session=False`` the broker also
+    keeps the subscriptions and queues QoS 1/2 messages (e.g. sensor data)
+    while the client is away, so experiments in flight during an outage
+    still get their results. Outages are recorded in the :mod:`metrics`
+    registry (``mqtt_disconnects_total``, ``mqtt_reconnect_seconds``,
+    ``mqtt_offline_buffer``, ``mqtt_offline_dropped_total``).
+
+    Callbacks are assigned as usual (``client.on_connect = ...``); they run
+    after the client's own handling.
+
+    Parameters
+    ----------
+    client_id : str
+        MQTT client id; empty lets the broker assign one.
+    clean_session : bool, optional
+        Defaults to ``True`` without a ``client_id``, ``False`` with one.
+    buffer_size : int
+        Maximum number of messages held back while offline.
+    min_delay, max_delay : float
+        Range of the reconnect backoff in seconds.
+    poll_interval : float
+        Longest the network thread blocks, which bounds how long
+        :meth:`loop_stop` takes.
+    recorder : TransportRecorder, optional
+        Records every message published and received.
+    **kwargs
+        Passed on to ``paho.mqtt.client.Client``.
+    """
+
+    def __init__(
+        self,
+        client_id="",
+        clean_session=None,
+        buffer_size=1000,
+        min_delay=0.5,
+        max_delay=30.0,
+        poll_interval=0.1,
+        recorder=None,
+        **kwargs,
+    ):
+        if clean_session is None:
+            clean_session = not client_id
+        super().__init__(
+            **client_kwargs(client_id=client_id, clean_session=clean_session, **kwargs)
+        )
+        self.backoff = Backoff(min_delay, max_delay)
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self.connect_rc = None  # result code of the last CONNACK
+        self.connected_event = threading.Event()
+        self._subscriptions = {}  # topic -> qos, renewed on every reconnect
+        self._buffer = deque()  # (topic, payload, qos, retain, info) while offline
+        self._online = False
+        self._online_lock = threading.Lock()
+        self._disconnected_at = None
+        self._user_on_connect = None
+        self._user_on_disconnect = None
+        self._user_on_message = None
+        self._loop_thread = None
+        self._stop_loop = threading.Event()
+        self._closing = False  # disconnect() called: don't reconnect
+        self.recorder = recorder
+        self._stream = recorder.attach() if recorder is not None else None
+        # With a write callback registered, publish() from another thread only
+        # queues the packet and wakes the network thread, which writes it,
+        # rather than writing to the socket itself alongside that thread
+        self.on_socket_register_write = self._on_socket_register_write
+
+    # paho looks its callbacks up through these properties, so the client's
+    # own handlers run first and then whatever the user assigned
+    @property
+    def on_connect(self):
+        return self._handle_connect
+
+    @on_connect.setter
+    def on_connect(self, func):
+        self._user_on_connect = func
+
+    @property
+    def on_disconnect(self):
+        return self._handle_disconnect
+
+    @on_disconnect.setter
+    def on_disconnect(self, func):
+        self._user_on_disconnect = func
+
+    @property
+    def on_message(self):
+        return self._handle_message
+
+    @on_message.setter
+    def on_message(self, func):
+        self._user_on_message = func
+
+    @property
+    def online(self):
+        return self._online
+
+    def _handle_connect(self, client, userdata, flags, rc, *args):
+        self.connect_rc = rc
+        if rc == 0:
+            self.backoff.reset()
+            with self._online_lock:
+                # subscribe before flushing, so no reply to a buffered command
+                # can arrive before the subscription
+                if self._subscriptions:
+                    super().subscribe(list(self._subscriptions.items()))
+                while self._buffer:
+                    topic, payload, qos, retain, info = self._buffer.popleft()
+                    info._flushed(super().publish(topic, payload, qos, retain))
+                self._online = True
+            get_registry().gauge("mqtt_offline_buffer").set(0)
+            if self._disconnected_at is not None:
+                get_registry().histogram(
+                    "mqtt_reconnect_seconds", "Time from losing the connection to CONNACK"
+                ).record(monotonic() - self._disconnected_at)
+                self._disconnected_at = None
+            self.connected_event.set()
+        else:
+            logger.warning("Connection refused with result code %s", rc)
+        if self._user_on_connect is not None:
+            self._user_on_connect(client, userdata, flags, rc, *args)
+
+    def _handle_disconnect(self, client, userdata, rc, *args):
+        with self._online_lock:
+            self._online = False
+        self.connected_event.clear()
+        if rc != mqtt_client.MQTT_ERR_SUCCESS:
+            get_registry().counter("mqtt_disconnects_total").inc()
+            if self._disconnected_at is None:
+                self._disconnected_at = monotonic()
+            logger.warning("Lost the connection (%s), reconnecting", mqtt_client.error_string(rc))  # noqa: E501
+        if self._user_on_disconnect is not None:
+            self._user_on_disconnect(client, userdata, rc, *args)
+
+    def _handle_message(self, client, userdata, message):
+        if self.recorder is not None:
+            self.recorder.record_message(self._stream, message)
+        if self._user_on_message is not None:
+            self._user_on_message(client, userdata, message)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        pass  # the network thread's select() already watches for writability
+
+    def message_callback_add(self, sub, callback):
+        """Add a topic callback; its messages are recorded as well."""
+        if self.recorder is None:
+            return super().message_callback_add(sub, callback)
+
+        def recorded(client, userdata, message):
+            self.recorder.record_message(self._stream, message)
+            callback(client, userdata, message)
+
+        return super().message_callback_add(sub, recorded)
+
+    def subscribe(self, topic, qos=0, **kwargs):
+        """Subscribe now if connected, and again after every reconnect."""
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        with self._online_lock:
+            self._subscriptions.update(topics)
+        return super().subscribe(topic, qos, **kwargs)
+
+    def unsubscribe(self, topic, **kwargs):
+        with self._online_lock:
+            for t in topic if isinstance(topic, list) else [topic]:
+                self._subscriptions.pop(t, None)
+        return super().unsubscribe(topic, **kwargs)
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        """Publish, or hold the message back until reconnected if offline."""
+        if self.recorder is not None:
+            self.recorder.record(self._stream, "publish", topic, payload, qos, retain)
+        with self._online_lock:
+            if self._online or self._loop_thread is None:
+                return super().publish(topic, payload, qos, retain, properties)
+            if len(self._buffer) >= self.buffer_size:
+                get_registry().counter("mqtt_offline_dropped_total").inc()
+                return _BufferedMessageInfo(mqtt_client.MQTT_ERR_QUEUE_SIZE)
+            info = _BufferedMessageInfo()
+            self._buffer.append((topic, payload, qos, retain, info))
+            get_registry().gauge("mqtt_offline_buffer").set(len(self._buffer))
+            return info
+
+    def loop_start(self):
+        """Start the reconnecting network thread (``MQTT_ERR_INVAL`` if running)."""
+        if self._loop_thread is not None:
+            return mqtt_client.MQTT_ERR_INVAL
+        self._stop_loop.clear()
+        self._loop_thread = threading.Thread(
+            target=self._run, name="mqtt-resilient-loop", daemon=True
+        )
+        self._loop_thread.start()
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        thread = self._loop_thread
+        if thread is None:
+            return mqtt_client.MQTT_ERR_INVAL
+        self._stop_loop.set()
+        if threading.current_thread() is not thread:
+            thread.join()
+            self._loop_thread = None
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    def connect_async(self, *args, **kwargs):
+        self._closing = False
+        return super().connect_async(*args, **kwargs)
+
+    def disconnect(self, *args, **kwargs):
+        with self._online_lock:
+            self._online = False
+            self._closing = True
+        return super().disconnect(*args, **kwargs)
+
+    def _run(self):
+        while not self._stop_loop.is_set():
+            if self.socket() is None:
+                if self._closing or self.connect_rc in FATAL_CONNACK_CODES:
+                    # disconnected on purpose, or e.g. bad credentials, which
+                    # retrying would not fix
+                    return
+                try:
+                    self.reconnect()
+                except (OSError, ValueError) as e:
+                    if self._disconnected_at is None:
+                        self._disconnected_at = monotonic()
+                    delay = self.backoff.next()
+                    logger.info("Reconnect failed (%s), retrying in %.1f s", e, delay)
+                    self._stop_loop.wait(delay)
+                    continue
+            rc = self.loop(timeout=self.poll_interval)
+            if rc != mqtt_client.MQTT_ERR_SUCCESS and not self._stop_loop.is_set():
+                self._stop_loop.wait(self.backoff.next())
@@ -0,0 +1,716 @@
+import os
+import json
+import struct
+import atexit
+import logging
+import threading
+from collections import Counter, deque
+from time import time, monotonic
+from typing import NamedTuple
+
+from paho.mqtt import client as mqtt_client
+
+from metrics import get_registry
+from communication._reconnect import ResilientClient
+from communication._codec import decode_results
+
+logger = logging.getLogger(__name__)
+
+# Path of a transport log to append every message sent and received to
+record_key = "MQTT_RECORD"
+# Path of a transport log to play back instead of connecting to a broker, and
+# the playback speed (0 for as fast as possible, 1 for real time)
+replay_key = "MQTT_REPLAY"
+replay_speed_key = "MQTT_REPLAY_SPEED"
+
+PUBLISH = "publish"
+RECEIVE = "receive"
+
+# Written whenever a recorder opens the log, so every run starts with it
+_MAGIC = b"MQTTLOG1"
+# time, stream, flags, qos, topic length, payload length; then topic, payload
+_RECORD = struct.Struct("<dBBBHI")
+_RECEIVED = 1
+_RETAINED = 2
+
+
+class LogEntry(NamedTuple):
+    """One message in a transport log (see :class:`TransportRecorder`)."""
+
+    time: float
+    stream: int
+    direction: str
+    topic: str
+    payload: bytes
+    qos: int
+    retain: bool
+
+
+def _to_bytes(payload):
+    # the same conversion paho applies before sending
+    if payload is None:
+        return b""
+    if isinstance(payload, str):
+        return payload.encode()
+    if isinstance(payload, (int, float)):
+        return str(payload).encode()
+    return bytes(payload)
+
+
+class TransportRecorder:
+    """Append-only log of the MQTT messages a process sends and receives.
+
+    Every message is written as it is published or received, with its wall
+    clock time, topic, payload, QoS and retain flag, in a compact binary
+    format (a 17-byte header plus topic and payload), and flushed straight
+    away so that a crash loses at most the message being written. Read logs
+    back with :func:`read_log` and play them back without a broker with
+    :class:`Replayer`.
+
+    Several transports (e.g. the orchestrator's client and a pooled
+    :class:`MQTTSession`) can share one recorder; each gets its own stream
+    number from :meth:`attach`, in the order they are created.
+
+    Set ``MQTT_RECORD`` to a path to have :func:`get_session` and
+    :func:`create_client` record to it (see :func:`env_recorder`).
+
+    Parameters
+    ----------
+    path : str
+        Log file, appended to if it exists. Each recorder starts a new run
+        in it (see :func:`read_log`).
+    clock : callable
+        Returns the current time in seconds.
+    """
+
+    def __init__(self, path, clock=time):
+        self.path = path
+        self.clock = clock
+        self.records = 0
+        self._lock = threading.Lock()
+        self._streams = 0
+        self._file = open(path, "ab")
+        self._file.write(_MAGIC)
+        self._file.flush()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    def attach(self):
+        """Return the stream number for a new transport."""
+        with self._lock:
+            stream = self._streams
+            self._streams += 1
+        return stream
+
+    def record(self, stream, direction, topic, payload, qos=0, retain=False):
+        """Append a message published (``PUBLISH``) or received (``RECEIVE``)."""
+        topic = topic.encode() if isinstance(topic, str) else bytes(topic)
+        payload = _to_bytes(payload)
+        flags = (_RECEIVED if direction == RECEIVE else 0) | (
+            _RETAINED if retain else 0
+        )
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(
+                _RECORD.pack(
+                    self.clock(), stream, flags, qos, len(topic), len(payload)
+                )
+                + topic
+                + payload
+            )
+            self._file.flush()
+            self.records += 1
+
+    def record_message(self, stream, message):
+        """Append a received ``paho.mqtt.client.MQTTMessage``."""
+        self.record(
+            stream, RECEIVE, message.topic, message.payload, message.qos, message.retain
+        )
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_log(path, run=-1):
+    """Return the :class:`LogEntry` list of one run of a transport log.
+
+    ``run`` indexes the runs recorded into the file (the last by default);
+    ``None`` returns the entries of all runs. A record cut short by a crash
+    ends the log.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    runs = []
+    offset = 0
+    while offset < len(data):
+        if data.startswith(_MAGIC, offset):
+            runs.append([])
+            offset += len(_MAGIC)
+            continue
+        if not runs:
+            raise ValueError(f"{path} is not an MQTT transport log")
+        if offset + _RECORD.size > len(data):
+            break
+        t, stream, flags, qos, n_topic, n_payload = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        end = start + n_topic + n_payload
+        if end > len(data):
+            break
+        runs[-1].append(
+            LogEntry(
+                t,
+                stream,
+                RECEIVE if flags & _RECEIVED else PUBLISH,
+                data[start : start + n_topic].decode(),
+                data[start + n_topic : end],
+                qos,
+                bool(flags & _RETAINED),
+            )
+        )
+        offset = end
+    if run is None:
+        return [entry for entries in runs for entry in entries]
+    return runs[run] if runs else []
+
+
+class ReplayError(RuntimeError):
+    """A message published during a strict replay differs from the log."""
+
+
+class Replayer:
+    """Plays a transport log back to stand-in transports, without a broker.
+
+    The transports (:class:`ReplaySession` for :func:`hivemq_communication`
+    and :class:`ReplayClient` for the orchestrator's paho client) attach in
+    the order the recorded ones were created. Each publish is matched to
+    the next message published in the log, and releases the messages that
+    were received after it and before the following publish; those are then
+    delivered on the replayer's own thread, as paho would on its network
+    thread. The run is thereby reproduced message for message, as long as
+    the code under test publishes what it published when recorded. Commands
+    that differ only in their (equally long) experiment ids, such as the
+    random ones of ``orchestrator_client``, still match, and the replies
+    carry the new ids.
+
+    Parameters
+    ----------
+    entries : list of LogEntry
+        The log to play back, e.g. from :func:`read_log`.
+    speed : float, optional
+        ``None`` or 0 delivers messages as soon as they are released, for
+        regression tests and for profiling without network latency. A
+        positive factor keeps the recorded delays after each publish,
+        scaled down by it (1 for real time).
+    strict : bool
+        Raise :class:`ReplayError` from ``publish`` when a message differs
+        from the log instead of only recording it in ``mismatches``.
+    rewrite_ids : bool
+        Match commands with different experiment ids, as described above.
+    id_key : str
+        Key of the correlation id in commands.
+    clock : callable
+        Returns the current monotonic time in seconds.
+
+    Attributes
+    ----------
+    stats : collections.Counter
+        ``published``, ``matched`` (of which ``rewritten`` with new ids),
+        ``mismatched``, ``extra`` (published past
+        the end of the log), ``delivered`` and ``unrouted`` (no transport or
+        subscription for them).
+    mismatches : list
+        ``(index, expected LogEntry, topic, payload)`` of mismatched
+        publishes.
+    """
+
+    def __init__(
+        self,
+        entries,
+        speed=None,
+        strict=False,
+        rewrite_ids=True,
+        id_key="experiment_id",
+        clock=monotonic,
+    ):
+        self.entries = list(entries)
+        self.speed = speed or None
+        self.strict = strict
+        self.rewrite_ids = rewrite_ids
+        self.id_key = id_key
+        self.clock = clock
+        self.stats = Counter()
+        self.mismatches = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._cursor = 0  # index of the next log entry to replay
+        self._due = deque()  # (monotonic time due, entry), in log order
+        self._delivering = False
+        self._anchor = None  # (clock(), log time) of the latest publish
+        self._ids = {}  # recorded id -> id published instead, as bytes
+        self._transports = []
+        self._thread = None
+        self._closed = False
+
+    @classmethod
+    def from_file(cls, path, run=-1, **kwargs):
+        return cls(read_log(path, run=run), **kwargs)
+
+    @property
+    def done(self):
+        """Whether every message in the log has been replayed and delivered."""
+        with self._lock:
+            return (
+                self._cursor == len(self.entries)
+                and not self._due
+                and not self._delivering
+            )
+
+    def attach(self, transport):
+        """Add a transport and return its stream number."""
+        with self._lock:
+            self._transports.append(transport)
+            return len(self._transports) - 1
+
+    def start(self):
+        """Release the messages received before the first publish."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._release()
+            self._thread = threading.Thread(
+                target=self._run, name="mqtt-replay", daemon=True
+            )
+            self._thread.start()
+
+    def _release(self):
+        # queue the received messages up to the next publish in the log
+        if self._anchor is None:
+            first = self.entries[0].time if self.entries else 0.0
+            self._anchor = (self.clock(), first)
+        now, logged = self._anchor
+        while (
+            self._cursor < len(self.entries)
+            and self.entries[self._cursor].direction == RECEIVE
+        ):
+            entry = self.entries[self._cursor]
+            if self._ids:
+                entry = entry._replace(payload=self._rewrite(entry.payload))
+            due = now + (entry.time - logged) / self.speed if self.speed else 0.0
+            self._due.append((due, entry))
+            self._cursor += 1
+        self._wakeup.notify_all()
+
+    def _rewrite(self, payload):
+        # put the ids published in place of the recorded ones
+        try:
+            replies = decode_results(payload)
+        except Exception:
+            return payload
+        for reply in replies:
+            old = reply.get(self.id_key) if isinstance(reply, dict) else None
+            new = self._ids.get(str(old).encode())
+            if new is not None:
+                payload = payload.replace(str(old).encode(), new)
+        return payload
+
+    def publish(self, stream, topic, payload, qos=0, retain=False):
+        """Match a publish to the log and release the replies it triggered."""
+        payload = _to_bytes(payload)
+        error = None
+        with self._lock:
+            self._release()  # received before this publish, if not started yet
+            self.stats["published"] += 1
+            if self._cursor >= len(self.entries):
+                self.stats["extra"] += 1
+                if self.strict:
+                    error = f"Publish to {topic} after the end of the log"
+            else:
+                index = self._cursor
+                entry = self.entries[index]
+                same_topic = (entry.stream, entry.topic) == (stream, topic)
+                ids = None
+                if same_topic and entry.payload != payload and self.rewrite_ids:
+                    ids = _id_mapping(entry.payload, payload, self.id_key)
+                if same_topic and (entry.payload == payload or ids is not None):
+                    self.stats["matched"] += 1
+                    if ids:
+                        self.stats["rewritten"] += 1
+                        self._ids.update(ids)
+                else:
+                    self.stats["mismatched"] += 1
+                    self.mismatches.append((index, entry, topic, payload))
+                    if self.strict:
+                        error = f"Publish {index} to {topic} differs from the log ({entry.topic}: {entry.payload[:80]!r})"  # noqa: E501
+                self._cursor += 1
+                self._anchor = (self.clock(), entry.time)
+                self._release()
+        if error is not None:
+            raise ReplayError(error)
+
+    def wait(self, timeout=None):
+        """Block until the whole log has been replayed; return :attr:`done`."""
+        deadline = None if timeout is None else self.clock() + timeout
+        with self._wakeup:
+            while self._cursor < len(self.entries) or self._due or self._delivering:
+                remaining = None if deadline is None else deadline - self.clock()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._wakeup.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                self._delivering = False
+                self._wakeup.notify_all()
+                while not self._due and not self._closed:
+                    self._wakeup.wait()
+                if self._closed:
+                    return
+                due, entry = self._due[0]
+                delay = due - self.clock()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+                self._due.popleft()
+                self._delivering = True
+                transport = (
+                    self._transports[entry.stream]
+                    if entry.stream < len(self._transports)
+                    else None
+                )
+            # An exception escaping here would stop the replay
+            try:
+                delivered = transport is not None and transport._deliver(entry)
+            except Exception:
+                delivered = True
+                logger.exception("Error handling replayed message on %s", entry.topic)
+            self.stats["delivered" if delivered else "unrouted"] += 1
+
+    def close(self):
+        with self._wakeup:
+            self._closed = True
+            self._wakeup.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+def _id_mapping(recorded, published, id_key):
+    # {recorded id: published id} if two JSON commands (or batches of them)
+    # differ only in their ids, and the ids in length, so that replacing
+    # them in the replies also works for the binary format; otherwise None
+    try:
+        recorded, published = json.loads(recorded), json.loads(published)
+    except ValueError:
+        return None
+    if isinstance(recorded, dict) and isinstance(published, dict):
+        recorded = recorded.get("batch", [recorded])
+        published = published.get("batch", [published])
+    if not (
+        isinstance(recorded, list)
+        and isinstance(published, list)
+        and len(recorded) == len(published)
+    ):
+        return None
+    ids = {}
+    for old, new in zip(recorded, published):
+        if not (isinstance(old, dict) and isinstance(new, dict)):
+            return None
+        old, new = dict(old), dict(new)
+        old_id, new_id = str(old.pop(id_key, "")), str(new.pop(id_key, ""))
+        if old != new or not old_id or len(old_id) != len(new_id):
+            return None
+        if old_id != new_id:
+            ids[old_id.encode()] = new_id.encode()
+    return ids
+
+
+def _message(entry):
+    message = mqtt_client.MQTTMessage(topic=entry.topic.encode())
+    message.payload = entry.payload
+    message.qos = entry.qos
+    message.retain = entry.retain
+    return message
+
+
+class _PublishedInfo:
+    # paho's public MQTTMessageInfo interface, for a message that is
+    # published as soon as it is handed over
+
+    rc = mqtt_client.MQTT_ERR_SUCCESS
+
+    def __init__(self, mid):
+        self.mid = mid
+
+    def __iter__(self):
+        return iter((self.rc, self.mid))
+
+    def __getitem__(self, index):
+        return (self.rc, self.mid)[index]
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+    def is_published(self):
+        return True
+
+
+class ReplaySession:
+    """Stands in for :class:`MQTTSession`, playing back a :class:`Replayer`.
+
+    Returned by :func:`get_session` when ``MQTT_REPLAY`` is set, so that
+    :func:`hivemq_communication`, :class:`RequestMultiplexer` and
+    :class:`FleetScheduler` run unchanged without a broker.
+    """
+
+    def __init__(self, replayer, host="replay", port=None):
+        self.replayer = replayer
+        self.host = host
+        self.port = port
+        self._lock = threading.Lock()
+        self._handlers = {}  # topic filter -> list of callables
+        self._mid = 0
+        self._connected = False
+        self._closed = False
+        self.stream = replayer.attach(self)
+
+    @property
+    def connected(self):
+        return self._connected
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def connect(self):
+        self._connected = True
+        self.replayer.start()
+        return self
+
+    def subscribe(self, topic, handler=None, qos=2, timeout=None):
+        with self._lock:
+            handlers = self._handlers.setdefault(topic, [])
+            if handler is not None:
+                handlers.append(handler)
+
+    def remove_handler(self, topic, handler):
+        with self._lock:
+            handlers = self._handlers.get(topic, [])
+            if handler in handlers:
+                handlers.remove(handler)
+
+    def publish(self, topic, payload, qos=2, retain=False):
+        with self._lock:
+            self._mid += 1
+            mid = self._mid
+        self.replayer.publish(self.stream, topic, payload, qos, retain)
+        get_registry().counter("mqtt_messages_sent_total").inc()
+        return _PublishedInfo(mid)
+
+    def _deliver(self, entry):
+        with self._lock:
+            handlers = [
+                handler
+                for topic_filter, topic_handlers in self._handlers.items()
+                if mqtt_client.topic_matches_sub(topic_filter, entry.topic)
+                for handler in topic_handlers
+            ]
+        if not handlers:
+            return False
+        get_registry().counter("mqtt_messages_received_total").inc()
+        message = _message(entry)
+        for handler in handlers:
+            try:
+                handler(message)
+            except Exception:
+                logger.exception("Error handling message on topic %s", entry.topic)
+        return True
+
+    def close(self):
+        self._closed = True
+        self._connected = False
+
+
+class ReplayClient:
+    """Stands in for the orchestrator's paho client, playing back a :class:`Replayer`.
+
+    Supports what ``orchestrator_client`` and :func:`iter_batch` use: the
+    ``on_*`` callbacks, :meth:`subscribe`, :meth:`publish`, ``connect``/
+    ``connect_async``, and :meth:`loop_start`/:meth:`loop_stop`, which
+    pause delivery like stopping paho's network loop. Returned by
+    :func:`create_client` when ``MQTT_REPLAY`` is set.
+    """
+
+    def __init__(self, replayer, client_id=""):
+        self.replayer = replayer
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_subscribe = None
+        self.on_publish = None
+        self.connect_rc = None
+        self.connected_event = threading.Event()
+        self._lock = threading.RLock()
+        self._subscriptions = {}  # topic filter -> qos
+        self._held = deque()  # messages arriving while the loop is stopped
+        self._running = False
+        self._mid = 0
+        self.stream = replayer.attach(self)
+
+    @property
+    def online(self):
+        return self.connected_event.is_set()
+
+    def _next_mid(self):
+        with self._lock:
+            self._mid += 1
+            return self._mid
+
+    def tls_set_context(self, context=None):
+        pass
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect_async(self, host, port=1883, keepalive=60, **kwargs):
+        self.host = host
+        self.port = port
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    connect = connect_async
+
+    def subscribe(self, topic, qos=0, **kwargs):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        mid = self._next_mid()
+        with self._lock:
+            self._subscriptions.update(topics)
+            if self.online and self.on_subscribe is not None:
+                self.on_subscribe(self, None, mid, tuple(q for _, q in topics))
+        return mqtt_client.MQTT_ERR_SUCCESS, mid
+
+    def unsubscribe(self, topic, **kwargs):
+        with self._lock:
+            for t in topic if isinstance(topic, list) else [topic]:
+                self._subscriptions.pop(t, None)
+        return mqtt_client.MQTT_ERR_SUCCESS, self._next_mid()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        mid = self._next_mid()
+        self.replayer.publish(self.stream, topic, payload, qos, retain)
+        if self.on_publish is not None:
+            self.on_publish(self, None, mid)
+        return _PublishedInfo(mid)
+
+    def loop_start(self):
+        with self._lock:
+            if self._running:
+                return mqtt_client.MQTT_ERR_INVAL
+            self._running = True
+            if not self.online:
+                self.connect_rc = 0
+                self.connected_event.set()
+                if self.on_connect is not None:
+                    self.on_connect(self, None, {"session present": 0}, 0)
+                if self._subscriptions and self.on_subscribe is not None:
+                    qos = tuple(self._subscriptions.values())
+                    self.on_subscribe(self, None, self._next_mid(), qos)
+            while self._held:
+                self._dispatch(self._held.popleft())
+        self.replayer.start()
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        with self._lock:
+            if not self._running:
+                return mqtt_client.MQTT_ERR_INVAL
+            self._running = False
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    def disconnect(self, *args, **kwargs):
+        with self._lock:
+            self.connected_event.clear()
+            if self.on_disconnect is not None:
+                self.on_disconnect(self, None, mqtt_client.MQTT_ERR_SUCCESS)
+        return mqtt_client.MQTT_ERR_SUCCESS
+
+    def _deliver(self, entry):
+        with self._lock:
+            if not any(
+                mqtt_client.topic_matches_sub(topic_filter, entry.topic)
+                for topic_filter in self._subscriptions
+            ):
+                return False
+            message = _message(entry)
+            if self._running:
+                self._dispatch(message)
+            else:
+                self._held.append(message)
+        return True
+
+    def _dispatch(self, message):
+        if self.on_message is not None:
+            self.on_message(self, None, message)
+
+
+_env_lock = threading.Lock()
+_recorder = None
+_replayer = None
+
+
+def env_recorder():
+    """The shared :class:`TransportRecorder` for ``MQTT_RECORD``, if set."""
+    global _recorder
+    path = os.getenv(record_key)
+    if not path:
+        return None
+    with _env_lock:
+        if _recorder is None or _recorder.closed or _recorder.path != path:
+            _recorder = TransportRecorder(path)
+    return _recorder
+
+
+def env_replayer():
+    """The shared :class:`Replayer` for ``MQTT_REPLAY``, if set.
+
+    Plays back the last run in the log at ``MQTT_REPLAY_SPEED`` (0, as fast
+    as possible, by default).
+    """
+    global _replayer
+    path = os.getenv(replay_key)
+    if not path:
+        return None
+    with _env_lock:
+        if _replayer is None:
+            speed = float(os.getenv(replay_speed_key, 0))
+            _replayer = Replayer.from_file(path, speed=speed)
+    return _replayer
+
+
+def create_client(client_id="", **kwargs):
+    """Return the orchestrator's paho client.
+
+    A :class:`ReplayClient` playing back ``MQTT_REPLAY`` if that is set, and
+    otherwise a :class:`ResilientClient` (``kwargs`` are passed on to it)
+    that records to ``MQTT_RECORD`` if that is set.
+    """
+    replayer = env_replayer()
+    if replayer is not None:
+        return ReplayClient(replayer, client_id)
+    return ResilientClient(client_id, recorder=env_recorder(), **kwargs)
+
+
+@atexit.register
+def _close_recorder():
+    with _env_lock:
+        if _recorder is not None:
+            _recorder.close()
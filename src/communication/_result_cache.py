@@ -0,0 +1,184 @@
+import os
+import json
+import threading
+from collections import Counter, OrderedDict
+from time import time
+
+
+def canonical_command(command, resolution=1):
+    """Return a hashable key for ``command``, e.g. ``{"R": 15, "G": 82, "B": 186}``.
+
+    Keys are sorted and numeric values are rounded to the nearest multiple of
+    ``resolution``, so ``{"G": 82.2, "R": 15, "B": 186}`` maps to the same key
+    and, with ``resolution=4``, so do commands that differ by a level or two.
+
+    Examples
+    --------
+    >>> canonical_command({"R": 15, "G": 82.2, "B": 186})
+    (('B', 186), ('G', 82), ('R', 15))
+    >>> canonical_command({"R": 15, "G": 83, "B": 186}, resolution=4)
+    (('B', 184), ('G', 84), ('R', 16))
+    """
+    return tuple(
+        (key, _quantize(value, resolution)) for key, value in sorted(command.items())
+    )
+
+
+def _quantize(value, resolution):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return value
+    return int(round(value / resolution) * resolution)
+
+
+class ResultCache:
+    """LRU cache of sensor data keyed by the command that produced them.
+
+    Put in front of :func:`hivemq_communication`, :func:`run_batch` or
+    ``orchestrator_client.run_experiment`` (``cache=...``), so that commands
+    measured recently are answered without an MQTT round trip. This is for
+    closed-loop optimisation, which keeps revisiting the same points.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of commands kept; the least recently used goes first.
+    ttl : float or None
+        Seconds a measurement stays valid, or ``None`` for no expiry.
+    path : str, optional
+        JSON Lines file backing the cache. Existing entries are loaded on
+        creation and new ones are appended, so the cache survives restarts.
+    resolution : int
+        Commands are rounded to multiples of this before lookup (see
+        :func:`canonical_command`); 1 matches identical commands only.
+    clock : callable
+        Returns the current (wall clock) time in seconds.
+
+    Attributes
+    ----------
+    stats : collections.Counter
+        ``hits``, ``misses``, ``expired`` and ``evictions``.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, path=None, resolution=1, clock=time):
+        if maxsize < 1:
+            raise ValueError(f"maxsize must be at least 1, got {maxsize}")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.resolution = resolution
+        self.clock = clock
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (stored at, sensor_data)
+        self._file = None
+        if path is not None:
+            n_lines = self._load(path)
+            # rewrite the file once it is mostly superseded entries
+            if n_lines > 2 * max(len(self._entries), 1):
+                self._compact(path)
+            self._file = open(path, "a")
+
+    def _load(self, path):
+        n_lines = 0
+        if not os.path.exists(path):
+            return n_lines
+        with open(path) as f:
+            for line in f:
+                n_lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # e.g. a line cut short by a crash
+                key = tuple((k, v) for k, v in record["key"])
+                self._store(key, record["time"], record["sensor_data"])
+        self.stats["evictions"] = 0
+        return n_lines
+
+    @staticmethod
+    def _record(key, stored_at, sensor_data):
+        return json.dumps({"key": key, "time": stored_at, "sensor_data": sensor_data})
+
+    def _compact(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            for key, (stored_at, sensor_data) in self._entries.items():
+                f.write(self._record(key, stored_at, sensor_data) + "\n")
+        os.replace(tmp_path, path)
+
+    def _store(self, key, stored_at, sensor_data):
+        self._entries[key] = (stored_at, sensor_data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def key(self, command):
+        return canonical_command(command, self.resolution)
+
+    def get(self, command):
+        """Return a copy of the cached sensor data for ``command``, or ``None``."""
+        key = self.key(command)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None:
+                if self.clock() - entry[0] > self.ttl:
+                    del self._entries[key]
+                    self.stats["expired"] += 1
+                    entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return dict(entry[1])  # so callers can't alter the cached entry
+
+    def put(self, command, sensor_data):
+        key = self.key(command)
+        stored_at = self.clock()
+        sensor_data = dict(sensor_data)  # nor alter it afterwards
+        with self._lock:
+            self._store(key, stored_at, sensor_data)
+            if self._file is not None:
+                self._file.write(self._record(key, stored_at, sensor_data) + "\n")
+                self._file.flush()
+
+    def lookup(self, payload_dict):
+        """Return the cached reply to ``payload_dict``, or ``None``.
+
+        The reply is a new dict: ``payload_dict`` with a copy of the cached
+        ``sensor_data`` added, i.e. what the device would have sent back.
+        """
+        command = payload_dict.get("command")
+        if not isinstance(command, dict):
+            return None
+        sensor_data = self.get(command)
+        if sensor_data is None:
+            return None
+        return {**payload_dict, "sensor_data": sensor_data}
+
+    def store(self, results_dict):
+        """Cache the ``sensor_data`` of a reply under its ``command``."""
+        if isinstance(results_dict, dict) and "sensor_data" in results_dict:
+            command = results_dict.get("command")
+            if isinstance(command, dict):
+                self.put(command, results_dict["sensor_data"])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._file is not None:
+                self._file.truncate(0)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,354 @@
+import os
+import ssl
+import threading
+import atexit
+import logging
+from collections import OrderedDict
+from time import perf_counter
+
+from paho.mqtt import client as mqtt_client
+
+from metrics import get_registry
+from communication._paho import client_kwargs
+from communication._replay import ReplaySession, env_recorder, env_replayer
+
+logger = logging.getLogger(__name__)
+
+username_key = "HIVEMQ_USERNAME"
+password_key = "HIVEMQ_PASSWORD"
+host_key = "HIVEMQ_HOST"
+# Optional, for brokers other than HiveMQ Cloud (e.g. the local test broker)
+port_key = "HIVEMQ_PORT"
+tls_key = "HIVEMQ_TLS"
+# QoS for commands and results; 0 or 1 for throughput, relying on
+# experiment_id deduplication (see DedupCache) instead of QoS 2
+qos_key = "MQTT_QOS"
+
+# Publish and early ack times are kept for at most this many messages each
+# (oldest dropped first), so timings whose counterpart never comes can't
+# pile up or be matched to a reused mid
+MAX_TIMED_PUBLISHES = 1024
+
+
+def _remember(times, mid, t):
+    times[mid] = t
+    times.move_to_end(mid)
+    if len(times) > MAX_TIMED_PUBLISHES:
+        times.popitem(last=False)
+
+
+def env_port():
+    """Broker port from ``HIVEMQ_PORT``, defaulting to HiveMQ Cloud's 8883."""
+    return int(os.getenv(port_key, 8883))
+
+
+def env_tls():
+    """Whether to use TLS, from ``HIVEMQ_TLS`` (``0`` disables it)."""
+    return os.getenv(tls_key, "1").lower() not in ("0", "false", "no")
+
+
+def env_qos():
+    """QoS for commands and results from ``MQTT_QOS``, defaulting to 2."""
+    qos = int(os.getenv(qos_key, 2))
+    if qos not in (0, 1, 2):
+        raise ValueError(f"{qos_key} must be 0, 1 or 2, got {qos}")
+    return qos
+
+
+class _TimedSSLSocket(ssl.SSLSocket):
+    # paho wraps the socket with do_handshake_on_connect=False and then calls
+    # do_handshake itself, so this times exactly the TLS handshake
+    def do_handshake(self, *args, **kwargs):
+        start = perf_counter()
+        result = super().do_handshake(*args, **kwargs)
+        get_registry().histogram(
+            "mqtt_tls_handshake_seconds", "TLS handshake time"
+        ).record(perf_counter() - start)
+        return result
+
+
+def tls_context():
+    """TLS client context (as ``tls_set(PROTOCOL_TLS_CLIENT)``) that times handshakes.
+
+    Pass it to ``client.tls_set_context`` to have the handshake time
+    recorded in the ``mqtt_tls_handshake_seconds`` histogram.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs()
+    context.sslsocket_class = _TimedSSLSocket
+    return context
+
+
+class MQTTSession:
+    """A long-lived, thread-safe MQTT connection that keeps its subscriptions.
+
+    Handlers registered with :meth:`subscribe` are called from paho's network
+    thread with the raw ``paho.mqtt.client.MQTTMessage``. The broker-side
+    subscription is kept after a handler is removed, so a topic is only
+    subscribed to once per session, and every subscription is renewed when
+    paho reconnects.
+
+    Connect, TLS handshake and publish-to-acknowledgement times are recorded
+    in the :mod:`metrics` registry.
+
+    Parameters
+    ----------
+    host : str
+        Hostname of the MQTT broker.
+    username, password : str, optional
+        Broker credentials.
+    port : int
+        Broker port, 8883 for HiveMQ Cloud.
+    tls : bool
+        Whether to enable TLS.
+    connect_timeout : float
+        Seconds to wait for the broker to acknowledge the connection.
+    client_id : str
+        MQTT client id; empty lets the broker assign one.
+    clean_session : bool, optional
+        Defaults to ``True`` without a ``client_id``, ``False`` with one, in
+        which case the broker keeps the subscriptions and queues QoS 1/2
+        messages while the session is disconnected.
+    recorder : TransportRecorder, optional
+        Records every message published and received.
+    """
+
+    def __init__(
+        self,
+        host,
+        username=None,
+        password=None,
+        port=8883,
+        tls=True,
+        connect_timeout=10,
+        client_id="",
+        clean_session=None,
+        recorder=None,
+    ):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+
+        self._lock = threading.Lock()
+        self._subacks = threading.Condition(self._lock)
+        self._acked_mids = set()
+        self._subscriptions = {}  # topic filter -> qos
+        self._handlers = {}  # topic filter -> list of callables
+        self._connected_event = threading.Event()
+        self._connect_rc = None
+        self._closed = False
+        self._network_thread = None  # ident of the thread running the handlers
+        self._timing_lock = threading.Lock()
+        self._publish_times = OrderedDict()  # mid -> perf_counter() at publish
+        self._early_acks = OrderedDict()  # mid -> perf_counter() at ack, if first
+        self.recorder = recorder
+        self._stream = recorder.attach() if recorder is not None else None
+
+        if clean_session is None:
+            clean_session = not client_id
+        self.client = mqtt_client.Client(
+            **client_kwargs(client_id=client_id, clean_session=clean_session)
+        )
+        self.client.username_pw_set(username, password)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_subscribe = self._on_subscribe
+        self.client.on_message = self._on_message
+        self.client.on_publish = self._on_publish
+        if tls:
+            self.client.tls_set_context(tls_context())
+
+    @property
+    def connected(self):
+        return self._connected_event.is_set()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def connect(self):
+        """Connect, start the network thread and wait for the CONNACK."""
+        start = perf_counter()
+        self.client.connect(self.host, port=self.port)
+        self.client.loop_start()
+        if not self._connected_event.wait(timeout=self.connect_timeout):
+            self.client.loop_stop()
+            get_registry().counter("mqtt_connect_failures_total").inc()
+            raise ConnectionError(
+                f"Could not connect to {self.host}:{self.port} within {self.connect_timeout} s (result code {self._connect_rc})"  # noqa: E501
+            )
+        get_registry().histogram(
+            "mqtt_connect_seconds", "Time from connect() to CONNACK"
+        ).record(perf_counter() - start)
+        return self
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self._connect_rc = rc
+        if rc != 0:
+            logger.warning("Connection to %s refused with result code %s", self.host, rc)
+            return
+        # Renew every subscription, since the broker forgets them when a clean
+        # session reconnects
+        with self._lock:
+            subscriptions = list(self._subscriptions.items())
+            self._acked_mids.clear()
+        if subscriptions:
+            client.subscribe(subscriptions)
+        self._connected_event.set()
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected_event.clear()
+        # messages in flight are resent on reconnecting and time the outage,
+        # not the broker; QoS 0 ones are never acknowledged
+        with self._timing_lock:
+            self._publish_times.clear()
+            self._early_acks.clear()
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        with self._subacks:
+            self._acked_mids.add(mid)
+            self._subacks.notify_all()
+
+    def _on_publish(self, client, userdata, mid):
+        now = perf_counter()
+        with self._timing_lock:
+            start = self._publish_times.pop(mid, None)
+            if start is None:
+                _remember(self._early_acks, mid, now)
+        if start is not None:
+            self._record_publish(now - start)
+
+    @staticmethod
+    def _record_publish(seconds):
+        get_registry().histogram(
+            "mqtt_publish_ack_seconds", "Time from publish to PUBACK/PUBCOMP"
+        ).record(seconds)
+
+    def _on_message(self, client, userdata, message):
+        self._network_thread = threading.get_ident()
+        get_registry().counter("mqtt_messages_received_total").inc()
+        if self.recorder is not None:
+            self.recorder.record_message(self._stream, message)
+        with self._lock:
+            handlers = [
+                handler
+                for topic_filter, topic_handlers in self._handlers.items()
+                if mqtt_client.topic_matches_sub(topic_filter, message.topic)
+                for handler in topic_handlers
+            ]
+        for handler in handlers:
+            # An exception escaping here would kill paho's network thread
+            try:
+                handler(message)
+            except Exception:
+                logger.exception("Error handling message on topic %s", message.topic)
+
+    def subscribe(self, topic, handler=None, qos=2, timeout=None):
+        """Register ``handler`` for ``topic``, subscribing on first use.
+
+        Blocks until the broker has acknowledged a new subscription, so a
+        request published right afterwards cannot miss its reply. Called
+        from a handler, it returns straight away instead, since the
+        acknowledgement is processed on the handler's own thread.
+        """
+        with self._lock:
+            if handler is not None:
+                self._handlers.setdefault(topic, []).append(handler)
+            is_new = self._subscriptions.get(topic, -1) < qos
+            if is_new:
+                self._subscriptions[topic] = qos
+        if not is_new:
+            return
+        result, mid = self.client.subscribe(topic, qos=qos)
+        if result != mqtt_client.MQTT_ERR_SUCCESS:
+            # Not connected right now; on_connect subscribes once we are
+            return
+        if threading.get_ident() == self._network_thread:
+            return
+        timeout = self.connect_timeout if timeout is None else timeout
+        with self._subacks:
+            if not self._subacks.wait_for(lambda: mid in self._acked_mids, timeout):
+                raise TimeoutError(f"Subscription to {topic} not acknowledged")
+            self._acked_mids.discard(mid)
+
+    def remove_handler(self, topic, handler):
+        """Stop calling ``handler`` for ``topic``; the subscription is kept."""
+        with self._lock:
+            handlers = self._handlers.get(topic, [])
+            if handler in handlers:
+                handlers.remove(handler)
+
+    def publish(self, topic, payload, qos=2, retain=False):
+        if self.recorder is not None:
+            self.recorder.record(self._stream, "publish", topic, payload, qos, retain)
+        start = perf_counter()
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        get_registry().counter("mqtt_messages_sent_total").inc()
+        if info.rc != mqtt_client.MQTT_ERR_SUCCESS:
+            return info  # not sent (e.g. offline), so not timed either
+        # the acknowledgement may already have been handled on the network thread
+        with self._timing_lock:
+            acked = self._early_acks.pop(info.mid, None)
+            if acked is None:
+                _remember(self._publish_times, info.mid, start)
+        if acked is not None:
+            self._record_publish(acked - start)
+        return info
+
+    def close(self):
+        self._closed = True
+        self.client.disconnect()
+        self.client.loop_stop()
+        self._connected_event.clear()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(host=None, username=None, password=None, port=None, tls=None):
+    """Return the pooled, connected session for these broker credentials.
+
+    Missing ``host``, ``username`` and ``password`` are read from the
+    ``HIVEMQ_HOST``, ``HIVEMQ_USERNAME`` and ``HIVEMQ_PASSWORD`` environment
+    variables, and ``port`` and ``tls`` from the optional ``HIVEMQ_PORT`` and
+    ``HIVEMQ_TLS``. Sessions are created on first use and reused until closed.
+
+    With ``MQTT_RECORD`` set, sessions record their messages to that file;
+    with ``MQTT_REPLAY`` set, they are :class:`ReplaySession` objects playing
+    a recording back instead of connecting (see :class:`Replayer`).
+    """
+    host = host if host is not None else os.environ[host_key]
+    username = username if username is not None else os.environ[username_key]
+    password = password if password is not None else os.environ[password_key]
+    port = port if port is not None else env_port()
+    tls = tls if tls is not None else env_tls()
+    key = (host, port, username, password, tls)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None or session.closed:
+            replayer = env_replayer()
+            if replayer is not None:
+                session = ReplaySession(replayer, host, port)
+            else:
+                session = MQTTSession(
+                    host,
+                    username,
+                    password,
+                    port=port,
+                    tls=tls,
+                    recorder=env_recorder(),
+                )
+            session.connect()
+            _sessions[key] = session
+    return session
+
+
+@atexit.register
+def close_sessions():
+    """Disconnect and forget every pooled session."""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
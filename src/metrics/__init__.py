@@ -0,0 +1,10 @@
+"""Latency and throughput instrumentation"""
+from metrics._metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsRegistry,
+    REGISTRY,
+    get_registry,
+)
+from metrics._export import to_text, to_json, to_prometheus, write_metrics
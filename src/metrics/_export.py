@@ -0,0 +1,82 @@
+import os
+import json
+import math
+
+from metrics._metrics import REGISTRY
+
+FORMATS = ("text", "json", "prometheus")
+
+
+def _format_value(value):
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def to_text(registry=REGISTRY):
+    """Human-readable summary, one metric per line."""
+    lines = []
+    for name, metric in registry.metrics().items():
+        if metric.kind == "histogram":
+            if not metric.count:
+                lines.append(f"{name}: no samples")
+                continue
+            percentiles = "  ".join(
+                f"p{q:g}={metric.percentile(q) * 1000:.3f}ms" for q in metric.quantiles
+            )
+            lines.append(
+                f"{name}: n={metric.count}  mean={metric.mean * 1000:.3f}ms  "
+                f"{percentiles}  max={metric.max * 1000:.3f}ms"
+            )
+        elif metric.kind == "gauge":
+            lines.append(f"{name}: {metric.value} (max {metric.max})")
+        else:
+            lines.append(f"{name}: {metric.value}")
+    return "\n".join(lines)
+
+
+def to_json(registry=REGISTRY, **kwargs):
+    return json.dumps(registry.snapshot(), **kwargs)
+
+
+def to_prometheus(registry=REGISTRY):
+    """Prometheus text exposition format; histograms become summaries."""
+    lines = []
+    for name, metric in registry.metrics().items():
+        if metric.help:
+            lines.append(f"# HELP {name} {metric.help}")
+        if metric.kind == "histogram":
+            lines.append(f"# TYPE {name} summary")
+            for q in metric.quantiles:
+                value = metric.percentile(q)
+                lines.append(f'{name}{{quantile="{q / 100:g}"}} {_format_value(value)}')
+            lines.append(f"{name}_sum {_format_value(metric.sum)}")
+            lines.append(f"{name}_count {metric.count}")
+        else:
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.append(f"{name} {_format_value(metric.value)}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path, format=None, registry=REGISTRY):
+    """Write the metrics to ``path`` as text, JSON or Prometheus.
+
+    The format defaults to the extension: ``.json`` for JSON, ``.prom`` for
+    Prometheus (e.g. for node_exporter's textfile collector), otherwise text.
+    The file is replaced atomically, so readers never see a partial file.
+    """
+    if format is None:
+        extension = os.path.splitext(path)[1]
+        format = {".json": "json", ".prom": "prometheus"}.get(extension, "text")
+    if format == "json":
+        content = to_json(registry, indent=2)
+    elif format == "prometheus":
+        content = to_prometheus(registry)
+    elif format == "text":
+        content = to_text(registry) + "\n"
+    else:
+        raise ValueError(f"Unknown format {format!r}, expected one of {FORMATS}")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
@@ -0,0 +1,233 @@
+import math
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class Counter:
+    """Monotonically increasing count, e.g. of timeouts."""
+
+    kind = "counter"
+
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {"type": self.kind, "value": self.value}
+
+
+class Gauge:
+    """Value that goes up and down, e.g. a queue depth; keeps its maximum."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+            self.max = max(self.max, value)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+            self.max = max(self.max, self.value)
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def snapshot(self):
+        return {"type": self.kind, "value": self.value, "max": self.max}
+
+
+class Histogram:
+    """HDR-style histogram of positive values such as latencies in seconds.
+
+    Values are counted in log-linear buckets: every power of two between
+    ``lowest`` and ``highest`` is split into ``2 ** precision_bits`` equal
+    buckets. Recording is O(1) and memory is fixed, regardless of the number
+    of values, and any percentile is reported with a relative error below
+    ``2 ** -precision_bits`` (under 1 % with the default 7 bits). Values
+    outside the range are clamped to it.
+
+    Examples
+    --------
+    >>> h = Histogram("latency_seconds")
+    >>> for ms in range(1, 101):
+    ...     h.record(ms / 1000)
+    >>> round(h.percentile(50), 3), round(h.percentile(99), 3), h.count
+    (0.05, 0.099, 100)
+    """
+
+    kind = "histogram"
+    quantiles = (50, 90, 99, 99.9)
+
+    def __init__(self, name, help="", lowest=1e-6, highest=3600.0, precision_bits=7):
+        self.name = name
+        self.help = help
+        self.lowest = lowest
+        self.highest = highest
+        self.sub_buckets = 1 << precision_bits
+        self.n_octaves = max(1, math.ceil(math.log2(highest / lowest)))
+        self.counts = [0] * (self.n_octaves * self.sub_buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._lock = threading.Lock()
+
+    def _index(self, value):
+        value = min(max(value, self.lowest), self.highest)
+        mantissa, exponent = math.frexp(value / self.lowest)  # mantissa in [0.5, 1)
+        octave = min(exponent - 1, self.n_octaves - 1)
+        sub_bucket = int((mantissa * 2 - 1) * self.sub_buckets)
+        if octave < exponent - 1:  # clamped at the top
+            sub_bucket = self.sub_buckets - 1
+        return octave * self.sub_buckets + min(sub_bucket, self.sub_buckets - 1)
+
+    def _bucket_value(self, index):
+        # midpoint of the bucket
+        octave, sub_bucket = divmod(index, self.sub_buckets)
+        return self.lowest * 2**octave * (1 + (sub_bucket + 0.5) / self.sub_buckets)
+
+    def record(self, value, count=1):
+        index = self._index(value)
+        with self._lock:
+            self.counts[index] += count
+            self.count += count
+            self.sum += value * count
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    @contextmanager
+    def time(self):
+        """Record the wall time spent in the ``with`` block."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(perf_counter() - start)
+
+    def percentile(self, percent):
+        """Value below which ``percent`` % of the recorded values fall."""
+        with self._lock:
+            if not self.count:
+                return math.nan
+            # round first so that e.g. 99.9 % of 20000 is rank 19980, not 19981
+            rank = max(1, math.ceil(round(percent / 100 * self.count, 9)))
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return min(max(self._bucket_value(index), self.min), self.max)
+        return self.max
+
+    def merge(self, other):
+        """Add the values recorded by ``other`` (with the same layout)."""
+        if len(other.counts) != len(self.counts) or other.lowest != self.lowest:
+            raise ValueError("Histograms have different bucket layouts")
+        with self._lock:
+            for index, count in enumerate(other.counts):
+                self.counts[index] += count
+            self.count += other.count
+            self.sum += other.sum
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else math.nan
+
+    def snapshot(self):
+        snapshot = {"type": self.kind, "count": self.count, "sum": self.sum}
+        if self.count:
+            snapshot.update(
+                min=self.min,
+                max=self.max,
+                mean=self.mean,
+                percentiles={str(q): self.percentile(q) for q in self.quantiles},
+            )
+        return snapshot
+
+
+class MetricsRegistry:
+    """Named counters, gauges and histograms, plus recent per-key samples.
+
+    Metrics are created on first use, so instrumented code simply calls e.g.
+    ``registry.histogram("mqtt_reply_seconds").record(dt)``.
+    ``trace(name, key, value)`` additionally keeps the last ``trace_len``
+    samples per name (e.g. the round-trip time of each ``experiment_id``).
+    """
+
+    def __init__(self, trace_len=1000):
+        self.trace_len = trace_len
+        self._metrics = {}
+        self._traces = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise TypeError(f"{name} is a {metric.kind}, not a {cls.kind}")
+        return metric
+
+    def counter(self, name, help=""):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=""):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help="", **kwargs):
+        return self._get(Histogram, name, help, **kwargs)
+
+    def trace(self, name, key, value):
+        with self._lock:
+            samples = self._traces.get(name)
+            if samples is None:
+                samples = self._traces[name] = deque(maxlen=self.trace_len)
+        samples.append((key, value))
+
+    def traces(self, name):
+        return list(self._traces.get(name, ()))
+
+    def metrics(self):
+        with self._lock:
+            return dict(sorted(self._metrics.items()))
+
+    def snapshot(self):
+        """All metrics as a JSON-serialisable dictionary."""
+        snapshot = {name: metric.snapshot() for name, metric in self.metrics().items()}
+        with self._lock:
+            traces = {name: list(samples) for name, samples in self._traces.items()}
+        if traces:
+            snapshot["traces"] = traces
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+            self._traces.clear()
+
+
+REGISTRY = MetricsRegistry()
+
+
+def get_registry():
+    """Return the process-wide registry the built-in instrumentation uses."""
+    return REGISTRY
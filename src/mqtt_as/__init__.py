@@ -1,2 +1,2 @@
-"""Mock function that  gets installed by requirements.txt"""
-from mqtt_as._mqtt_as import MQTTClient, config
+"""asyncio stand-in for the Pico W's mqtt_as, for running the device code on a PC"""
+from mqtt_as._mqtt_as import MQTTClient, MsgQueue, config
@@ -1,24 +1,466 @@
+"""asyncio MQTT 3.1.1 client with the interface of the Pico W's ``mqtt_as``.
+
+Lets ``microcontroller_client.py`` run, and be load tested, under CPython
+against a real broker (e.g. :class:`mqtt_broker.MQTTBroker`). As with
+``mqtt_as``, the client is configured by a ``config`` dictionary, supports
+QoS 0 and 1, and with ``queue_len`` set delivers messages through the
+``up``/``down`` events and an async-iterable ``queue``; otherwise through
+``config["subs_cb"]``. Outages are ridden out: the client reconnects with
+backoff and ``publish`` and ``subscribe`` wait for the connection rather
+than fail.
+"""
 import asyncio
+import os
+import ssl
+import socket
+import struct
+import uuid
+from collections import deque
+from time import monotonic
+
+from mqtt_broker._mqtt_broker import (
+    CONNECT,
+    CONNACK,
+    PUBLISH,
+    PUBACK,
+    PUBREC,
+    PUBREL,
+    PUBCOMP,
+    SUBSCRIBE,
+    SUBACK,
+    UNSUBSCRIBE,
+    UNSUBACK,
+    PINGREQ,
+    DISCONNECT,
+    _encode_string,
+    _packet,
+    _read_packet,
+    _read_string,
+)
+
+SUBSCRIBE_FAILURE = 0x80
+
+# Defaults, updated by the caller and passed to MQTTClient
+config = {
+    # like the board's unique id: the same for every client in this process
+    "client_id": f"{uuid.getnode():012x}-{os.getpid()}",
+    "server": None,
+    "port": 0,  # 1883, or 8883 with ssl
+    "user": "",
+    "password": "",
+    "keepalive": 60,
+    "ping_interval": 0,  # 0: a quarter of keepalive
+    "ssl": False,
+    "ssl_params": {},
+    "response_time": 10,  # seconds to wait for an acknowledgement
+    "clean_init": True,  # clean session on the first connection
+    "clean": True,  # clean session on reconnection
+    "max_repubs": 4,  # resends before the connection is presumed dead
+    "will": None,  # (topic, msg, retain, qos)
+    "subs_cb": lambda *_: None,
+    "wifi_coro": None,  # not used: the host's network is up
+    "connect_coro": None,
+    "ssid": None,
+    "wifi_pw": None,
+    "queue_len": 0,
+    "max_inflight": 8,  # QoS 1 publishes awaiting PUBACK at once
+}
+_DEFAULTS = dict(config)
+
+
+def _ssl_context(ssl_params):
+    # ssl.SSLContext from mqtt_as's ssl_params (ssl.wrap_socket arguments)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if ssl_params.get("cert_reqs") == ssl.CERT_NONE:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif ssl_params.get("cadata"):
+        context.load_verify_locations(cadata=ssl_params["cadata"])
+    else:
+        context.load_default_certs()
+    if ssl_params.get("cert"):
+        context.load_cert_chain(ssl_params["cert"], ssl_params.get("key"))
+    return context
+
+
+def _as_bytes(value):
+    return value.encode() if isinstance(value, str) else bytes(value)
+
+
+class MsgQueue:
+    """Async-iterable queue of ``(topic, msg, retained)`` tuples.
 
-config = {}
+    Holds at most ``size`` messages; when full, the oldest is discarded
+    (and counted in ``discards``) so that the network is never held up.
+    """
+
+    def __init__(self, size):
+        self._items = deque((), size)
+        self._event = asyncio.Event()
+        self.discards = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, *item):
+        if len(self._items) == self._items.maxlen:
+            self.discards += 1
+        self._items.append(item)
+        self._event.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            self._event.clear()
+            await self._event.wait()
+        return self._items.popleft()
 
 
 class MQTTClient:
+    """MQTT client for one broker connection, kept up across outages.
+
+    Parameters
+    ----------
+    config : dict
+        Settings, see the module's ``config`` for the keys and defaults.
+        Keys that are missing take the default.
+
+    Attributes
+    ----------
+    up, down : asyncio.Event
+        Set on every (re)connection and outage; the caller clears them.
+    queue : MsgQueue
+        Received messages, with ``config["queue_len"]`` above 0.
+    REPUB_COUNT : int
+        QoS 1 publishes and subscriptions sent again for want of an
+        acknowledgement.
+
+    Examples
+    --------
+    >>> async def main():  # doctest: +SKIP
+    ...     client = MQTTClient({**config, "server": "127.0.0.1", "queue_len": 16})
+    ...     await client.connect()
+    ...     await client.subscribe("course/neopixel", 1)
+    ...     async for topic, msg, retained in client.queue:
+    ...         await client.publish("course/as7341", msg, qos=1)
+    """
+
     DEBUG = False
+    RECONNECT_DELAY = 0.5  # seconds before the first reconnection attempt
+    MAX_RECONNECT_DELAY = 30
 
     def __init__(self, config):
-        self.config = config
+        settings = {**_DEFAULTS, **config}
+        self.client_id = settings["client_id"]
+        self.server = settings["server"]
+        self.ssl = settings["ssl"]
+        self.ssl_params = settings["ssl_params"]
+        self.port = settings["port"] or (8883 if self.ssl else 1883)
+        self.user = settings["user"]
+        self.password = settings["password"]
+        self.keepalive = settings["keepalive"]
+        self.ping_interval = settings["ping_interval"] or self.keepalive / 4
+        self.response_time = settings["response_time"]
+        self.clean_init = settings["clean_init"]
+        self.clean = settings["clean"]
+        self.max_repubs = settings["max_repubs"]
+        self.will = settings["will"]
+        self.subs_cb = settings["subs_cb"]
+        self.connect_coro = settings["connect_coro"]
         self.up = asyncio.Event()
-        self.queue = asyncio.Queue()
+        self.down = asyncio.Event()
+        self.queue = None
+        if settings["queue_len"] > 0:
+            self.queue = MsgQueue(settings["queue_len"])
+        self.REPUB_COUNT = 0
+
+        self._window = asyncio.Semaphore(settings["max_inflight"])
+        self._online = asyncio.Event()
+        self._reader = None
+        self._writer = None
+        self._lost = None  # future, done once the current connection is lost
+        self._last_rx = 0.0
+        self._tasks = set()  # reader, pinger and reconnection of this client
+        self._acks = {}  # packet id -> future of the acknowledgement's body
+        self._incoming_qos2 = set()  # packet ids awaiting PUBREL
+        self._pid = 0
+        self._closing = False
+
+    def dprint(self, msg, *args):
+        if self.DEBUG:
+            print(msg % args)
+
+    def _spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _new_pid(self):
+        for _ in range(65535):
+            self._pid = self._pid % 65535 + 1
+            if self._pid not in self._acks:
+                return self._pid
+        raise RuntimeError("No free packet identifiers")
+
+    def _connect_packet(self, clean):
+        flags = 0x02 if clean else 0
+        payload = _encode_string(self.client_id)
+        if self.will is not None:
+            topic, msg, retain, qos = self.will
+            flags |= 0x04 | (qos << 3) | (0x20 if retain else 0)
+            payload += _encode_string(topic) + _encode_string(_as_bytes(msg))
+        if self.user:
+            flags |= 0x80
+            payload += _encode_string(self.user)
+            if self.password:
+                flags |= 0x40
+                payload += _encode_string(self.password)
+        body = _encode_string("MQTT") + struct.pack("!BBH", 4, flags, self.keepalive)
+        return _packet(CONNECT, 0, body + payload)
+
+    async def _open(self, clean):
+        # -> (reader, writer) of a connection the broker has accepted
+        kwargs = {}
+        if self.ssl:
+            kwargs["ssl"] = _ssl_context(self.ssl_params)
+            kwargs["server_hostname"] = self.ssl_params.get("server_hostname", self.server)  # noqa: E501
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server, self.port, **kwargs),
+            self.response_time,
+        )
+        try:
+            writer.write(self._connect_packet(clean))
+            packet_type, _, body = await asyncio.wait_for(
+                _read_packet(reader), self.response_time
+            )
+            if packet_type != CONNACK or len(body) < 2:
+                raise ConnectionError(f"Expected CONNACK, got packet type {packet_type}")  # noqa: E501
+            if body[1]:
+                raise ConnectionRefusedError(
+                    f"Connection to {self.server} refused with return code {body[1]}"
+                )
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    def _start(self, reader, writer):
+        self._reader, self._writer = reader, writer
+        self._lost = asyncio.get_running_loop().create_future()
+        self._last_rx = monotonic()
+        self._spawn(self._read_loop(reader, writer))
+        if self.keepalive:
+            self._spawn(self._keep_alive(writer))
+        self._online.set()
+        self.up.set()
+        if self.connect_coro is not None:
+            self._spawn(self.connect_coro(self))
+        self.dprint("Connected to %s:%s", self.server, self.port)
 
     async def connect(self):
-        pass
+        """Connect to the broker; raises ``OSError`` if that fails."""
+        self._closing = False
+        clean = self.clean_init
+        if clean and not self.clean:
+            # Start afresh, then reconnect without clean session so that the
+            # broker keeps the session from here on
+            reader, writer = await self._open(True)
+            writer.write(_packet(DISCONNECT, 0))
+            await writer.drain()
+            writer.close()
+            clean = False
+        self._start(*await self._open(clean))
+
+    def _connection_lost(self, writer, reason):
+        if writer is None or writer is not self._writer:
+            return  # already lost, or an earlier connection
+        self.dprint("Connection lost: %s", reason)
+        self._online.clear()
+        self._writer = self._reader = None
+        writer.close()
+        if not self._lost.done():
+            self._lost.set_result(None)
+        self.down.set()
+        if not self._closing:
+            self._spawn(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self.RECONNECT_DELAY
+        while not self._closing:
+            await asyncio.sleep(delay)
+            try:
+                self._start(*await self._open(self.clean))
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                self.dprint("Reconnecting failed: %s", e)
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+    async def _keep_alive(self, writer):
+        # Ping while connected; a broker that has been silent for keepalive
+        # seconds (PINGRESP included) is presumed gone
+        while writer is self._writer:
+            await asyncio.sleep(self.ping_interval)
+            if writer is not self._writer:
+                return
+            if monotonic() - self._last_rx > self.keepalive:
+                self._connection_lost(writer, "keepalive timeout")
+                return
+            writer.write(_packet(PINGREQ, 0))
+
+    async def _read_loop(self, reader, writer):
+        try:
+            while True:
+                packet_type, flags, body = await _read_packet(reader)
+                self._last_rx = monotonic()
+                self._handle(writer, packet_type, flags, body)
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            self._connection_lost(writer, e)
+
+    def _acknowledge(self, packet_id, body):
+        future = self._acks.get(packet_id)
+        if future is not None and not future.done():
+            future.set_result(body)
+
+    def _handle(self, writer, packet_type, flags, body):
+        if packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic, offset = _read_string(body, 0)
+            if qos:
+                (packet_id,) = struct.unpack_from("!H", body, offset)
+                offset += 2
+            msg = bytes(body[offset:])
+            if qos == 2:
+                # delivered on receipt, once: a resent PUBLISH is only
+                # acknowledged again until PUBREL
+                writer.write(_packet(PUBREC, 0, struct.pack("!H", packet_id)))
+                if packet_id in self._incoming_qos2:
+                    return
+                self._incoming_qos2.add(packet_id)
+            elif qos == 1:
+                writer.write(_packet(PUBACK, 0, struct.pack("!H", packet_id)))
+            if self.queue is not None:
+                self.queue.put(topic, msg, bool(flags & 1))
+            else:
+                self.subs_cb(topic, msg, bool(flags & 1))
+        elif packet_type == PUBREL:
+            (packet_id,) = struct.unpack_from("!H", body, 0)
+            self._incoming_qos2.discard(packet_id)
+            writer.write(_packet(PUBCOMP, 0, struct.pack("!H", packet_id)))
+        elif packet_type in (PUBACK, SUBACK, UNSUBACK):
+            (packet_id,) = struct.unpack_from("!H", body, 0)
+            self._acknowledge(packet_id, body[2:])
+
+    async def _send(self, packet):
+        # Write once connected, waiting out an outage
+        while True:
+            await self._online.wait()
+            writer = self._writer
+            try:
+                writer.write(packet)
+                await writer.drain()
+                return
+            except (OSError, RuntimeError) as e:
+                self._connection_lost(writer, e)
+
+    async def _acknowledged(self, build):
+        # Send the packet build(packet_id) returns until it is acknowledged;
+        # return the body of the acknowledgement. Resent with DUP set after
+        # response_time, and on a new connection after an outage
+        packet_id = self._new_pid()
+        future = asyncio.get_running_loop().create_future()
+        self._acks[packet_id] = future
+        packet = build(packet_id)
+        resends = 0
+        try:
+            while True:
+                await self._send(packet)
+                await asyncio.wait(
+                    (future, self._lost),
+                    timeout=self.response_time,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if future.done():
+                    return future.result()
+                if not self._lost.done():
+                    resends += 1
+                    if resends > self.max_repubs:
+                        # no answer from the broker: presume the connection dead
+                        self._connection_lost(self._writer, "no acknowledgement")
+                        resends = 0
+                if packet[0] >> 4 == PUBLISH:
+                    packet = bytes([packet[0] | 0x08]) + packet[1:]
+                self.REPUB_COUNT += 1
+        finally:
+            del self._acks[packet_id]
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        """Publish ``msg`` (str or bytes-like) to ``topic``.
+
+        Returns once sent at QoS 0, or acknowledged by the broker at QoS 1;
+        at most ``config["max_inflight"]`` QoS 1 messages are awaiting
+        acknowledgement at once. ``msg`` may be reused on return.
+        """
+        if qos not in (0, 1):
+            raise ValueError(f"qos must be 0 or 1, got {qos}")
+        header = _encode_string(topic)
+        flags = (qos << 1) | (1 if retain else 0)
+        msg = _as_bytes(msg)
+        if not qos:
+            await self._send(_packet(PUBLISH, flags, header + msg))
+            return
+        async with self._window:
+            await self._acknowledged(
+                lambda packet_id: _packet(
+                    PUBLISH, flags, header + struct.pack("!H", packet_id) + msg
+                )
+            )
+
+    async def subscribe(self, topic, qos=0):
+        if qos not in (0, 1):
+            raise ValueError(f"qos must be 0 or 1, got {qos}")
+        granted = await self._acknowledged(
+            lambda packet_id: _packet(
+                SUBSCRIBE,
+                0x02,
+                struct.pack("!H", packet_id) + _encode_string(topic) + bytes([qos]),
+            )
+        )
+        if granted[:1] == bytes([SUBSCRIBE_FAILURE]):
+            raise OSError(f"Subscription to {topic} refused")
+
+    async def unsubscribe(self, topic):
+        await self._acknowledged(
+            lambda packet_id: _packet(
+                UNSUBSCRIBE, 0x02, struct.pack("!H", packet_id) + _encode_string(topic)
+            )
+        )
 
-    async def publish(self, topic, payload, qos):
-        pass
+    def isconnected(self):
+        return self._online.is_set()
 
-    async def subscribe(self, topic, qos):
-        pass
+    async def disconnect(self):
+        """Disconnect cleanly, so that the broker does not send the will."""
+        writer = self._writer
+        if writer is not None:
+            writer.write(_packet(DISCONNECT, 0))
+            try:
+                await writer.drain()
+            except OSError:
+                pass
+        self.close()
 
-    async def close(self):
-        pass
+    def close(self):
+        """Drop the connection and stop reconnecting."""
+        self._closing = True
+        self._online.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        writer, self._writer, self._reader = self._writer, None, None
+        if writer is not None:
+            try:
+                writer.close()
+            except RuntimeError:  # the event loop has already been closed
+                writer.transport.get_extra_info("socket").shutdown(socket.SHUT_RDWR)
@@ -0,0 +1,2 @@
+"""Local MQTT broker that stands in for HiveMQ Cloud when running offline"""
+from mqtt_broker._mqtt_broker import MQTTBroker, topic_matches
@@ -0,0 +1,476 @@
+"""Lightweight MQTT 3.1.1 broker for running the clients offline.
+
+Only what the orchestrator, microcontroller and test clients need is
+implemented: CONNECT (with optional username/password), PUBLISH at QoS 0/1/2,
+retained messages, SUBSCRIBE/UNSUBSCRIBE with ``+``/``#`` wildcards, last will
+messages, keepalive and, in memory, persistent sessions (``clean_session``
+false): a client reconnecting with the same id keeps its subscriptions and
+gets the QoS 1/2 messages it missed.
+"""
+import asyncio
+import logging
+import struct
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+CONNACK_ACCEPTED = 0
+CONNACK_BAD_PROTOCOL = 1
+CONNACK_BAD_CREDENTIALS = 4
+
+
+def topic_matches(topic_filter, topic):
+    """Return True if ``topic`` matches the MQTT ``topic_filter``.
+
+    Examples
+    --------
+    >>> topic_matches("course/+/as7341", "course/pico1/as7341")
+    True
+    >>> topic_matches("course/#", "course")
+    True
+    >>> topic_matches("#", "$SYS/uptime")
+    False
+    """
+    if topic.startswith("$") and topic_filter[:1] in ("+", "#"):
+        return False
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def _encode_remaining_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _encode_string(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack("!H", len(value)) + value
+
+
+def _packet(packet_type, flags, body=b""):
+    return (
+        bytes([(packet_type << 4) | flags]) + _encode_remaining_length(len(body)) + body
+    )
+
+
+def _read_string(data, offset):
+    (length,) = struct.unpack_from("!H", data, offset)
+    offset += 2
+    return bytes(data[offset : offset + length]), offset + length
+
+
+async def _read_packet(reader):
+    # -> (packet type, flags, body) of the next packet on the stream
+    header = await reader.readexactly(1)
+    multiplier = 1
+    length = 0
+    while True:
+        (byte,) = await reader.readexactly(1)
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+        if multiplier > 128**3:
+            raise ValueError("Malformed remaining length")
+    body = await reader.readexactly(length) if length else b""
+    return header[0] >> 4, header[0] & 0x0F, body
+
+
+class _Message:
+    __slots__ = ("topic", "payload", "qos", "retain")
+
+    def __init__(self, topic, payload, qos, retain):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class _Session:
+    """State kept for a client that disconnected with ``clean_session`` false."""
+
+    def __init__(self, subscriptions, maxlen):
+        self.subscriptions = subscriptions  # topic filter -> granted qos
+        self.pending = deque(maxlen=maxlen)  # (message, qos) missed while away
+
+
+class _Connection:
+    """Server side of a single client connection."""
+
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.clean_session = True
+        self.keepalive = 0
+        self.subscriptions = {}  # topic filter -> granted qos
+        self.will = None
+        self.next_packet_id = 0
+        self.incoming_qos2 = set()  # packet ids awaiting PUBREL
+        self.outgoing = {}  # packet id -> message awaiting acknowledgement
+        self.closed = False
+
+    def _packet_id(self):
+        for _ in range(65535):
+            self.next_packet_id = self.next_packet_id % 65535 + 1
+            if self.next_packet_id not in self.outgoing:
+                return self.next_packet_id
+        raise RuntimeError("No free packet identifiers")
+
+    def send(self, data):
+        if not self.closed:
+            self.writer.write(data)
+
+    def deliver(self, message, qos, retain=False):
+        flags = (qos << 1) | (1 if retain else 0)
+        body = _encode_string(message.topic)
+        if qos:
+            packet_id = self._packet_id()
+            self.outgoing[packet_id] = message
+            body += struct.pack("!H", packet_id)
+        self.send(_packet(PUBLISH, flags, body + message.payload))
+
+    async def read_packet(self):
+        return await _read_packet(self.reader)
+
+    async def run(self):
+        try:
+            packet_type, _, body = await asyncio.wait_for(
+                self.read_packet(), timeout=self.broker.connect_timeout
+            )
+            if packet_type != CONNECT or not self.handle_connect(body):
+                return
+            while True:
+                if self.keepalive:
+                    packet_type, flags, body = await asyncio.wait_for(
+                        self.read_packet(), timeout=self.keepalive * 1.5
+                    )
+                else:
+                    packet_type, flags, body = await self.read_packet()
+                if packet_type == DISCONNECT:
+                    self.will = None
+                    return
+                self.handle(packet_type, flags, body)
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except (struct.error, IndexError, ValueError) as e:
+            # a malformed or truncated packet (ValueError covers bad UTF-8)
+            logger.warning("Closing %s after a malformed packet: %r", self.client_id, e)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.broker._disconnected(self)
+        if not self.clean_session:
+            # unacknowledged messages are sent again on reconnect
+            self.broker._keep_session(self, list(self.outgoing.values()))
+        if self.will is not None:
+            self.broker.publish(self.will)
+            self.will = None
+        self.writer.close()
+
+    def handle_connect(self, body):
+        protocol, offset = _read_string(body, 0)
+        level, flags = body[offset], body[offset + 1]
+        (self.keepalive,) = struct.unpack_from("!H", body, offset + 2)
+        offset += 4
+        if protocol not in (b"MQTT", b"MQIsdp") or level not in (3, 4):
+            self.send(_packet(CONNACK, 0, bytes([0, CONNACK_BAD_PROTOCOL])))
+            return False
+        client_id, offset = _read_string(body, offset)
+        # An empty client id asks the server to assign a unique one
+        self.client_id = client_id.decode() or f"auto-{id(self):x}"
+        self.clean_session = bool(flags & 0x02) or not client_id
+        if flags & 0x04:
+            will_topic, offset = _read_string(body, offset)
+            will_payload, offset = _read_string(body, offset)
+            self.will = _Message(
+                will_topic.decode(), will_payload, (flags >> 3) & 0x03, bool(flags & 0x20)
+            )
+        username = password = None
+        if flags & 0x80:
+            username, offset = _read_string(body, offset)
+            username = username.decode()
+        if flags & 0x40:
+            password, offset = _read_string(body, offset)
+            password = password.decode()
+        if not self.broker._authenticate(username, password):
+            self.send(_packet(CONNACK, 0, bytes([0, CONNACK_BAD_CREDENTIALS])))
+            return False
+        session = self.broker._connected(self)
+        session_present = 1 if session is not None else 0
+        self.send(_packet(CONNACK, 0, bytes([session_present, CONNACK_ACCEPTED])))
+        if session is not None:
+            self.subscriptions = session.subscriptions
+            for message, qos in session.pending:
+                self.deliver(message, qos)
+        return True
+
+    def handle(self, packet_type, flags, body):
+        if packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic, offset = _read_string(body, 0)
+            packet_id = None
+            if qos:
+                (packet_id,) = struct.unpack_from("!H", body, offset)
+                offset += 2
+            message = _Message(topic.decode(), bytes(body[offset:]), qos, bool(flags & 1))
+            if qos == 0:
+                self.broker.publish(message)
+            elif qos == 1:
+                self.broker.publish(message)
+                self.send(_packet(PUBACK, 0, struct.pack("!H", packet_id)))
+            else:
+                # Deliver on receipt and remember the id until PUBREL so that a
+                # retransmitted PUBLISH is not delivered twice
+                if packet_id not in self.incoming_qos2:
+                    self.incoming_qos2.add(packet_id)
+                    self.broker.publish(message)
+                self.send(_packet(PUBREC, 0, struct.pack("!H", packet_id)))
+        elif packet_type == PUBREL:
+            (packet_id,) = struct.unpack("!H", body[:2])
+            self.incoming_qos2.discard(packet_id)
+            self.send(_packet(PUBCOMP, 0, struct.pack("!H", packet_id)))
+        elif packet_type in (PUBACK, PUBCOMP):
+            (packet_id,) = struct.unpack("!H", body[:2])
+            self.outgoing.pop(packet_id, None)
+        elif packet_type == PUBREC:
+            (packet_id,) = struct.unpack("!H", body[:2])
+            self.send(_packet(PUBREL, 0x02, struct.pack("!H", packet_id)))
+        elif packet_type == SUBSCRIBE:
+            (packet_id,) = struct.unpack_from("!H", body, 0)
+            offset = 2
+            granted = bytearray()
+            new_filters = []
+            while offset < len(body):
+                topic_filter, offset = _read_string(body, offset)
+                qos = min(body[offset] & 0x03, 2)
+                offset += 1
+                topic_filter = topic_filter.decode()
+                self.subscriptions[topic_filter] = qos
+                granted.append(qos)
+                new_filters.append((topic_filter, qos))
+            self.send(_packet(SUBACK, 0, struct.pack("!H", packet_id) + bytes(granted)))
+            for topic_filter, qos in new_filters:
+                self.broker._send_retained(self, topic_filter, qos)
+        elif packet_type == UNSUBSCRIBE:
+            (packet_id,) = struct.unpack_from("!H", body, 0)
+            offset = 2
+            while offset < len(body):
+                topic_filter, offset = _read_string(body, offset)
+                self.subscriptions.pop(topic_filter.decode(), None)
+            self.send(_packet(UNSUBACK, 0, struct.pack("!H", packet_id)))
+        elif packet_type == PINGREQ:
+            self.send(_packet(PINGRESP, 0))
+
+
+class MQTTBroker:
+    """In-process MQTT broker running on its own event loop thread.
+
+    Parameters
+    ----------
+    host : str
+        Interface to listen on.
+    port : int
+        Port to listen on. ``0`` picks a free port, available as ``port``
+        once the broker has started.
+    username, password : str, optional
+        If given, clients must present these credentials.
+
+    Examples
+    --------
+    >>> with MQTTBroker() as broker:  # doctest: +SKIP
+    ...     client.connect("127.0.0.1", broker.port)
+    """
+
+    connect_timeout = 10
+    # messages kept per persistent session while its client is away
+    max_pending = 10000
+
+    def __init__(self, host="127.0.0.1", port=0, username=None, password=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.retained = {}  # topic -> _Message
+        self.connections = set()
+        self._clients = {}  # client id -> _Connection
+        self._sessions = {}  # client id -> _Session of a disconnected client
+        self._tasks = set()
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+
+    def _authenticate(self, username, password):
+        if self.username is None:
+            return True
+        return username == self.username and password == self.password
+
+    def _connected(self, connection):
+        """Register ``connection``; return its resumed _Session, if any."""
+        previous = self._clients.get(connection.client_id)
+        if previous is not None and previous is not connection:
+            # MQTT-3.1.4-2: a second client with the same id takes over
+            previous.close()
+        self._clients[connection.client_id] = connection
+        self.connections.add(connection)
+        session = self._sessions.pop(connection.client_id, None)
+        return None if connection.clean_session else session
+
+    def _keep_session(self, connection, unacknowledged):
+        session = _Session(connection.subscriptions, self.max_pending)
+        session.pending.extend((message, message.qos) for message in unacknowledged)
+        self._sessions[connection.client_id] = session
+
+    def _disconnected(self, connection):
+        self.connections.discard(connection)
+        if self._clients.get(connection.client_id) is connection:
+            del self._clients[connection.client_id]
+
+    def _send_retained(self, connection, topic_filter, qos):
+        for message in list(self.retained.values()):
+            if topic_matches(topic_filter, message.topic):
+                connection.deliver(message, min(qos, message.qos), retain=True)
+
+    def publish(self, message):
+        """Route ``message`` to every matching subscription."""
+        if message.retain:
+            if message.payload:
+                self.retained[message.topic] = message
+            else:
+                self.retained.pop(message.topic, None)
+        for connection in list(self.connections):
+            granted = [
+                qos
+                for topic_filter, qos in connection.subscriptions.items()
+                if topic_matches(topic_filter, message.topic)
+            ]
+            if granted:
+                # One copy per client at the highest granted QoS (MQTT-3.3.5-1)
+                connection.deliver(message, min(max(granted), message.qos))
+        if message.qos:
+            for session in self._sessions.values():
+                granted = [
+                    qos
+                    for topic_filter, qos in session.subscriptions.items()
+                    if topic_matches(topic_filter, message.topic)
+                ]
+                if granted and max(granted):
+                    session.pending.append((message, min(max(granted), message.qos)))
+
+    async def _handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await _Connection(self, reader, writer).run()
+        finally:
+            self._tasks.discard(task)
+
+    async def _start_server(self):
+        self._server = await asyncio.start_server(
+            self._handle_client, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def start(self, timeout=10):
+        """Start serving on a background thread and wait until bound."""
+        if self._thread is not None:
+            return self
+        self._loop = asyncio.new_event_loop()
+        errors = []
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self._start_server())
+            except OSError as e:
+                errors.append(e)
+                self._started.set()
+                return
+            self._started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="mqtt-broker", daemon=True)
+        self._thread.start()
+        if not self._started.wait(timeout):
+            raise TimeoutError(f"MQTT broker did not start within {timeout} s")
+        if errors:
+            self._thread = None
+            self._started.clear()
+            raise errors[0]
+        return self
+
+    def disconnect_all(self):
+        """Abruptly drop every client connection, as a network failure would."""
+
+        def drop():
+            for connection in list(self.connections):
+                connection.writer.transport.abort()
+
+        self._loop.call_soon_threadsafe(drop)
+
+    def stop(self, timeout=10):
+        """Close all connections and stop the background thread."""
+        if self._thread is None:
+            return
+
+        async def shutdown():
+            self._server.close()
+            for connection in list(self.connections):
+                connection.will = None
+                connection.close()
+            # Closing the transport ends each connection's read loop
+            if self._tasks:
+                await asyncio.wait(self._tasks, timeout=timeout)
+            await self._server.wait_closed()
+            self._loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop)
+        self._thread.join(timeout)
+        self._thread = None
+        self._started.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
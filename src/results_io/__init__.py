@@ -0,0 +1,22 @@
+"""Reading and writing experiment results"""
+from results_io._results_io import (
+    ResultsWriter,
+    iter_results,
+    load_results,
+    completed_experiment_ids,
+)
+from results_io._columnar import (
+    ColumnarResults,
+    results_to_columnar,
+    save_columnar,
+    load_columnar,
+    json_to_columnar,
+    columnar_to_json,
+)
+from results_io._validation import (
+    Schema,
+    Mismatch,
+    ValidationReport,
+    results_schema,
+    validate_results,
+)
@@ -0,0 +1,195 @@
+import os
+import json
+from typing import NamedTuple, Tuple
+
+import numpy as np
+
+from results_io._results_io import ResultsWriter, iter_results
+
+FORMAT = "results-columnar"
+VERSION = 1
+COMMAND_KEYS = ("R", "G", "B")
+
+
+class ColumnarResults(NamedTuple):
+    """A result set stored column-wise.
+
+    Attributes
+    ----------
+    command : ndarray of uint8, shape (N, 3)
+        R, G, B of each command.
+    sensor_data : ndarray of float64, shape (N, len(channels))
+        Channel intensities of each result.
+    experiment_id : ndarray of bytes, shape (N,)
+        ASCII experiment ids.
+    channels : tuple of str
+        Names of the ``sensor_data`` columns, e.g. ``("ch410", ..., "ch670")``.
+    """
+
+    command: np.ndarray
+    sensor_data: np.ndarray
+    experiment_id: np.ndarray
+    channels: Tuple[str, ...]
+
+    def __len__(self):
+        return len(self.experiment_id)
+
+    def iter_results_dicts(self):
+        """Yield the results in the nested ``results.json`` layout."""
+        for command, sensor_data, experiment_id in zip(
+            self.command.tolist(), self.sensor_data.tolist(), self.experiment_id
+        ):
+            yield {
+                "command": dict(zip(COMMAND_KEYS, command)),
+                "experiment_id": experiment_id.decode(),
+                "sensor_data": dict(zip(self.channels, sensor_data)),
+            }
+
+    def to_results_dicts(self):
+        return list(self.iter_results_dicts())
+
+
+def _commands_to_array(commands):
+    command = np.array(commands)
+    if len(command) and (
+        command.min() < 0 or command.max() > 255 or np.any(command != np.round(command))
+    ):
+        raise ValueError("Commands must be integers between 0 and 255")
+    return command.astype(np.uint8).reshape(-1, len(COMMAND_KEYS))
+
+
+def results_to_columnar(results_dicts, channels=None):
+    """Convert results dictionaries to a :class:`ColumnarResults`.
+
+    ``channels`` defaults to the ``sensor_data`` keys of the first result.
+    """
+    results_dicts = list(results_dicts)
+    if channels is None:
+        channels = tuple(results_dicts[0]["sensor_data"]) if results_dicts else ()
+    command = _commands_to_array(
+        [[d["command"][key] for key in COMMAND_KEYS] for d in results_dicts]
+    )
+    sensor_data = np.array(
+        [[d["sensor_data"][ch] for ch in channels] for d in results_dicts],
+        dtype=np.float64,
+    ).reshape(-1, len(channels))
+    experiment_id = np.array(
+        [d["experiment_id"].encode() for d in results_dicts], dtype=np.bytes_
+    )
+    return ColumnarResults(command, sensor_data, experiment_id, tuple(channels))
+
+
+def _write_meta(path, n, channels, id_width):
+    meta = {
+        "format": FORMAT,
+        "version": VERSION,
+        "length": n,
+        "channels": list(channels),
+        "command_keys": list(COMMAND_KEYS),
+        "experiment_id_width": id_width,
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def save_columnar(path, results):
+    """Save ``results`` (columnar or results dictionaries) to directory ``path``.
+
+    The directory holds one ``.npy`` file per column plus ``meta.json``, so
+    each column can be memory-mapped on its own by :func:`load_columnar`.
+    """
+    if not isinstance(results, ColumnarResults):
+        results = results_to_columnar(results)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "command.npy"), results.command)
+    np.save(os.path.join(path, "sensor_data.npy"), results.sensor_data)
+    np.save(os.path.join(path, "experiment_id.npy"), results.experiment_id)
+    _write_meta(path, len(results), results.channels, results.experiment_id.itemsize)
+
+
+def load_columnar(path, mmap_mode="r"):
+    """Load a result set saved by :func:`save_columnar`.
+
+    With the default ``mmap_mode="r"`` the columns are memory-mapped, so
+    loading is zero-copy and only the pages actually touched are read.
+    Pass ``mmap_mode=None`` to read everything into memory.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("format") != FORMAT or meta.get("version") != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} {FORMAT} directory")
+    return ColumnarResults(
+        np.load(os.path.join(path, "command.npy"), mmap_mode=mmap_mode),
+        np.load(os.path.join(path, "sensor_data.npy"), mmap_mode=mmap_mode),
+        np.load(os.path.join(path, "experiment_id.npy"), mmap_mode=mmap_mode),
+        tuple(meta["channels"]),
+    )
+
+
+def json_to_columnar(src, dst, chunk_size=100_000):
+    """Convert a ``results.json`` file (JSON list or JSON Lines) to columnar.
+
+    The input is streamed twice (once to size the columns, once to fill
+    them ``chunk_size`` records at a time), so memory use does not grow with
+    the number of results.
+    """
+    n = 0
+    channels = None
+    id_width = 1
+    for record in iter_results(src):
+        if channels is None:
+            channels = tuple(record["sensor_data"])
+        id_width = max(id_width, len(record["experiment_id"].encode()))
+        n += 1
+    channels = channels or ()
+
+    os.makedirs(dst, exist_ok=True)
+    columns = {
+        "command": np.lib.format.open_memmap(
+            os.path.join(dst, "command.npy"), "w+", np.uint8, (n, len(COMMAND_KEYS))
+        ),
+        "sensor_data": np.lib.format.open_memmap(
+            os.path.join(dst, "sensor_data.npy"), "w+", np.float64, (n, len(channels))
+        ),
+        "experiment_id": np.lib.format.open_memmap(
+            os.path.join(dst, "experiment_id.npy"), "w+", f"S{id_width}", (n,)
+        ),
+    }
+
+    def flush(start, chunk):
+        part = results_to_columnar(chunk, channels=channels)
+        stop = start + len(chunk)
+        columns["command"][start:stop] = part.command
+        columns["sensor_data"][start:stop] = part.sensor_data
+        columns["experiment_id"][start:stop] = part.experiment_id
+        return stop
+
+    start = 0
+    chunk = []
+    for record in iter_results(src):
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            start = flush(start, chunk)
+            chunk = []
+    if chunk:
+        flush(start, chunk)
+    for column in columns.values():
+        column.flush()
+    _write_meta(dst, n, channels, id_width)
+    return load_columnar(dst)
+
+
+def columnar_to_json(src, dst, lines=True):
+    """Write a columnar result set back out in the ``results.json`` layout.
+
+    By default this writes JSON Lines as :class:`ResultsWriter` does; pass
+    ``lines=False`` for a single JSON list.
+    """
+    results = load_columnar(src)
+    if lines:
+        with ResultsWriter(dst, fsync_every=len(results) + 1) as writer:
+            for results_dict in results.iter_results_dicts():
+                writer.write(results_dict)
+    else:
+        with open(dst, "w") as f:
+            json.dump(results.to_results_dicts(), f)
@@ -0,0 +1,103 @@
+import os
+import json
+from time import monotonic
+
+
+class ResultsWriter:
+    """Append results to a JSON Lines file as they arrive.
+
+    Each record is written as one line and flushed to the operating system
+    straight away, so a crash of the writing process loses nothing. Calls to
+    ``os.fsync`` (which protect against power loss but are slow) are batched:
+    every ``fsync_every`` records or ``fsync_interval`` seconds, and on close.
+
+    Parameters
+    ----------
+    path : str or path-like
+        File to write to.
+    append : bool
+        Keep existing records (e.g. when resuming) instead of truncating.
+    fsync_every : int
+        Number of records between fsyncs.
+    fsync_interval : float
+        Maximum number of seconds between fsyncs.
+
+    Examples
+    --------
+    >>> with ResultsWriter("results.json") as writer:  # doctest: +SKIP
+    ...     writer.write(results_dict)
+    """
+
+    def __init__(self, path, append=False, fsync_every=100, fsync_interval=1.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._file = open(path, "a" if append else "w")
+        self._unsynced = 0
+        self._last_sync = monotonic()
+
+    def write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if (
+            self._unsynced >= self.fsync_every
+            or monotonic() - self._last_sync >= self.fsync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = monotonic()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.sync()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_results(path):
+    """Lazily yield the records in a JSON Lines or JSON array file.
+
+    JSON arrays (the original ``json.dump`` layout) are loaded in one go;
+    JSON Lines files are read line by line. A truncated last line, as left
+    behind by a crash mid-write, is skipped.
+    """
+    with open(path) as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        if first == "[":
+            f.seek(0)
+            yield from json.load(f)
+            return
+        f.seek(0)
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                if line.endswith("\n"):
+                    raise
+                # only the last line can be incomplete
+
+
+def load_results(path):
+    """Return the records in a JSON Lines or JSON array file as a list."""
+    return list(iter_results(path))
+
+
+def completed_experiment_ids(path):
+    """Return the experiment ids already recorded in ``path``, for resuming."""
+    if not os.path.exists(path):
+        return set()
+    return {record["experiment_id"] for record in iter_results(path)}